@@ -0,0 +1,464 @@
+import logging
+import re
+import sqlite3
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from Queue import Queue, Empty
+from random import uniform
+from time import time, sleep
+from xml.etree import ElementTree
+
+import requests
+from requests.adapters import HTTPAdapter
+from boardgamegeek import BoardGameGeek
+from boardgamegeek.exceptions import BoardGameGeekError
+
+from CacheManager import CacheManager
+from GameSummary import GameSummary, GameStore
+from LRUCache import LRUCache
+from Metrics import metrics
+from Profiler import profiler
+
+log = logging.getLogger(__name__)
+
+BGG_API = u'https://www.boardgamegeek.com/xmlapi2'
+_BGG_API_RE = re.compile(u'^https?://(www\.)?boardgamegeek\.com/xmlapi2')
+
+# seconds BGG data, and anything made from it, is cached for.
+BGG_CACHE_TTL = 86400
+
+
+class Thing(namedtuple(u'Thing', [u'id', u'name', u'type', u'owned'])):
+    '''The few fields of a BGG "thing" needed to choose between search results.'''
+    __slots__ = ()
+
+    @property
+    def expansion(self):
+        return self.type == u'boardgameexpansion'
+
+
+def _maxRate(interval):
+    '''Requests per second for the shortest interval between them. 0 is no limit.'''
+    return 1.0 / interval if interval else None
+
+
+class RateLimiter(object):
+    '''A token bucket whose rate adapts to how BGG is coping. Each error halves the rate
+    (down to a sixteenth of maxRate) and pauses every caller for a while. Each success
+    nudges the rate back up towards maxRate. Safe to share between threads.
+
+    A maxRate of None is no limit: callers only wait out the pause after an error.'''
+    def __init__(self, maxRate, burst=2):
+        super(RateLimiter, self).__init__()
+        self._maxRate = maxRate
+        self._minRate = maxRate / 16.0 if maxRate else None
+        self._burst = burst
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._stamp = time()
+        self._pausedUntil = 0.0
+        self.rate = maxRate
+
+    @contextmanager
+    def _state(self):
+        '''Hold the bucket for the body of the with statement.'''
+        with self._lock:
+            yield
+
+    def wait(self):
+        '''Block until the caller may make a request.'''
+        while True:
+            with self._state():
+                now = time()
+                if now < self._pausedUntil:
+                    delay = self._pausedUntil - now
+                elif not self.rate:
+                    return
+                else:
+                    self._tokens = min(self._burst, self._tokens + (now - self._stamp) * self.rate)
+                    self._stamp = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+
+                    delay = (1 - self._tokens) / self.rate
+
+            sleep(delay)
+
+    def success(self):
+        if not self._maxRate:
+            return
+        with self._state():
+            self.rate = min(self._maxRate, self.rate + self._maxRate / 20.0)
+
+    def failure(self, pause):
+        '''BGG is unhappy. Slow down and have everyone wait pause seconds.'''
+        with self._state():
+            if self._maxRate:
+                self.rate = max(self._minRate, self.rate / 2.0)
+            self._tokens = 0
+            self._pausedUntil = max(self._pausedUntil, time() + pause)
+            log.info(u'BGG is throttling us. Pausing {:.1f} seconds, rate now {}/s.'.format(
+                pause, u'{:.2f}'.format(self.rate) if self.rate else u'unlimited'))
+
+
+class SharedRateLimiter(RateLimiter):
+    '''A RateLimiter whose bucket is kept in the sqlite database at path, so that every
+    process using the same path draws from the one budget and backs off together.'''
+    def __init__(self, path, maxRate, burst=2):
+        super(SharedRateLimiter, self).__init__(maxRate, burst)
+        # transactions are begun by hand so that reading and updating the bucket is one.
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                                           isolation_level=None)
+        with self._lock:
+            self._connection.execute(u'PRAGMA journal_mode=WAL')
+            # losing the bucket in a crash does no harm.
+            self._connection.execute(u'PRAGMA synchronous=OFF')
+            self._connection.execute(u'CREATE TABLE IF NOT EXISTS bucket (id integer PRIMARY KEY, '
+                                     u'tokens real, stamp real, paused_until real, rate real)')
+            self._connection.execute(u'INSERT OR IGNORE INTO bucket VALUES (0, ?, ?, 0, ?)',
+                                     (burst, time(), maxRate))
+
+    @contextmanager
+    def _state(self):
+        with self._lock:
+            self._connection.execute(u'BEGIN IMMEDIATE')
+            try:
+                row = self._connection.execute(u'SELECT tokens, stamp, paused_until, rate FROM '
+                                               u'bucket WHERE id=0').fetchone()
+                self._tokens, self._stamp, self._pausedUntil, rate = row
+                # maxRate may be lower than the last run's.
+                self.rate = min(self._maxRate, rate) if self._maxRate and rate else self._maxRate
+                yield
+                self._connection.execute(u'UPDATE bucket SET tokens=?, stamp=?, paused_until=?, '
+                                         u'rate=? WHERE id=0', (self._tokens, self._stamp,
+                                                                self._pausedUntil, self.rate))
+                self._connection.execute(u'COMMIT')
+            except Exception:
+                self._connection.execute(u'ROLLBACK')
+                raise
+
+
+class _ThrottledAdapter(HTTPAdapter):
+    '''Transport adapter that waits on the rate limiter before anything goes out on the
+    wire. Responses served from the requests cache never get this far so cache hits are
+    not throttled. Throttled (429), unavailable (503) and queued (202) responses and
+    connection errors are retried with jittered exponential backoff.'''
+    RETRY_STATUS = (202, 429, 502, 503, 504)
+
+    def __init__(self, limiter, retries=4, backoff=2.0, maxBackoff=60.0, api=BGG_API, *args,
+                 **kwargs):
+        super(_ThrottledAdapter, self).__init__(*args, **kwargs)
+        self._limiter = limiter
+        self._retries = retries
+        self._backoff = backoff
+        self._maxBackoff = maxBackoff
+        # send everything to api instead of BGG, if they differ. Used for testing.
+        self._api = api if api != BGG_API else None
+        self._countLock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def _count(self, request, start, error=False):
+        with self._countLock:
+            self.requests += 1
+            self.errors += 1 if error else 0
+
+        endpoint = request.path_url.split(u'?')[0].rsplit(u'/', 1)[-1]
+        metrics.observe(u'bgg_request_seconds', time() - start, endpoint=endpoint,
+                        help=u'Time taken by each request to BGG, retries counted separately.')
+        if error:
+            metrics.inc(u'bgg_errors_total', endpoint=endpoint,
+                        help=u'Requests to BGG that failed or were throttled.')
+
+    def _delay(self, attempt, response=None):
+        retryAfter = response.headers.get(u'Retry-After') if response is not None else None
+        if retryAfter and retryAfter.isdigit():
+            return min(self._maxBackoff, float(retryAfter))
+
+        return min(self._maxBackoff, self._backoff * 2 ** attempt * uniform(0.5, 1.5))
+
+    def send(self, request, **kwargs):
+        if self._api:
+            request.url = _BGG_API_RE.sub(self._api, request.url)
+
+        attempt = 0
+        while True:
+            with profiler.span(u'bgg wait'):
+                self._limiter.wait()
+            log.debug(u'BGG request: {}'.format(request.url))
+            start = time()
+            try:
+                with profiler.span(u'bgg request'):
+                    response = super(_ThrottledAdapter, self).send(request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self._count(request, start, error=True)
+                if attempt >= self._retries:
+                    raise
+                log.info(u'Error talking to BGG, will retry: {}'.format(e))
+                self._limiter.failure(self._delay(attempt))
+                attempt += 1
+                continue
+
+            self._count(request, start, error=response.status_code in self.RETRY_STATUS)
+            if response.status_code not in self.RETRY_STATUS:
+                self._limiter.success()
+                return response
+
+            if attempt >= self._retries:
+                log.warn(u'Giving up on {} after {} tries, status {}.'.format(
+                    request.url, attempt + 1, response.status_code))
+                return response
+
+            log.info(u'BGG returned {} for {}, will retry.'.format(response.status_code, request.url))
+            self._limiter.failure(self._delay(attempt, response))
+            response.close()
+            attempt += 1
+
+
+class BGGClient(object):
+    '''Wraps a boardgamegeek.BoardGameGeek instance so that all network access to BGG
+    shares one adaptive rate limit and retry policy, no matter how many threads are making
+    calls. interval is the shortest average time between requests, or 0 for no limit.
+
+    Games are also kept in memory. Once older than ttl a game is still returned, as long as
+    it is no older than maxStale, and a background thread fetches a fresh copy. If popular
+    is given, it is called with a count and should return the ids of the most requested
+    games, most popular first. Every prefetchInterval seconds up to prefetchBudget of
+    those that are missing or within prefetchLead seconds of going stale are refreshed.
+    Refreshes use freshBgg, an uncached BoardGameGeek instance, if given, so they are not
+    answered from the cache they are meant to replace.
+
+    Games are returned as GameSummarys. gameCacheSize of them are kept in memory. If store,
+    a GameStore, is given, games are also kept there, by id and name, so they survive a
+    restart without asking BGG again, and descriptions are only read from it when used.
+    Refreshes and prefetches go to the store too, and games fresh there are not
+    prefetched.
+
+    limiter, if given, replaces the rate limiter made from interval. Several bot processes
+    can share one budget by each passing a SharedRateLimiter on the same path. cache, a
+    CacheManager, if given, is told about every use of the requests cache.'''
+    def __init__(self, bgg, interval=0.5, chunk=20, api=BGG_API, ttl=BGG_CACHE_TTL,
+                 maxStale=7 * 86400, popular=None, prefetchBudget=20, prefetchInterval=600,
+                 prefetchLead=3600, freshBgg=None, retries=4, store=None, gameCacheSize=4096,
+                 limiter=None, cache=None):
+        super(BGGClient, self).__init__()
+        self._bgg = bgg
+        self._freshBgg = freshBgg if freshBgg else bgg
+        self._limiter = limiter if limiter else RateLimiter(_maxRate(interval))
+        self._chunk = chunk
+        self._api = api
+        self._things = LRUCache(4096)
+
+        self._session = getattr(bgg, u'requests_session', None)
+        if not self._session:
+            log.warn(u'Cannot find the BGG requests session. Using an uncached one.')
+            self._session = requests.Session()
+
+        self._cache = cache
+        if cache and hasattr(self._session, u'cache'):
+            cache.track(self._session)
+
+        adapter = _ThrottledAdapter(self._limiter, retries=retries, api=api)
+        self._adapter = adapter
+        sessions = [self._session, getattr(self._freshBgg, u'requests_session', None)]
+        # requests uses the adapter with the longest matching prefix, and the library mounts
+        # its own on the API url, so ours has to replace that one too.
+        prefixes = [u'http://', u'https://', BGG_API, BGG_API.replace(u'https:', u'http:')]
+        for session in [s for s in sessions if s]:
+            for prefix in prefixes:
+                session.mount(prefix, adapter)
+
+        # (name, game_id) --> (GameSummary, time fetched)
+        self._games = LRUCache(gameCacheSize)
+        self._store = store
+        self._ttl = ttl
+        self._maxStale = maxStale
+        self._popular = popular
+        self._prefetchBudget = prefetchBudget
+        self._prefetchInterval = prefetchInterval
+        self._prefetchLead = prefetchLead
+        self._refreshQueue = Queue()
+        self._refreshing = set()
+        self._refreshLock = threading.Lock()
+        t = threading.Thread(target=self._refresher, name=u'bgg-refresher')
+        t.daemon = True
+        t.start()
+
+    @classmethod
+    def sqlite(cls, path, sharedRate=False, maxEntries=100000, maxBytes=512 * 2 ** 20,
+               compactInterval=600, compact=True, **kwargs):
+        '''Create a client for BGG cached in the sqlite database at path. Game summaries
+        are kept in PATH-games.db, PATH being path without the .db. Several processes can
+        share these. If sharedRate is True, so is the rate limit, kept in PATH-rate.db.
+
+        The cache is kept to maxEntries responses and maxBytes bytes of them by a
+        CacheManager, compacting every compactInterval seconds if compact is True. Only one
+        of the processes sharing the cache should compact it.'''
+        ttl = kwargs.get(u'ttl', BGG_CACHE_TTL)
+        base = re.sub(u'\.db$', u'', path)
+        if sharedRate:
+            kwargs[u'limiter'] = SharedRateLimiter(u'{}-rate.db'.format(base),
+                                                   _maxRate(kwargs.get(u'interval', 0.5)))
+
+        # The requests cache opens a connection for each read and write. In WAL mode readers
+        # are not held up by a writer in another process, and the mode sticks to the file.
+        connection = sqlite3.connect(path)
+        connection.execute(u'PRAGMA journal_mode=WAL')
+        connection.close()
+        cache = CacheManager(path, maxEntries=maxEntries, maxBytes=maxBytes, ttl=ttl,
+                             interval=compactInterval, compact=compact)
+        return cls(BoardGameGeek(cache=u'sqlite://{}?ttl={}'.format(path, ttl)),
+                   freshBgg=BoardGameGeek(cache=None),
+                   store=GameStore(u'{}-games.db'.format(base)), cache=cache, **kwargs)
+
+    def game(self, name=None, game_id=None):
+        key = (name, int(game_id) if game_id else None)
+        entry = self._entry(key)
+        if entry:
+            game, fetched = entry
+            age = time() - fetched
+            if age < self._ttl:
+                return game
+
+            if age < self._maxStale:
+                log.debug(u'Returning stale {} and refreshing it.'.format(game.name))
+                self._refresh(key)
+                return game
+
+        return self._fetch(key)
+
+    def _entry(self, key):
+        '''Return (GameSummary, time fetched) for key from memory or the store, or None.'''
+        entry = self._games.get(key)
+        if not entry and self._store:
+            name, game_id = key
+            entry = self._store.get(game_id) if game_id else self._store.getByName(name)
+            if entry:
+                self._games.put(key, entry)
+        return entry
+
+    def _fetch(self, key, fresh=False):
+        name, game_id = key
+        bgg = self._freshBgg if fresh else self._bgg
+        game = bgg.game(name, game_id=game_id)
+        if not game:
+            return None
+
+        now = time()
+        if self._store:
+            summary = GameSummary.fromGame(game, keepDescription=False,
+                                           descriptionLoader=self._store.description, fetched=now)
+            self._store.put(summary, game.description, now, name=name)
+        else:
+            summary = GameSummary.fromGame(game, fetched=now)
+
+        self._games.put(key, (summary, now))
+        self._games.put((None, summary.id), (summary, now))
+        return summary
+
+    def _refresh(self, key):
+        with self._refreshLock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        self._refreshQueue.put(key)
+
+    def _refresher(self):
+        '''Fetch the games queued for refresh, off the request path, and now and then queue
+        popular games that are about to go stale.'''
+        nextPrefetch = time() + self._prefetchInterval
+        while True:
+            try:
+                key = self._refreshQueue.get(timeout=max(0.1, nextPrefetch - time()))
+                try:
+                    self._fetch(key, fresh=True)
+                except Exception as e:
+                    log.error(u'Error refreshing {} from BGG: {}'.format(key, e))
+                finally:
+                    with self._refreshLock:
+                        self._refreshing.discard(key)
+            except Empty:
+                pass
+
+            if time() >= nextPrefetch:
+                nextPrefetch = time() + self._prefetchInterval
+                try:
+                    self._prefetch()
+                except Exception as e:
+                    log.error(u'Error prefetching popular games: {}'.format(e))
+
+    def _prefetch(self):
+        if not self._popular or not self._prefetchBudget:
+            return
+
+        queued = 0
+        for game_id in self._popular(4 * self._prefetchBudget):
+            key = (None, int(game_id))
+            entry = self._entry(key)
+            if entry and time() - entry[1] < self._ttl - self._prefetchLead:
+                continue
+
+            self._refresh(key)
+            queued += 1
+            if queued >= self._prefetchBudget:
+                break
+
+        log.debug(u'Queued {} popular games for prefetch.'.format(queued))
+
+    def stats(self):
+        '''Return a dict of request and cache counts.'''
+        return {
+            u'requests': self._adapter.requests,
+            u'errors': self._adapter.errors,
+            u'rate': self._limiter.rate,
+            u'game_hits': self._games.hits,
+            u'game_misses': self._games.misses,
+            u'thing_hits': self._things.hits,
+            u'thing_misses': self._things.misses
+        }
+
+    def cacheStats(self, fresh=False):
+        '''Return the CacheManager's statistics for the requests cache, or None.'''
+        return self._cache.stats(fresh) if self._cache else None
+
+    def search(self, query, **kwargs):
+        return self._bgg.search(query, **kwargs)
+
+    def things(self, ids):
+        '''Return a Thing for each of the given ids, in the same order. The ids are fetched
+        from BGG in chunks, many to a request, and each thing is then cached on its own so
+        later calls only fetch ids not seen before. Unknown ids are left out.'''
+        ids = [int(i) for i in ids]
+        missing = [i for i in ids if i not in self._things]
+        for start in xrange(0, len(missing), self._chunk):
+            chunk = missing[start:start + self._chunk]
+            for thing in self._fetchThings(chunk):
+                self._things.put(thing.id, thing)
+
+        things = [self._things.get(i) for i in ids]
+        return [t for t in things if t]
+
+    def _fetchThings(self, ids):
+        log.debug(u'Fetching {} things from BGG in one request.'.format(len(ids)))
+        params = {u'id': u','.join([str(i) for i in ids]), u'stats': 1}
+        try:
+            r = self._session.get(u'{}/thing'.format(self._api), params=params)
+            r.raise_for_status()
+            root = ElementTree.fromstring(r.content)
+        except (requests.exceptions.RequestException, ElementTree.ParseError) as e:
+            raise BoardGameGeekError(u'error fetching things {}: {}'.format(params[u'id'], e))
+
+        things = []
+        for item in root.findall(u'item'):
+            name = item.find(u'name[@type="primary"]')
+            owned = item.find(u'statistics/ratings/owned')
+            things.append(Thing(
+                int(item.get(u'id')),
+                name.get(u'value') if name is not None else None,
+                item.get(u'type'),
+                int(owned.get(u'value')) if owned is not None else 0))
+
+        return things
@@ -1,18 +1,113 @@
 import sqlite3
+import json
 import logging
+import re
+import threading
+from time import time
 
 log = logging.getLogger(__name__)
 
+
+def normalize_query(name):
+    '''Lower case and collapse whitespace so trivially different spellings of a query share
+    one key.'''
+    return re.sub(u'\s+', u' ', name).strip().lower()
+
+
 class BotDatabase(object):
-    def __init__(self, path):
+    def __init__(self, path, not_found_ttl=86400, comment_retention=30 * 86400, worker=None,
+                 claim_expiry=600):
+        '''not_found_ttl is how long, in seconds, a name BGG could not resolve is remembered
+        as not found. 0 disables the not found cache. comment_retention is how long, in
+        seconds, handled comment ids are kept. It should be longer than the oldest item
+        Reddit will still show in the inbox.
+
+        worker names this process when several bot processes share the database. Each
+        comment is then claimed by one of them, see claim_comment(), and each keeps its own
+        outbox. A claim not followed by the comment being handled within claim_expiry
+        seconds can be taken over by another worker.'''
         super(BotDatabase, self).__init__()
-        self._connection = sqlite3.connect(path)
+        # The comment handler may call in from several worker threads, and other bot
+        # processes may be writing, so wait a while for them rather than fail.
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._lock = threading.RLock()
+        self.worker = worker
+        self._claim_expiry = claim_expiry
+        self._data_version = None
+        self._not_found_ttl = not_found_ttl
+        self.comment_retention = comment_retention
+        # In memory copies of the small, rarely changing alias, admin and ignore tables, keyed
+        # by normalize_query(). Loaded on first use and dropped whenever the table changes.
+        self._alias_map = None
+        self._admins = None
+        self._ignored = None
+
+        # WAL lets readers and the writer get along and makes commits cheaper.
+        self._connection.execute(u'PRAGMA journal_mode=WAL')
 
         stmt = u'SELECT name FROM sqlite_master WHERE type="table" AND name="comments"'
         q = self._connection.execute(stmt).fetchall()
         if not q:
             log.info(u'Creating comments table.')
-            self._connection.execute(u'CREATE table comments (id text)')
+            self._connection.execute(u'CREATE table comments (id text PRIMARY KEY, added real)')
+        else:
+            columns = [row[1] for row in self._connection.execute(u'PRAGMA table_info(comments)')]
+            if u'added' not in columns:
+                self._migrate_comments()
+
+        stmt = u'SELECT name FROM sqlite_master WHERE type="table" AND name="not_found"'
+        q = self._connection.execute(stmt).fetchall()
+        if not q:
+            self._connection.execute(u'CREATE table not_found (query text PRIMARY KEY, added real)')
+            log.info('Created not_found table.')
+
+        stmt = u'SELECT name FROM sqlite_master WHERE type="table" AND name="resolutions"'
+        q = self._connection.execute(stmt).fetchall()
+        if not q:
+            self._connection.execute(u'CREATE table resolutions (query text PRIMARY KEY, '
+                                     u'game_id integer, step text, hits integer DEFAULT 0)')
+            log.info('Created resolutions table.')
+
+        # hit and miss counts for the resolution cache since startup.
+        self.resolution_hits = 0
+        self.resolution_misses = 0
+        # resolution hits, query --> count, and game requests, game_id --> (count, last),
+        # not yet written. They are written by commit().
+        self._hit_counts = {}
+        self._request_counts = {}
+
+        stmt = u'SELECT name FROM sqlite_master WHERE type="table" AND name="game_requests"'
+        q = self._connection.execute(stmt).fetchall()
+        if not q:
+            self._connection.execute(u'CREATE table game_requests (game_id integer PRIMARY KEY, '
+                                     u'count integer, last real)')
+            log.info('Created game_requests table.')
+
+        stmt = u'SELECT name FROM sqlite_master WHERE type="table" AND name="replies"'
+        q = self._connection.execute(stmt).fetchall()
+        if not q:
+            self._connection.execute(u'CREATE table replies (id text PRIMARY KEY, mode text, '
+                                     u'game_ids text, not_found text, added real)')
+            log.info('Created replies table.')
+
+        stmt = u'SELECT name FROM sqlite_master WHERE type="table" AND name="outbox"'
+        q = self._connection.execute(stmt).fetchall()
+        if not q:
+            self._connection.execute(u'CREATE table outbox (id integer PRIMARY KEY AUTOINCREMENT, '
+                                     u'action text, thing_id text, body text, record text, '
+                                     u'added real, worker text)')
+            log.info('Created outbox table.')
+        else:
+            columns = [row[1] for row in self._connection.execute(u'PRAGMA table_info(outbox)')]
+            if u'worker' not in columns:
+                self._connection.execute(u'ALTER TABLE outbox ADD COLUMN worker text')
+
+        stmt = u'SELECT name FROM sqlite_master WHERE type="table" AND name="claims"'
+        q = self._connection.execute(stmt).fetchall()
+        if not q:
+            self._connection.execute(u'CREATE table claims (id text PRIMARY KEY, worker text, '
+                                     u'claimed real)')
+            log.info('Created claims table.')
 
         stmt = u'SELECT name FROM sqlite_master WHERE type="table" AND name="aliases"'
         q = self._connection.execute(stmt).fetchall()
@@ -40,7 +135,7 @@ class BotDatabase(object):
             self._connection.execute(u'CREATE table bot_admins (ruid text)')
             for a in ['phil_s_stein', u'timotab']:
                 log.info(u'Adding {} as admin'.format(a))
-                self._connection.execute(u'INSERT INTO bot_admins VALUES (?)', (a,))
+                self.add_admin(a)
 
         stmt = u'SELECT name FROM sqlite_master WHERE type="table" AND name="ignore"'
         q = self._connection.execute(stmt).fetchall()
@@ -52,44 +147,309 @@ class BotDatabase(object):
         self._connection.commit()
 
     def add_comment(self, comment):
+        '''Record comment as handled. Marking it read is up to the caller.'''
         log.debug(u'adding comment {} to database'.format(comment.id))
-        comment.mark_as_read()
-        self._connection.execute(u'INSERT INTO comments VALUES(?)', (comment.id,))
-        self._connection.commit()
+        with self._lock:
+            # Not committed here, unless other workers are looking for it. Call commit()
+            # once per batch of comments.
+            self._connection.execute(u'INSERT OR IGNORE INTO comments VALUES(?, ?)', (comment.id, time()))
+            if self.worker:
+                self._connection.commit()
+
+    def claim_comment(self, comment):
+        '''Claim comment for this worker. Returns True if it is ours to handle: it has not
+        been handled, and no other worker has claimed it or its claim has expired. Always
+        True when there is only the one process.'''
+        if not self.worker:
+            return True
+
+        now = time()
+        with self._lock:
+            # Each statement is atomic across processes, so only one worker's insert, or
+            # takeover of an expired claim, changes a row. Neither happens once the comment
+            # is handled, however old its claim.
+            cur = self._connection.execute(
+                u'INSERT OR IGNORE INTO claims SELECT ?, ?, ? '
+                u'WHERE NOT EXISTS (SELECT 1 FROM comments WHERE id=?)',
+                (comment.id, self.worker, now, comment.id))
+            if not cur.rowcount:
+                cur = self._connection.execute(
+                    u'UPDATE claims SET worker=?, claimed=? WHERE id=? AND (worker=? OR claimed < ?) '
+                    u'AND NOT EXISTS (SELECT 1 FROM comments WHERE id=?)',
+                    (self.worker, now, comment.id, self.worker, now - self._claim_expiry,
+                     comment.id))
+            self._connection.commit()
+            return cur.rowcount == 1
 
     def comment_exists(self, comment):
-        cmd = u'SELECT COUNT(*) FROM comments WHERE id=?'
-        count = self._connection.execute(cmd, (comment.id,)).fetchall()[0]
-        return count and count[0] > 0
+        with self._lock:
+            cmd = u'SELECT 1 FROM comments WHERE id=?'
+            return self._connection.execute(cmd, (comment.id,)).fetchone() is not None
 
-    def add_alias(self, alias, name):
-        gname = self.get_name_from_alias(alias)
-        if not gname:
-            self._connection.execute(u'INSERT INTO aliases VALUES (?, ?)', (name, alias))
+    def commit(self):
+        '''Commit, writing the resolution hits and game requests counted since the last
+        commit first.'''
+        with self._lock:
+            if self._hit_counts:
+                self._connection.executemany(
+                    u'UPDATE resolutions SET hits = hits + ? WHERE query=?',
+                    [(count, query) for query, count in self._hit_counts.iteritems()])
+                self._hit_counts = {}
+
+            if self._request_counts:
+                rows = self._request_counts.items()
+                self._connection.executemany(u'INSERT OR IGNORE INTO game_requests VALUES (?, 0, ?)',
+                                             [(game_id, last) for game_id, (count, last) in rows])
+                self._connection.executemany(
+                    u'UPDATE game_requests SET count = count + ?, last = ? WHERE game_id=?',
+                    [(count, last, game_id) for game_id, (count, last) in rows])
+                self._request_counts = {}
+
+            self._connection.commit()
+
+    def prune_comments(self):
+        '''Forget comments and replies older than the retention period so the tables stay
+        small.'''
+        with self._lock:
+            cur = self._connection.execute(u'DELETE FROM comments WHERE added < ?',
+                                           (time() - self.comment_retention,))
+            self._connection.execute(u'DELETE FROM replies WHERE added < ?',
+                                     (time() - self.comment_retention,))
+            self._connection.execute(u'DELETE FROM claims WHERE claimed < ?',
+                                     (time() - self.comment_retention,))
             self._connection.commit()
+            if cur.rowcount:
+                log.info(u'Pruned {} old comments from the database.'.format(cur.rowcount))
+
+    def _migrate_comments(self):
+        '''Move an old style comments table, with no key and no timestamps, to the new schema.
+        Existing comments are stamped with the current time.'''
+        log.info(u'Migrating comments table.')
+        self._connection.execute(u'CREATE table comments_new (id text PRIMARY KEY, added real)')
+        self._connection.execute(u'INSERT OR IGNORE INTO comments_new SELECT id, ? FROM comments',
+                                 (time(),))
+        self._connection.execute(u'DROP TABLE comments')
+        self._connection.execute(u'ALTER TABLE comments_new RENAME TO comments')
+
+    def reload(self):
+        '''Drop the in memory alias, admin and ignore tables so they are read again from the
+        database. Only needed if the database was changed by something else.'''
+        with self._lock:
+            self._alias_map = None
+            self._admins = None
+            self._ignored = None
+
+    def refresh(self):
+        '''Reload the in memory tables if another process has written to the database since
+        the last call. Cheap enough to call every poll.'''
+        with self._lock:
+            version = self._connection.execute(u'PRAGMA data_version').fetchone()[0]
+            # the first call cannot tell, so it reloads whatever was read before it.
+            if version != self._data_version:
+                self.reload()
+            self._data_version = version
+
+    def _aliases(self):
+        with self._lock:
+            if self._alias_map is None:
+                self._alias_map = {}
+                rows = self._connection.execute(u'SELECT alias, gamename FROM aliases ORDER BY rowid')
+                for alias, gamename in rows:
+                    # the first one added wins, as it always has.
+                    self._alias_map.setdefault(normalize_query(alias), gamename)
+            return self._alias_map
+
+    def _uids(self, table, column):
+        rows = self._connection.execute(u'SELECT {} FROM {}'.format(column, table))
+        return set([normalize_query(row[0]) for row in rows if row[0]])
+
+    def add_reply(self, reply_id, mode, game_ids, not_found):
+        '''Remember what went into the bot's reply reply_id so it can be repaired without
+        looking everything up again.'''
+        with self._lock:
+            self._connection.execute(u'INSERT OR REPLACE INTO replies VALUES (?, ?, ?, ?, ?)',
+                                     (reply_id, mode, json.dumps(game_ids), json.dumps(not_found), time()))
+            self._connection.commit()
+
+    def get_reply(self, reply_id):
+        '''Return (mode, game_ids, not_found) for the bot's reply reply_id or None if it
+        is not known.'''
+        with self._lock:
+            cmd = u'SELECT mode, game_ids, not_found FROM replies WHERE id=?'
+            row = self._connection.execute(cmd, (reply_id,)).fetchone()
+            if not row:
+                return None
+
+            return row[0], json.loads(row[1]), json.loads(row[2])
+
+    def add_outgoing(self, action, thing_id, body, record=None):
+        '''Keep a reply or edit waiting to be sent. Returns its id in the outbox.'''
+        with self._lock:
+            cur = self._connection.execute(
+                u'INSERT INTO outbox (action, thing_id, body, record, added, worker) '
+                u'VALUES (?, ?, ?, ?, ?, ?)',
+                (action, thing_id, body, json.dumps(record), time(), self.worker))
+            self._connection.commit()
+            return cur.lastrowid
+
+    def remove_outgoing(self, outgoing_id):
+        with self._lock:
+            self._connection.execute(u'DELETE FROM outbox WHERE id=?', (outgoing_id,))
+            self._connection.commit()
+
+    def retarget_outgoing(self, old_thing_id, thing_id):
+        '''Point replies and edits waiting for old_thing_id at thing_id instead.'''
+        with self._lock:
+            self._connection.execute(u'UPDATE outbox SET thing_id=? WHERE thing_id=?',
+                                     (thing_id, old_thing_id))
+            self._connection.commit()
+
+    def pending_outgoing(self):
+        '''Return this worker's unsent replies and edits, oldest first, as (id, action,
+        thing_id, body, record).'''
+        with self._lock:
+            rows = self._connection.execute(
+                u'SELECT id, action, thing_id, body, record FROM outbox WHERE worker IS ? '
+                u'ORDER BY id', (self.worker,)).fetchall()
+            return [(r[0], r[1], r[2], r[3], json.loads(r[4])) for r in rows]
+
+    def add_alias(self, alias, name):
+        with self._lock:
+            gname = self.get_name_from_alias(alias)
+            if not gname:
+                self._connection.execute(u'INSERT INTO aliases VALUES (?, ?)', (name, alias))
+                self._connection.commit()
+                self._alias_map = None
+
+            # the alias now points at a real game, so it is no longer "not found".
+            self.remove_not_found(alias)
+            self.remove_not_found(name)
+            self.remove_resolution(alias)
 
     def get_name_from_alias(self, name):
-        cmd = u'SELECT gamename FROM aliases where alias=?'
-        rows = self._connection.execute(cmd, (name,)).fetchall()
-        return rows[0][0] if rows else None
+        return self._aliases().get(normalize_query(name))
 
     def aliases(self):
-        cmd = u'SELECT * FROM aliases' 
-        rows = self._connection.execute(cmd).fetchall()
-        return [] if not rows else rows
+        with self._lock:
+            cmd = u'SELECT * FROM aliases' 
+            rows = self._connection.execute(cmd).fetchall()
+            return [] if not rows else rows
 
     def is_admin(self, uid):
-        cmd = u'SELECT COUNT(ruid) FROM bot_admins where ruid=?'
-        rows = self._connection.execute(cmd, (uid,)).fetchall()
-        if not rows:
-            return False
+        with self._lock:
+            if self._admins is None:
+                self._admins = self._uids(u'bot_admins', u'ruid')
+            return normalize_query(uid) in self._admins
 
-        return False if rows[0][0] == 0 else True
+    def add_admin(self, uid):
+        with self._lock:
+            if not self.is_admin(uid):
+                self._connection.execute(u'INSERT INTO bot_admins VALUES (?)', (uid,))
+                self._connection.commit()
+                self._admins = None
 
     def ignore_user(self, uid):
-        cmd = u'SELECT COUNT(uid) FROM ignore where uid=?'
-        rows = self._connection.execute(cmd, (uid,)).fetchall()
-        if not rows:
+        with self._lock:
+            if self._ignored is None:
+                self._ignored = self._uids(u'ignore', u'uid')
+            return normalize_query(uid) in self._ignored
+
+    def add_ignored_user(self, uid):
+        with self._lock:
+            if not self.ignore_user(uid):
+                self._connection.execute(u'INSERT INTO ignore VALUES (?)', (uid,))
+                self._connection.commit()
+                self._ignored = None
+
+    def add_not_found(self, name):
+        '''Remember that BGG could not resolve name.'''
+        if not self._not_found_ttl:
+            return
+
+        with self._lock:
+            self._connection.execute(u'INSERT OR REPLACE INTO not_found VALUES (?, ?)',
+                                     (normalize_query(name), time()))
+            self._connection.commit()
+
+    def is_not_found(self, name):
+        '''Return True if name was recently found to not be a game.'''
+        if not self._not_found_ttl:
             return False
 
-        return False if rows[0][0] == 0 else True
+        with self._lock:
+            cmd = u'SELECT added FROM not_found WHERE query=?'
+            rows = self._connection.execute(cmd, (normalize_query(name),)).fetchall()
+            if not rows:
+                return False
+
+            if time() - rows[0][0] > self._not_found_ttl:
+                self.remove_not_found(name)
+                return False
+
+            return True
+
+    def remove_not_found(self, name):
+        with self._lock:
+            self._connection.execute(u'DELETE FROM not_found WHERE query=?', (normalize_query(name),))
+            self._connection.commit()
+
+    def add_resolution(self, name, game_id, step):
+        '''Remember that the query name was found as game game_id by the lookup step step.'''
+        with self._lock:
+            self._connection.execute(u'INSERT OR REPLACE INTO resolutions VALUES (?, ?, ?, 0)',
+                                     (normalize_query(name), game_id, step))
+            self._connection.commit()
+
+    def get_resolution(self, name):
+        '''Return (game_id, step) if the query name has been resolved before, else None.'''
+        query = normalize_query(name)
+        with self._lock:
+            cmd = u'SELECT game_id, step FROM resolutions WHERE query=?'
+            rows = self._connection.execute(cmd, (query,)).fetchall()
+            if not rows:
+                self.resolution_misses += 1
+                return None
+
+            # counted in memory, as a hit is the common case. commit() writes the counts.
+            self.resolution_hits += 1
+            self._hit_counts[query] = self._hit_counts.get(query, 0) + 1
+            return rows[0]
+
+    def remove_resolution(self, name):
+        with self._lock:
+            self._hit_counts.pop(normalize_query(name), None)
+            self._connection.execute(u'DELETE FROM resolutions WHERE query=?', (normalize_query(name),))
+            self._connection.commit()
+
+    def resolution_stats(self):
+        '''Return a dict of resolution cache statistics. "saved" maps each lookup step to the
+        number of times a cached resolution skipped the lookups up to and including it.'''
+        with self._lock:
+            self.commit()
+            cmd = u'SELECT step, SUM(hits) FROM resolutions GROUP BY step'
+            rows = self._connection.execute(cmd).fetchall()
+            return {
+                u'hits': self.resolution_hits,
+                u'misses': self.resolution_misses,
+                u'saved': {step: hits for step, hits in rows}
+            }
+
+    def known_queries(self):
+        '''Return every query that has been resolved to a game, normalized.'''
+        with self._lock:
+            return [r[0] for r in self._connection.execute(u'SELECT query FROM resolutions')]
+
+    def add_game_requests(self, game_ids):
+        '''Count a request for each of the given games. The counts are written by commit().'''
+        with self._lock:
+            now = time()
+            for game_id in game_ids:
+                count = self._request_counts.get(game_id, (0, now))[0]
+                self._request_counts[game_id] = (count + 1, now)
+
+    def popular_games(self, limit):
+        '''Return the ids of the most requested games, most requested first.'''
+        with self._lock:
+            self.commit()
+            cmd = u'SELECT game_id FROM game_requests ORDER BY count DESC LIMIT ?'
+            return [row[0] for row in self._connection.execute(cmd, (limit,)).fetchall()]
@@ -0,0 +1,199 @@
+import logging
+import threading
+from HTMLParser import HTMLParser
+from Queue import Queue, Full, Empty
+from time import time
+
+from CommandParser import parse
+from InboxPoller import InboxPoller
+from Metrics import metrics
+from Profiler import profiler
+
+log = logging.getLogger(__name__)
+
+
+class BotPipeline(object):
+    '''Runs the bot as a fetcher feeding a bounded queue of comments that a pool of command
+    workers take from. A comment is only recorded in the bot database (and marked read)
+    once a worker has handled it, so anything still queued when the bot is stopped is
+    picked up again on the next start.
+
+    When several bot processes share the bot database a worker claims each comment before
+    handling it, and leaves it be if another process got there first. See BotDatabase.claim_comment().'''
+    def __init__(self, reddit, botdb, botname, cmdmap, workers=1, queueSize=100,
+                 timeout=300, poller=None, replyQueue=None):
+        super(BotPipeline, self).__init__()
+        self._botdb = botdb
+        self._cmdmap = cmdmap
+        self._workers = workers
+        self._timeout = timeout
+        self._poller = poller if poller else InboxPoller(reddit, botdb)
+        # if given, comments are marked read in batches through it and it is closed on stop.
+        self._replies = replyQueue
+        self._botname = botname
+        self._hp = HTMLParser()
+
+        self._queue = Queue(queueSize)
+        self._stop = threading.Event()
+        # ids that are queued or being handled.
+        self._pending = set()
+        self._pendingLock = threading.Lock()
+        # comment id --> (seconds its inbox fetch took, time fetched), while profiling.
+        self._fetched = {}
+        self._lastPrune = 0
+        metrics.collect(self._gauges)
+
+    def _gauges(self):
+        return {u'queue_depth': self._queue.qsize(), u'pending_comments': len(self._pending),
+                u'poll_interval_seconds': self._poller.interval}
+
+    def stop(self, signum=None, frame=None):
+        '''Stop fetching and let the workers finish what they are doing. Can be used as a
+        signal handler.'''
+        if not self._stop.is_set():
+            log.info(u'Stopping. Waiting for commands in progress to finish.')
+        self._stop.set()
+
+    def run(self):
+        '''Run until stop() is called.'''
+        threads = []
+        for i in xrange(self._workers):
+            t = threading.Thread(target=self._work, name=u'command-worker-{}'.format(i))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        while not self._stop.is_set():
+            try:
+                self._fetch()
+            except Exception as e:
+                log.error(u'Caught exception: {}'.format(e))
+
+            # a locked database here must not end the loop, and the workers with it.
+            try:
+                # one commit for all the comments seen this time around.
+                self._botdb.commit()
+                # pick up aliases, admins and ignored users added by other bot processes.
+                self._botdb.refresh()
+                if time() - self._lastPrune > 3600:
+                    self._lastPrune = time()
+                    self._botdb.prune_comments()
+            except Exception as e:
+                log.error(u'Caught exception updating the bot database: {}'.format(e))
+
+            self._stop.wait(self._poller.interval)
+
+        for t in threads:
+            t.join(self._timeout)
+
+        self._botdb.commit()
+        if self._replies:
+            self._replies.close(self._timeout)
+        log.info(u'Stopped with {} comments left unhandled. They will be handled on the '
+                 u'next start.'.format(len(self._pending)))
+
+    def _fetch(self):
+        start = time()
+        comments = self._poller.poll()
+        if profiler.active:
+            took = time() - start
+            for comment in comments:
+                self._fetched[comment.id] = (took, time())
+
+        for comment in comments:
+            with self._pendingLock:
+                self._pending.add(comment.id)
+
+            # Block while the queue is full so a backlog slows down fetching instead of
+            # growing without bound.
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(comment, timeout=1)
+                    break
+                except Full:
+                    log.debug(u'Command queue is full, waiting.')
+
+            if self._stop.is_set():
+                return
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                comment = self._queue.get(timeout=1)
+            except Empty:
+                continue
+
+            try:
+                self._workOn(comment)
+            except Exception as e:
+                # a locked database or a Reddit error must not take the worker with it.
+                log.error(u'Caught exception handling {}: {}'.format(comment.id, e))
+            finally:
+                with self._pendingLock:
+                    self._pending.discard(comment.id)
+
+    def _workOn(self, comment):
+        profiling = profiler.active
+        start = time() if profiling else None
+        fetched = self._fetched.pop(comment.id, None)
+        # claimed only now, so a process claims no more than it is ready to handle.
+        try:
+            claimed = self._botdb.claim_comment(comment)
+        except Exception:
+            # offered again on a later poll.
+            self._poller.forget(comment)
+            raise
+        if not claimed:
+            log.debug(u'Comment {} is claimed by another worker.'.format(comment.id))
+            self._poller.forget(comment)
+            return
+
+        before = ()
+        if profiling:
+            before = [(u'dedup', time() - start)]
+            if fetched:
+                before += [(u'inbox fetch', fetched[0]), (u'queue wait', start - fetched[1])]
+
+        self._handle(comment, before)
+        self._record(comment)
+
+    def _record(self, comment):
+        '''Record comment as handled and mark it read.'''
+        self._botdb.add_comment(comment)
+        if self._replies:
+            self._replies.markRead(comment)
+        else:
+            comment.mark_as_read()
+        # created_utc is when the comment was posted, so this is the lag as a user sees it.
+        created = getattr(comment, u'created_utc', None)
+        if created:
+            metrics.observe(u'inbox_lag_seconds', time() - created,
+                            help=u'Time from a comment being posted to it being handled.')
+
+    def _handle(self, comment, before=()):
+        comment.body = self._hp.unescape(comment.body)
+        # parsed once here. The handlers get the same parse from CommandParser.parse().
+        for cmd, arg in parse(comment, self._botname).commands:
+            if cmd not in self._cmdmap:
+                log.info(u'Got unknown command: {}'.format(cmd))
+                continue
+
+            t = threading.Thread(target=self._runCommand, args=(cmd, comment, before),
+                                 name=u'{}-{}'.format(cmd, comment.id))
+            t.daemon = True
+            t.start()
+            t.join(self._timeout)
+            if t.is_alive():
+                # There is no killing a thread. Leave it to finish on its own and move on.
+                log.error(u'Command {} on comment {} took more than {} seconds. Giving up '
+                          u'waiting for it.'.format(cmd, comment.id, self._timeout))
+
+    def _runCommand(self, cmd, comment, before=()):
+        metrics.inc(u'commands_total', command=cmd, help=u'Commands run.')
+        try:
+            with metrics.timer(u'command_seconds', command=cmd, help=u'Time taken by each command.'), \
+                    profiler.command(comment.id, cmd, before):
+                self._cmdmap[cmd](comment)
+        except Exception as e:
+            metrics.inc(u'command_errors_total', command=cmd, help=u'Commands that raised.')
+            log.error(u'Caught exception running {} on {}: {}'.format(cmd, comment.id, e))
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+import argparse
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+from time import time
+
+from argParseLog import addLoggingArgs, handleLoggingArgs
+
+log = logging.getLogger(__name__)
+
+# upper bounds, in seconds, of the age buckets in stats().
+AGE_BUCKETS = [(u'1h', 3600), (u'6h', 6 * 3600), (u'1d', 86400), (u'7d', 7 * 86400)]
+
+
+class _TrackedCache(object):
+    '''Stands in for a requests cache backend, telling the manager about each hit, miss and
+    save on the way through. A response older than expireAfter, a timedelta, is a miss, as
+    the session fetches it again.'''
+    def __init__(self, cache, manager, expireAfter=None):
+        self._cache = cache
+        self._manager = manager
+        self._expireAfter = expireAfter
+
+    def get_response_and_time(self, key, default=(None, None)):
+        result = self._cache.get_response_and_time(key, default)
+        response, stamp = result
+        expired = self._expireAfter is not None and stamp is not None and \
+            datetime.utcnow() - stamp > self._expireAfter
+        self._manager._used(key, hit=response is not None and not expired)
+        return result
+
+    def save_response(self, key, response):
+        self._cache.save_response(key, response)
+        self._manager._saved(key)
+
+    def __getattr__(self, name):
+        return getattr(self._cache, name)
+
+
+class CacheManager(object):
+    '''Keeps the requests cache in the sqlite database at path to at most maxEntries
+    responses and maxBytes bytes of them.
+
+    How often and how recently each response was used is kept in a cache_access table in
+    the same database. Every interval seconds a background thread writes out the uses seen
+    since last time and, if compact is True, removes responses older than ttl, then, when
+    over either limit, evicts the responses with the lowest score until 10% under it. The
+    score is one more than the number of uses, halved for every halfLife seconds since the
+    last one, so a game asked for every day outlives a name bolded once. Deletes are made
+    batch responses at a time, in short transactions, so lookups are never held up for
+    long, and the pages each batch frees are given back to the file system.
+
+    A cache made by the manager uses incremental vacuum from the start. One made before
+    keeps its freed pages for reuse until converted with vacuum(), which rewrites the
+    whole file and blocks every other user of the database while it does.
+
+    Several processes can track the one cache, but only one should compact it.'''
+    def __init__(self, path, maxEntries=100000, maxBytes=512 * 2 ** 20, ttl=86400,
+                 halfLife=86400, interval=600, compact=True, batch=500):
+        super(CacheManager, self).__init__()
+        self._maxEntries = maxEntries
+        self._maxBytes = maxBytes
+        self._ttl = ttl
+        self._halfLife = halfLife
+        self._interval = interval
+        self._compact = compact
+        self._batch = batch
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        # key --> [uses, last used, saved], waiting to be written. Kept apart from _lock so
+        # lookups never wait on a compaction.
+        self._pending = {}
+        self._pendingLock = threading.Lock()
+        # since startup, and since the last flush.
+        self.hits = 0
+        self.misses = 0
+        self._counts = {u'hits': 0, u'misses': 0}
+        self._measured = {}
+
+        with self._lock:
+            c = self._connection
+            # only takes effect on a database with no tables yet.
+            c.execute(u'PRAGMA auto_vacuum=INCREMENTAL')
+            c.execute(u'PRAGMA journal_mode=WAL')
+            # the requests cache creates these on first use, which may not have happened yet.
+            c.execute(u'CREATE TABLE IF NOT EXISTS responses (key PRIMARY KEY, value)')
+            c.execute(u'CREATE TABLE IF NOT EXISTS urls (key PRIMARY KEY, value)')
+            c.execute(u'CREATE TABLE IF NOT EXISTS cache_access (key PRIMARY KEY, uses integer, '
+                      u'last real, saved real)')
+            c.execute(u'CREATE TABLE IF NOT EXISTS cache_counters (name text PRIMARY KEY, '
+                      u'value integer)')
+            c.commit()
+
+        if interval:
+            t = threading.Thread(target=self._run, name=u'bgg-cache-manager')
+            t.daemon = True
+            t.start()
+
+    def track(self, session):
+        '''Have the manager see every use of the requests cache of session, a CachedSession.'''
+        if not isinstance(session.cache, _TrackedCache):
+            session.cache = _TrackedCache(session.cache, self,
+                                          getattr(session, u'_cache_expire_after', None))
+
+    def _used(self, key, hit):
+        now = time()
+        with self._pendingLock:
+            if hit:
+                self.hits += 1
+                self._counts[u'hits'] += 1
+                entry = self._pending.setdefault(key, [0, now, None])
+                entry[0] += 1
+                entry[1] = now
+            else:
+                self.misses += 1
+                self._counts[u'misses'] += 1
+
+    def _saved(self, key):
+        now = time()
+        with self._pendingLock:
+            entry = self._pending.setdefault(key, [0, now, None])
+            entry[2] = now
+
+    def _run(self):
+        while True:
+            threading.Event().wait(self._interval)
+            try:
+                self.flush()
+                if self._compact:
+                    self.compact()
+            except Exception as e:
+                log.error(u'Error managing the BGG cache: {}'.format(e))
+
+    def flush(self):
+        '''Write out the uses seen since the last flush.'''
+        with self._pendingLock:
+            pending, self._pending = self._pending, {}
+            counts, self._counts = self._counts, {u'hits': 0, u'misses': 0}
+
+        with self._lock:
+            c = self._connection
+            for key, (uses, last, saved) in pending.iteritems():
+                c.execute(u'INSERT OR IGNORE INTO cache_access VALUES (?, 0, ?, ?)',
+                          (key, last, saved if saved else last))
+                c.execute(u'UPDATE cache_access SET uses = uses + ?, last = MAX(last, ?), '
+                          u'saved = COALESCE(?, saved) WHERE key=?', (uses, last, saved, key))
+            for name, value in counts.iteritems():
+                self._count(name, value)
+            c.commit()
+
+    def _count(self, name, value):
+        self._connection.execute(u'INSERT OR IGNORE INTO cache_counters VALUES (?, 0)', (name,))
+        self._connection.execute(u'UPDATE cache_counters SET value = value + ? WHERE name=?',
+                                 (value, name))
+
+    def vacuum(self):
+        '''Switch the database to incremental vacuum, if it is not already, with a full
+        VACUUM. That rewrites the whole file under an exclusive lock, so every other user of
+        the database waits for it, and it gives up with False if one is busy with it. Never
+        done by compact().'''
+        with self._lock:
+            c = self._connection
+            if c.execute(u'PRAGMA auto_vacuum').fetchone()[0] == 2:
+                return True
+
+            log.info(u'Switching the BGG cache to incremental vacuum. This may take a while.')
+            c.execute(u'PRAGMA busy_timeout=1000')
+            try:
+                c.execute(u'PRAGMA auto_vacuum=INCREMENTAL')
+                c.execute(u'VACUUM')
+                return True
+            except sqlite3.OperationalError as e:
+                log.warn(u'Could not vacuum the BGG cache, will try again: {}'.format(e))
+                return False
+            finally:
+                c.execute(u'PRAGMA busy_timeout=30000')
+
+    def compact(self):
+        '''Remove expired responses, evict the least valuable ones while over the limits
+        and give the space back.'''
+        start = time()
+        now = time()
+        with self._lock:
+            c = self._connection
+            # responses cached before tracking began count as saved now.
+            c.execute(u'INSERT OR IGNORE INTO cache_access SELECT key, 0, ?, ? FROM responses',
+                      (now, now))
+            c.execute(u'DELETE FROM cache_access WHERE key NOT IN (SELECT key FROM responses)')
+            c.commit()
+            expired = [r[0] for r in c.execute(u'SELECT key FROM cache_access WHERE saved < ?',
+                                               (now - self._ttl,))]
+        self._evict(expired, u'expired')
+
+        with self._lock:
+            rows = self._connection.execute(
+                u'SELECT a.key, a.uses, a.last, LENGTH(r.value) FROM cache_access a '
+                u'JOIN responses r ON r.key = a.key').fetchall()
+
+        count = len(rows)
+        size = sum(r[3] or 0 for r in rows)
+        victims = []
+        if count > self._maxEntries or size > self._maxBytes:
+            rows.sort(key=lambda r: (r[1] + 1) * 0.5 ** ((now - r[2]) / self._halfLife))
+            for key, uses, last, length in rows:
+                if count <= 0.9 * self._maxEntries and size <= 0.9 * self._maxBytes:
+                    break
+                victims.append(key)
+                count -= 1
+                size -= length or 0
+        self._evict(victims, u'evicted')
+
+        with self._lock:
+            self._connection.execute(u'PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+
+        self._measured = self.measure()
+        log.info(u'Compacted the BGG cache in {:.1f}s: {} expired, {} evicted, {} left.'.format(
+            time() - start, len(expired), len(victims), self._measured[u'entries']))
+
+    def _evict(self, keys, counter):
+        for i in xrange(0, len(keys), self._batch):
+            batch = keys[i:i + self._batch]
+            marks = u','.join(u'?' * len(batch))
+            with self._lock:
+                c = self._connection
+                c.execute(u'DELETE FROM responses WHERE key IN ({})'.format(marks), batch)
+                c.execute(u'DELETE FROM urls WHERE value IN ({})'.format(marks), batch)
+                c.execute(u'DELETE FROM cache_access WHERE key IN ({})'.format(marks), batch)
+                self._count(counter, len(batch))
+                c.commit()
+                # gives back the pages the batch freed, if the file uses incremental vacuum.
+                # Frees a page a step, so has to be read to the end.
+                c.execute(u'PRAGMA incremental_vacuum').fetchall()
+
+    def measure(self):
+        '''Return the size of the cache, its lifetime counters and the number of responses
+        in each age bucket, read from the database.'''
+        now = time()
+        with self._lock:
+            c = self._connection
+            entries, size = c.execute(u'SELECT COUNT(*), SUM(LENGTH(value)) FROM responses').fetchone()
+            pageSize = c.execute(u'PRAGMA page_size').fetchone()[0]
+            pages = c.execute(u'PRAGMA page_count').fetchone()[0]
+            counters = dict(c.execute(u'SELECT name, value FROM cache_counters').fetchall())
+            saved = [r[0] for r in c.execute(u'SELECT saved FROM cache_access')]
+
+        # responses cached before tracking began are untracked until the next compaction.
+        ages = {u'untracked': max(0, entries - len(saved))}
+        for name, bound in AGE_BUCKETS + [(u'older', None)]:
+            ages[name] = 0
+        for stamp in saved:
+            age = now - stamp
+            name = next((n for n, bound in AGE_BUCKETS if age < bound), u'older')
+            ages[name] += 1
+
+        hits = counters.get(u'hits', 0)
+        misses = counters.get(u'misses', 0)
+        return {
+            u'entries': entries,
+            u'bytes': size or 0,
+            u'file_bytes': pageSize * pages,
+            u'lifetime_hits': hits,
+            u'lifetime_misses': misses,
+            u'lifetime_hit_ratio': hits / float(hits + misses) if hits + misses else 0.0,
+            u'expired': counters.get(u'expired', 0),
+            u'evicted': counters.get(u'evicted', 0),
+            u'ages': ages
+        }
+
+    def stats(self, fresh=False):
+        '''Hits and misses since startup, and the measurements taken at the last compaction,
+        or now if fresh is True or there has not been one.'''
+        if fresh or not self._measured:
+            self._measured = self.measure()
+        return dict(self._measured, hits=self.hits, misses=self.misses,
+                    max_entries=self._maxEntries, max_bytes=self._maxBytes)
+
+
+def report(stats):
+    '''stats, from CacheManager.stats() or measure(), as lines of text.'''
+    lines = [u'Entries: {} of at most {}'.format(stats[u'entries'], stats.get(u'max_entries', u'?')),
+             u'Size: {:.1f} MB of responses in a {:.1f} MB file'.format(
+                 stats[u'bytes'] / 2.0 ** 20, stats[u'file_bytes'] / 2.0 ** 20),
+             u'Hit ratio: {:.1%} ({} hits, {} misses)'.format(
+                 stats[u'lifetime_hit_ratio'], stats[u'lifetime_hits'], stats[u'lifetime_misses']),
+             u'Expired: {}, evicted: {}'.format(stats[u'expired'], stats[u'evicted']),
+             u'Ages: ' + u', '.join([u'under {} {}'.format(name, stats[u'ages'][name])
+                                     for name, bound in AGE_BUCKETS] +
+                                    [u'{} {}'.format(name, stats[u'ages'][name])
+                                     for name in [u'older', u'untracked']])]
+    return lines
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description=u'Report on, and optionally compact, the BGG cache.')
+    ap.add_argument(u'path', help=u'The BGG cache database, usually r2d8-bgg.db.')
+    ap.add_argument(u'--compact', action=u'store_true',
+                    help=u'Compact the cache to the limits below first. Safe while the bot runs.')
+    ap.add_argument(u'--vacuum', action=u'store_true',
+                    help=u'Switch a cache made by an older bot to incremental vacuum first, so '
+                    u'space freed by compacting is given back. Rewrites the whole file. Stop the '
+                    u'bot first.')
+    ap.add_argument(u'--max-entries', dest=u'max_entries', type=int, default=100000,
+                    help=u'Most responses to keep. Default is 100000.')
+    ap.add_argument(u'--max-mb', dest=u'max_mb', type=int, default=512,
+                    help=u'Most megabytes of responses to keep. Default is 512.')
+    addLoggingArgs(ap)
+    args = ap.parse_args()
+    handleLoggingArgs(args)
+
+    manager = CacheManager(args.path, maxEntries=args.max_entries, maxBytes=args.max_mb * 2 ** 20,
+                           interval=0, compact=args.compact)
+    if args.vacuum and not manager.vacuum():
+        ap.exit(1, u'The cache is in use. Stop the bot and try again.\n')
+    if args.compact:
+        manager.compact()
+    for line in report(dict(manager.measure(), max_entries=args.max_entries)):
+        print(line)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+'''Parses a comment body once, in a single pass, into the bot commands, bolded text and
+**a**=**b** pairs in it, so handlers do not each scan the body with their own regexes.'''
+
+import re
+
+from LRUCache import LRUCache
+
+# What a bolded game name may contain. Checked against each bold span on its own, so this
+# never scans more than one span.
+_GAME_NAME = re.compile(u'\\w[\\w\\.\\s:\\-?$,!\'–&()\\[\\]]*[\\w\\.:\\-?$,!\'–&()\\[\\]]\\Z', re.UNICODE)
+
+MODES = [u'short', u'long']
+
+_parsed = LRUCache(256)
+_compiled = {}
+
+
+def _patterns(botname):
+    '''Return (mention, token) regexes for botname. mention matches a mention of the bot,
+    the command and, without consuming it, the argument. token matches the only places
+    anything starts: a run of two or more stars or a mention. Neither can backtrack.'''
+    if botname not in _compiled:
+        mention = re.compile(u'u/' + re.escape(botname) + u'\\s(\\w+)(?=(?:\\s(\\w+))?)',
+                             re.IGNORECASE)
+        token = re.compile(u'\\*\\*+|' + mention.pattern, re.IGNORECASE)
+        _compiled[botname] = (mention, token)
+    return _compiled[botname]
+
+
+class ParsedComment(object):
+    '''The parts of a comment body the bot acts on.
+
+    commands is a list of (command, argument) in the order they appear, both lower case.
+    argument is the word after the command or None. bold is the text of each **bold**
+    span. pairs is a list of (a, b) for each **a**=**b**. In **a**=**b**=**c** only a and
+    b are a pair.'''
+    __slots__ = (u'body', u'commands', u'bold', u'pairs')
+
+    # Commands and their arguments are matched without re.UNICODE, so they are ASCII.
+
+    def __init__(self, body, botname):
+        self.body = body
+        self.commands = []
+        self.bold = []
+        self.pairs = []
+        self._parse(body, botname.lower())
+
+    def _parse(self, body, botname):
+        mention, token = _patterns(botname)
+        i = 0
+        spanEnd = -1    # where the last bold span ended
+        paired = False  # whether the last span closed a pair, so cannot open one
+        while True:
+            m = token.search(body, i)
+            if not m:
+                break
+
+            if body[m.start()] != u'*':
+                self._command(m)
+                i = m.end()
+                continue
+
+            # The last two stars of a run open the span, and it can have no stars in it,
+            # so it ends at the next star or not at all.
+            start = m.end() - 2
+            close = body.find(u'*', m.end())
+            if close < 0 or not body.startswith(u'**', close):
+                i = m.end()
+                continue
+
+            text = body[m.end():close]
+            paired = not paired and spanEnd >= 0 and start == spanEnd + 1 and body[spanEnd] == u'='
+            if paired:
+                self.pairs.append((self.bold[-1], text))
+            self.bold.append(text)
+            for c in mention.finditer(body, m.end(), close):
+                self._command(c)
+            spanEnd = close + 2
+            i = spanEnd
+
+    def _command(self, m):
+        arg = m.group(2)
+        self.commands.append((m.group(1).lower(), arg.lower() if arg else None))
+
+    def mode(self, command, other=None):
+        '''The mode, short or long, given to the first command. other is the mode for any
+        other word after the command. None if there is no word after it.'''
+        for cmd, arg in self.commands:
+            if cmd == command:
+                if not arg:
+                    return None
+                return arg if arg in MODES else other
+        return None
+
+    def gameNames(self):
+        '''The bolded text that looks like game names.'''
+        return [b for b in self.bold if _GAME_NAME.match(b)]
+
+
+def parse(comment, botname):
+    '''Return the ParsedComment for comment, parsing its body only if it has not been
+    parsed recently.'''
+    # Kept by body rather than on the comment. Asking a PRAW object for an attribute it
+    # does not have fetches it from Reddit.
+    key = (botname, comment.body)
+    parsed = _parsed.get(key)
+    if parsed is None:
+        parsed = ParsedComment(comment.body, botname)
+        _parsed.put(key, parsed)
+    return parsed
@@ -3,27 +3,117 @@
 
 import logging
 import re
-from time import sleep
+import threading
 from urllib2 import quote, unquote
 from random import choice
 from os import getcwd
 from os.path import join as pjoin
-from boardgamegeek import BoardGameGeek as BGG
+from multiprocessing.pool import ThreadPool
 from boardgamegeek.api import BoardGameGeekNetworkAPI
 import boardgamegeek
 
+from BGGClient import BGGClient
+from CacheManager import report
+from CommandParser import parse
+from LRUCache import LRUCache
+from Metrics import metrics
+from Profiler import profiler
+
 log = logging.getLogger(__name__)
 
 
 class CommentHandler(object):
-    def __init__(self, UID, botdb):
+    def __init__(self, UID, botdb, workers=1, bggInterval=0.5, nameIndex=None, renderCacheSize=2048,
+                 bgg=None, probeWorkers=0, replyQueue=None, progressDeadline=None):
+        '''workers is the number of threads used to resolve the bolded names of a single
+        getinfo request. bggInterval is the minimum number of seconds between requests to
+        BGG, shared by all workers. nameIndex is an optional local NameIndex. Names matching
+        one in it exactly are found without going to BGG, and the closest name in it is
+        tried before searching BGG. renderCacheSize is the number of rendered game infos to keep.
+        bgg is an optional BGGClient to use instead of the default sqlite cached one. If
+        probeWorkers is more than 0 the spelling variants of a name BGG does not know are
+        looked up concurrently by that many threads instead of one after another. The
+        result is the same, but it can cost BGG requests a sequential lookup would not make.
+        If replyQueue, a ReplyQueue, is given replies and edits are sent through it instead
+        of straight away. If progressDeadline is given, a getinfo that is still looking up
+        games after that many seconds replies with what it has found and edits the reply
+        once it is done.'''
         self._botdb = botdb
+        self._replies = replyQueue
+        self._nameIndex = nameIndex
         self._botname = UID
         self._header = (u'^*[{}](/r/r2d8)* ^*issues* ^*a* ^*series* ^*of* ^*sophisticated* '
                         u'^*bleeps* ^*and* ^*whistles...*\n\n'.format(self._botname))
 
-        dbpath = pjoin(getcwd(), u'{}-bgg.db'.format(self._botname))
-        self._bgg = BGG(cache=u'sqlite://{}?ttl=86400'.format(dbpath))
+        if bgg:
+            self._bgg = bgg
+        else:
+            dbpath = pjoin(getcwd(), u'{}-bgg.db'.format(self._botname))
+            self._bgg = BGGClient.sqlite(dbpath, interval=bggInterval, popular=botdb.popular_games)
+
+        # rendered game info, keyed on (game id, time fetched from BGG, mode, generation).
+        self._renderCache = LRUCache(renderCacheSize)
+        self._renderGeneration = 0
+        self._renderers = {
+            u'short': self._getShortInfo,
+            u'normal': self._getStdInfo,
+            u'long': self._getLongInfo
+        }
+
+        # Only worth having a pool if there is more than one worker.
+        self._pool = ThreadPool(workers) if workers > 1 else None
+        self._progressDeadline = progressDeadline
+        self._stillLooking = u'\n\n*Still looking for {} more at BGG. This reply will be updated.*'
+        self._noBGG = u'*Could not reach BGG. Please try again later.*'
+        # separate from _pool, whose threads may be waiting on the probes.
+        self._probePool = ThreadPool(probeWorkers) if probeWorkers > 0 else None
+
+    def commands(self):
+        '''Return a map of bot command to the method handling it.'''
+        return {
+            u'getinfo': self.getInfo,
+            u'repair': self.repairComment,
+            u'xyzzy': self.xyzzy,
+            u'alias': self.alias,
+            u'getaliases': self.getaliases,
+            u'getparentinfo': self.getParentInfo,
+            u'cachestats': self.cachestats,
+            u'profile': self.profile
+        }
+
+    def _reply(self, target, text, record=None):
+        '''Reply to target with text. record is (mode, game ids, not found names) to keep
+        for repairs, if the reply lists games. Returns something _edit() can take to edit
+        the reply.'''
+        with profiler.span(u'reply'):
+            if self._replies:
+                return self._replies.reply(target, text, record)
+
+            reply = target.reply(text)
+            if reply and record:
+                self._botdb.add_reply(reply.id, *record)
+            return reply
+
+    def _edit(self, target, text, record=None):
+        '''Replace the text of target, one of the bot's comments, with text.'''
+        with profiler.span(u'edit'):
+            if self._replies:
+                self._replies.edit(target, text, record)
+                return
+
+            target.edit(text)
+            if record:
+                self._botdb.add_reply(target.id, *record)
+
+    def cacheStats(self):
+        '''Return a dict of BGG, resolution and render cache statistics.'''
+        return {
+            u'bgg': self._bgg.stats(),
+            u'http': self._bgg.cacheStats() or {},
+            u'resolutions': self._botdb.resolution_stats(),
+            u'render_hits': self._renderCache.hits,
+            u'render_misses': self._renderCache.misses
+        }
 
     def _bggQueryGame(self, name):
         '''Try "name", then if not found try a few other small things in an effort to find it.'''
@@ -35,41 +125,77 @@ class CommentHandler(object):
             log.warn('Got too long game name: {}'.format(name))
             return None
 
-        game = self._bgg.game(name)
+        query = name
+        with profiler.span(u'not found cache'):
+            notFound = self._botdb.is_not_found(query)
+        if notFound:
+            log.debug(u'{} was recently not found at BGG, not looking again.'.format(query))
+            self._countStep(u'not found cache')
+            return None
+
+        # Have we resolved this query before? If so go straight to the game.
+        with profiler.span(u'resolution cache'):
+            resolved = self._botdb.get_resolution(query)
+            game = self._bgg.game(None, game_id=resolved[0]) if resolved else None
+        if resolved:
+            game_id, step = resolved
+            if game:
+                log.debug(u'{} resolved to {} from the resolution cache (was "{}")'.format(
+                    query, game_id, step))
+                self._countStep(u'resolution cache')
+                return game
+
+            self._botdb.remove_resolution(query)
+
+        # The local name index can often find the game without asking BGG. Only an exact
+        # match here: a near one could stand in for a real game missing from the index.
+        if self._nameIndex:
+            with profiler.span(u'name index'):
+                game_id = self._nameIndex.lookup(name, fuzzy=False)
+                game = self._bgg.game(None, game_id=game_id) if game_id else None
+            if game:
+                self._botdb.add_resolution(query, game.id, u'name index')
+                self._countStep(u'name index')
+                return game
+
+        game, step = self._bggCascade(name)
         if game:
-            return game
+            self._botdb.add_resolution(query, game.id, step)
+        else:
+            self._botdb.add_not_found(query)
+
+        self._countStep(step if game else u'not found')
+        return game
+
+    def _countStep(self, step):
+        metrics.inc(u'resolution_step_total', step=step,
+                    help=u'Game names resolved, by the step that resolved them.')
+
+    def _nameVariants(self, name):
+        '''Return (variants, name). variants are the spellings of name to try at BGG, most
+        preferred first, as (step, name, game_id) with duplicates dropped. step describes
+        the variant. name is name with any embedded url text pulled out.'''
+        variants = [(u'name', name, None)]
 
         # Well OK, how about game ID?
         if not re.search(u'([^\d]+)', name):  # all digits is probably an ID
-            game = self._bgg.game(name=None, game_id=name)
-            if game:
-                log.debug('found game {} via searching by ID'.format(name))
-                return game
+            variants.append((u'id', None, name))
 
         # embedded url? If so, extract.
-        log.debug('Looking for embedded URL')
         m = re.search('\[([^]]*)\]', name)
         if m:
             name = m.group(1)
-            game = self._bgg.game(name)
-            if game:
-                return game
+            variants.append((u'embedded url', name, None))
 
         # note: unembedded from here down
         # remove 'the's
-        log.debug('removing "the"s')
         tmpname = re.sub('^the ', '', name)
         tmpname = re.sub('\sthe\s', ' ', tmpname)
         if tmpname != name:
-            game = self._bgg.game(tmpname)
-            if game:
-                return game
+            variants.append((u'removing "the"s', tmpname, None))
 
         # add a "the" at start.
-        log.debug('adding "the" at start')
-        game = self._bgg.game('The ' + name)
-        if game:
-            return game
+        variants.append((u'adding "the" at start', 'The ' + name, None))
 
         # various substistutions.
         subs = [
@@ -78,17 +204,59 @@ class CommentHandler(object):
             ('\s&\s', ' and ', '& --> and')
         ]
         for search, sub, logmess in subs:
-            log.debug(logmess)
             tmpname = re.sub(search, sub, name)
             if tmpname != name:
-                game = self._bgg.game(tmpname)
+                variants.append((logmess, tmpname, None))
+
+        seen = set()
+        unique = []
+        for step, vname, game_id in variants:
+            if (vname, game_id) not in seen:
+                seen.add((vname, game_id))
+                unique.append((step, vname, game_id))
+
+        return unique, name
+
+    def _probe(self, step, vname, game_id):
+        with profiler.span(u'variant: ' + step):
+            return self._bgg.game(name=vname, game_id=game_id)
+
+    def _bggCascade(self, name):
+        '''Walk through the ways of finding name at BGG. Returns (game, step) where step
+        describes what found the game, or (None, None).'''
+        variants, name = self._nameVariants(name)
+        if self._probePool:
+            # Ask for all the variants at once and take the first, in order of preference,
+            # that was found. Probes still running when we return finish in the background.
+            probe = profiler.bind(self._probe)
+            results = [self._probePool.apply_async(probe, variant) for variant in variants]
+            for (step, vname, game_id), result in zip(variants, results):
+                game = result.get()
                 if game:
-                    return game
+                    log.debug(u'found {} by {}'.format(vname or game_id, step))
+                    return game, step
+        else:
+            for step, vname, game_id in variants:
+                log.debug(u'trying {}: {}'.format(step, vname or game_id))
+                game = self._probe(step, vname, game_id)
+                if game:
+                    return game, step
+
+        # BGG does not know any spelling of it. The closest name in the local index, if
+        # there is one close enough, saves searching.
+        if self._nameIndex:
+            with profiler.span(u'name index fuzzy'):
+                game_id = self._nameIndex.lookup(name)
+                game = self._bgg.game(None, game_id=game_id) if game_id else None
+            if game:
+                return game, u'name index fuzzy'
 
         # well OK - let's pull out the heavy guns and use the search API.
         # this will give us a bunch of things to sort through, but hopefully
         # find something.
-        return self._bggSearchGame(name)
+        with profiler.span(u'search'):
+            game = self._bggSearchGame(name)
+        return game, u'search' if game else None
 
     def _bggSearchGame(self, name):
         '''Use the much wider search API to find the game.'''
@@ -111,51 +279,56 @@ class CommentHandler(object):
             return None
 
         # assume most owned is what people want. Is this good? Dunno.
-        most_owned = None
-        for i in items:
-            game = self._bgg.game(None, game_id=i.id)
-            # GTL the lib throws an uncaught exception if BGG assessed too quickly.
-            # GTL - this needs to be fixed in the library.
-            sleep(1)
-            if getattr(game, 'expansion', False):
-                log.debug('ignoring expansion')
-                continue
-            else:
-                if not most_owned:
-                    most_owned = game
-                else:
-                    most_owned = game if getattr(game, 'owned', 0) > most_owned.owned else most_owned
-
-        if most_owned:
-            return most_owned
-
-        return None
+        # Fetch all the candidates in a few batched requests rather than one at a time.
+        things = [t for t in self._bgg.things([i.id for i in items]) if not t.expansion]
+        log.debug(u'ignoring {} expansions and unknown ids'.format(len(items) - len(things)))
+        if not things:
+            return None
 
-    def _getInfoResponseBody(self, comment, mode=None):
-        body = comment.body
-        # bolded = re.findall(u'\*\*([^\*]+)\*\*', body)
-        # Now I've got two problems.
-        bolded = re.findall(u'\*\*([\w][\w\.\s:\-?$,!\'–&()\[\]]*[\w\.:\-?$,!\'–&()\[\]])\*\*', body, flags=re.UNICODE)
+        most_owned = max(things, key=lambda t: t.owned)
+        return self._bgg.game(None, game_id=most_owned.id)
+
+    def _lookupGame(self, game_name):
+        '''Look up a single game. Returns (game_name, game, error). This may be run in a
+        worker thread.'''
+        log.info(u'asking BGG for info on {}'.format(game_name))
+        try:
+            with profiler.span(u'lookup'):
+                return game_name, self._bggQueryGame(game_name), False
+        except boardgamegeek.exceptions.BoardGameGeekError as e:
+            log.error(u'Error getting info from BGG on {}: {}'.format(game_name, e))
+            return game_name, None, True
+
+    def _getInfoResponseBody(self, comment, mode=None, onPartial=None, names=None):
+        '''Look up the games bolded in comment. Returns (response, mode, games, not_found)
+        where response is the reply text, or None if there is nothing to reply, and mode
+        is the requested mode. If the bot makes progressive replies and the lookups are not
+        done by the deadline, onPartial is called with a reply listing the games found so
+        far. If names is given only those are looked up and the names not found are left
+        out of the reply.'''
+        with profiler.span(u'parse'):
+            parsed = parse(comment, self._botname)
+            bolded = list(names) if names is not None else parsed.gameNames()
         if not bolded:
             log.warn(u'Got getinfo command, but nothing is bolded. Ignoring comment.')
-            log.debug(u'comment was: {}'.format(body))
-            return
-
-        # convert aliases to real names. It may be better to do this after we don't find the
-        # game. Oh, well.
-        for i in xrange(len(bolded)):
-            real_name = self._botdb.get_name_from_alias(bolded[i])
-            if real_name:
-                bolded[i] = real_name
-
-        # filter out dups.
-        bolded = list(set(bolded))
-        bolded = [unquote(b) for b in bolded]
-
-        games = []
-        not_found = []
-
-        if comment.subreddit.display_name.lower() == u'boardgamescirclejerk':
+            log.debug(u'comment was: {}'.format(comment.body))
+            return None, mode, [], []
+
+        with profiler.span(u'alias lookup'):
+            # convert aliases to real names. It may be better to do this after we don't find
+            # the game. Oh, well.
+            for i in xrange(len(bolded)):
+                real_name = self._botdb.get_name_from_alias(bolded[i])
+                if real_name:
+                    bolded[i] = real_name
+
+            # filter out dups.
+            bolded = list(set(bolded))
+            bolded = [unquote(b) for b in bolded]
+
+        circlejerk = names is None and \
+            comment.subreddit.display_name.lower() == u'boardgamescirclejerk'
+        if circlejerk:
             cjgames = [
                 [u'Dead of Winter: A Crossroads Game'],
                 [u'Scythe']
@@ -163,34 +336,95 @@ class CommentHandler(object):
             bolded = choice(cjgames)
             bolded = ['Scythe', 'Scythe', 'Scythe']
 
-        seen = set()
-        for game_name in bolded:
-            log.info(u'asking BGG for info on {}'.format(game_name))
+        # get the mode if given. Can be short or long or normal. Default is normal.
+        mode = mode if mode else parsed.mode(u'getinfo')
+        mode = mode if mode else u'normal'
+
+        if self._progressDeadline and onPartial:
+            results = self._lookupGamesProgressively(bolded, comment.id, mode, circlejerk, onPartial)
+        elif self._pool and len(bolded) > 1:
+            results = self._pool.map(profiler.bind(self._lookupGame), bolded)
+        else:
+            results = [self._lookupGame(game_name) for game_name in bolded]
+
+        games, not_found = self._collectGames(results)
+
+        # the request history decides which games are kept warm in the BGG cache.
+        self._botdb.add_game_requests([g.id for g in games])
+
+        log.debug(u'resolution cache hits: {}, misses: {}'.format(
+            self._botdb.resolution_hits, self._botdb.resolution_misses))
+
+        if circlejerk or names is not None:
+            not_found = []
+
+        with profiler.span(u'render'):
+            response = self._renderResponse(comment.id, games, not_found, mode)
+        return response, mode, games, not_found
+
+    def _lookupGamesProgressively(self, bolded, comment_id, mode, circlejerk, onPartial):
+        '''Look up bolded in the background. If that takes longer than the progress deadline
+        call onPartial with a reply listing what has been found so far. Returns the
+        _lookupGame results once all are in.'''
+        results = [None] * len(bolded)
+        finished = threading.Event()
+
+        def lookupAll():
             try:
-                # game = self._bgg.game(game_name)
-                game = self._bggQueryGame(game_name)
-                if game:
-                    if game.name not in seen:
-                        games.append(game)
-                    # don't add dups. This can happen when the same game is calledby two valid
-                    # names in a post.
-                    seen.add(game.name)
+                if self._pool:
+                    lookup = profiler.bind(lambda (i, name): (i, self._lookupGame(name)))
+                    for i, result in self._pool.imap_unordered(lookup, enumerate(bolded)):
+                        results[i] = result
                 else:
-                    not_found.append(game_name)
-
-            except boardgamegeek.exceptions.BoardGameGeekError as e:
-                log.error(u'Error getting info from BGG on {}: {}'.format(game_name, e))
+                    for i, name in enumerate(bolded):
+                        results[i] = self._lookupGame(name)
+            finally:
+                finished.set()
+
+        t = threading.Thread(target=profiler.bind(lookupAll), name=u'lookup-{}'.format(comment_id))
+        t.daemon = True
+        t.start()
+
+        if not finished.wait(self._progressDeadline):
+            done = [r for r in results if r]
+            waiting = len(results) - len(done)
+            log.info(u'Still looking for {} games after {} seconds, sending what was found.'.format(
+                waiting, self._progressDeadline))
+            games, not_found = self._collectGames(done)
+            partial = self._renderResponse(comment_id, games, [] if circlejerk else not_found, mode)
+            onPartial((partial if partial else self._header) + self._stillLooking.format(waiting))
+            finished.wait()
+
+        return [r for r in results if r]
+
+    def _collectGames(self, results):
+        '''Turn _lookupGame results into (games, not found names).'''
+        games = []
+        not_found = []
+        seen = set()
+        for game_name, game, error in results:
+            if error:
                 continue
 
+            if game:
+                if game.name not in seen:
+                    games.append(game)
+                # don't add dups. This can happen when the same game is calledby two valid
+                # names in a post.
+                seen.add(game.name)
+            else:
+                not_found.append(game_name)
+
+        return games, not_found
+
+    def _renderResponse(self, comment_id, games, not_found, mode):
+        '''Return the reply listing games and not_found names in the given mode, or None if
+        there is nothing to say.'''
         # sort by game name because why not?
         games = sorted(games, key=lambda g: g.name)
 
         # we now have all the games.
         mode = u'short' if len(games) > 6 else mode
-        # not_found = list(set(bolded) - set([game.name for game in games]))
-
-        if comment.subreddit.display_name.lower() == u'boardgamescirclejerk':
-            not_found = None
 
         if not_found:
             log.debug(u'not found: {}'.format(u', '.join(not_found)))
@@ -199,15 +433,9 @@ class CommentHandler(object):
             log.debug(u'Found games {}'.format(u','.join([u'{} ({})'.format(
                 g.name, g.year) for g in games])))
         else:
-            log.warn(u'Found no games in comment {}'.format(comment.id))
+            log.warn(u'Found no games in comment {}'.format(comment_id))
 
         # get the information for each game in a nice tidy list of strings.
-        # get the mode if given. Can be short or long or normal. Default is normal.
-        if not mode:
-            m = re.search(u'getinfo\s(\w+)', body, flags=re.IGNORECASE)
-            if m:
-                mode = m.group(1).lower() if m.group(1).lower() in [u'short', u'long'] else mode
-
         if mode == u'short':
             infos = self._getShortInfos(games)
         elif mode == u'long':
@@ -246,99 +474,134 @@ class CommentHandler(object):
             log.info("Ignoring comment by {}".format(comment.author.name))
             return
 
-        response = self._getInfoResponseBody(comment, mode)
+        target = replyTo if replyTo else comment
+        partial = []
+        response, mode, games, not_found = self._getInfoResponseBody(
+            comment, mode, lambda text: partial.append(self._reply(target, text)))
+        if not response and partial and partial[0]:
+            # the partial reply promises more, so it is replaced whatever happened.
+            response = self._header + self._noBGG
         if response:
-            if replyTo:
-                replyTo.reply(response)
+            # the record is kept so a repair only has to look up the names it fixes.
+            record = (mode, [g.id for g in games], not_found)
+            if partial and partial[0]:
+                self._edit(partial[0], response, record)
             else:
-                comment.reply(response)
+                self._reply(target, response, record)
             log.info(u'Replied to info request for comment {}'.format(comment.id))
         else:
             log.warn(u'Did not find anything to reply to in comment'.format(comment.id))
 
+    def streamInfo(self, comment, names):
+        '''Reply to a comment that bolds the known game names names without asking the bot,
+        as found by the StreamScanner. Names BGG does not know are left out, as nobody asked
+        about them. Returns True if it replied.'''
+        response, mode, games, not_found = self._getInfoResponseBody(comment, names=names)
+        if not games:
+            log.debug(u'Found no games to reply with in stream comment {}'.format(comment.id))
+            return False
+
+        self._reply(comment, response, (mode, [g.id for g in games], not_found))
+        log.info(u'Replied to stream comment {} in {}'.format(comment.id, comment.subreddit.display_name))
+        return True
+
+    def _renderInfo(self, game, mode):
+        '''Return the markdown for a single game in the given mode. Rendered text is kept in
+        the render cache until the game is fetched from BGG again.'''
+        key = (game.id, game.fetched, mode, self._renderGeneration)
+        info = self._renderCache.get(key)
+        if info is None:
+            info = self._renderers[mode](game)
+            self._renderCache.put(key, info)
+
+        return info
+
+    def clearRenderCache(self):
+        '''Forget all rendered game info, say after changing how games are rendered.'''
+        self._renderGeneration += 1
+        self._renderCache.clear()
+
     def _getShortInfos(self, games):
-        infos = list()
-        for game in games:
-            players = self._getPlayers(game)
-            info = (u' * [**{}**](http://boardgamegeek.com/boardgame/{}) '
-                    u' ({}) by {}. '.format(
-                        game.name, game.id, game.year, u', '.join(getattr(game, u'designers', u'Unknown'))))
-            if players:
-                info += '{}; '.format(players)
-            if game.playing_time and int(game.playing_time) != 0:
-                info += '{} mins '.format(game.playing_time)
-
-            infos.append(info)
+        return [self._renderInfo(game, u'short') for game in games]
 
-        return infos
+    def _getShortInfo(self, game):
+        players = self._getPlayers(game)
+        info = (u' * [**{}**](http://boardgamegeek.com/boardgame/{}) '
+                u' ({}) by {}. '.format(
+                    game.name, game.id, game.year, u', '.join(getattr(game, u'designers', u'Unknown'))))
+        if players:
+            info += '{}; '.format(players)
+        if game.playing_time and int(game.playing_time) != 0:
+            info += '{} mins '.format(game.playing_time)
+
+        return info
 
     def _getStdInfos(self, games):
-        infos = list()
-        for game in games:
-            players = self._getPlayers(game)
-            info = (u'[**{}**](http://boardgamegeek.com/boardgame/{}) '
-                    u' ({}) by {}. {}; '.format(
-                        game.name, game.id, game.year, u', '.join(getattr(game, u'designers', u'Unknown')),
-                        players))
-
-            if game.playing_time and int(game.playing_time) != 0:
-                info += '{} minutes; '.format(game.playing_time)
-
-            if game.image:
-                info += '[img]({}) '.format(game.image)
-
-            info += '\n\n'
-
-            data = u', '.join(getattr(game, u'mechanics', u''))
-            if data:
-                info += u' * Mechanics: {}\n'.format(data)
-            people = u'people' if game.users_rated > 1 else u'person'
-            info += u' * Average rating is {}; rated by {} {}. Weight: {}\n'.format(
-                game.rating_average, game.users_rated, people, game.rating_average_weight)
-            data = u', '.join([u'{}: {}'.format(r[u'friendlyname'], r[u'value']) for r in game.ranks])
-            info += u' * {}\n\n'.format(data)
-
-            log.debug(u'adding info: {}'.format(info))
-            infos.append(info)
+        return [self._renderInfo(game, u'normal') for game in games]
 
-        return infos
+    def _getStdInfo(self, game):
+        players = self._getPlayers(game)
+        info = (u'[**{}**](http://boardgamegeek.com/boardgame/{}) '
+                u' ({}) by {}. {}; '.format(
+                    game.name, game.id, game.year, u', '.join(getattr(game, u'designers', u'Unknown')),
+                    players))
+
+        if game.playing_time and int(game.playing_time) != 0:
+            info += '{} minutes; '.format(game.playing_time)
+
+        if game.image:
+            info += '[img]({}) '.format(game.image)
+
+        info += '\n\n'
+
+        data = u', '.join(getattr(game, u'mechanics', u''))
+        if data:
+            info += u' * Mechanics: {}\n'.format(data)
+        people = u'people' if game.users_rated > 1 else u'person'
+        info += u' * Average rating is {}; rated by {} {}. Weight: {}\n'.format(
+            game.rating_average, game.users_rated, people, game.rating_average_weight)
+        data = u', '.join([u'{}: {}'.format(rank, value) for rank, value in game.ranks])
+        info += u' * {}\n\n'.format(data)
+
+        log.debug(u'adding info: {}'.format(info))
+        return info
 
     def _getLongInfos(self, games):
-        infos = list()
-        for game in games:
-            players = self._getPlayers(game)
-            info = (u'Details for [**{}**](http://boardgamegeek.com/boardgame/{}) '
-                    u' ({}) by {}. '.format(
-                        game.name, game.id, game.year, u', '.join(getattr(game, u'designers', u'Unknown'))))
-            if players:
-                info += '{}; '.format(players)
-            if game.playing_time and int(game.playing_time) != 0:
-                info += '{} minutes; '.format(game.playing_time)
-            if game.image:
-                info += '[img]({}) '.format(game.image)
-            info += '\n\n'
-
-            data = u', '.join(getattr(game, u'mechanics', u''))
-            if data:
-                info += u' * Mechanics: {}\n'.format(data)
-            people = u'people' if game.users_rated > 1 else u'person'
-            info += u' * Average rating is {}; rated by {} {}\n'.format(
-                game.rating_average, game.users_rated, people)
-            info += u' * Average Weight: {}; Number of Weights {}\n'.format(
-                game.rating_average_weight, game.rating_num_weights)
-            data = u', '.join([u'{}: {}'.format(r[u'friendlyname'], r[u'value']) for r in game.ranks])
-            info += u' * {}\n\n'.format(data)
-
-            info += u'Description:\n\n{}\n\n'.format(game.description)
-
-            if len(games) > 1:
-                info += u'------'
-
-            log.debug(u'adding info: {}'.format(info))
-            infos.append(info)
+        infos = [self._renderInfo(game, u'long') for game in games]
+        if len(games) > 1:
+            infos = [info + u'------' for info in infos]
 
         return infos
 
+    def _getLongInfo(self, game):
+        players = self._getPlayers(game)
+        info = (u'Details for [**{}**](http://boardgamegeek.com/boardgame/{}) '
+                u' ({}) by {}. '.format(
+                    game.name, game.id, game.year, u', '.join(getattr(game, u'designers', u'Unknown'))))
+        if players:
+            info += '{}; '.format(players)
+        if game.playing_time and int(game.playing_time) != 0:
+            info += '{} minutes; '.format(game.playing_time)
+        if game.image:
+            info += '[img]({}) '.format(game.image)
+        info += '\n\n'
+
+        data = u', '.join(getattr(game, u'mechanics', u''))
+        if data:
+            info += u' * Mechanics: {}\n'.format(data)
+        people = u'people' if game.users_rated > 1 else u'person'
+        info += u' * Average rating is {}; rated by {} {}\n'.format(
+            game.rating_average, game.users_rated, people)
+        info += u' * Average Weight: {}; Number of Weights {}\n'.format(
+            game.rating_average_weight, game.rating_num_weights)
+        data = u', '.join([u'{}: {}'.format(rank, value) for rank, value in game.ranks])
+        info += u' * {}\n\n'.format(data)
+
+        info += u'Description:\n\n{}\n\n'.format(game.description)
+
+        log.debug(u'adding info: {}'.format(info))
+        return info
+
     def repairComment(self, comment):
         '''Look for maps from missed game names to actual game names. If
         found repair orginal comment.'''
@@ -346,10 +609,9 @@ class CommentHandler(object):
             log.info("Ignoring comment by {}".format(comment.author.name))
             return
         #
-        # The repair is done by replacing the new games names with the old (wrong)
-        # games names in the original /u/r2d8 response, then recreating the entire
-        # post by regenerating it with the new (fixed) bolded game names. The just replacing
-        # the orginal response with the new one.
+        # The bot keeps the mode, games and not found names of each reply it makes. The
+        # repair looks up only the repaired names, swaps them in and renders the reply again.
+        # Replies made before that was kept are repaired from their text, see _repairFromBody.
         #
         log.debug(u'Got repair response, id {}'.format(comment.id))
 
@@ -365,9 +627,47 @@ class CommentHandler(object):
 
         # Look for patterns of **something**=**somethingelse**. This line creates a dict
         # of something: somethingelse for each one pattern found.
-        repairs = {match[0]: match[1] for match in re.findall(
-            u'\*\*([^\*]+)\*\*=\*\*([^\*]+)\*\*', comment.body)}
+        repairs = dict(parse(comment, self._botname).pairs)
+
+        stored = self._botdb.get_reply(parent.id)
+        if not stored:
+            log.info(u'No record of reply {}, repairing from its text.'.format(parent.id))
+            self._repairFromBody(parent, repairs)
+            return
 
+        # Only the repaired names are looked up. Everything else comes from what was
+        # stored when the reply was made.
+        mode, game_ids, not_found = stored
+        games = [g for g in [self._bgg.game(None, game_id=i) for i in game_ids] if g]
+        for wrongName, repairedName in repairs.iteritems():
+            log.info(u'Repairing {} --> {}'.format(wrongName, repairedName))
+            alias = self._botdb.get_name_from_alias(repairedName)
+            tmp_name = alias if alias else repairedName
+            tmp_game = self._bggQueryGame(tmp_name)
+            if not tmp_game:
+                log.info(u'{} seems to not be a game name according to BGG, ignoring.'.format(tmp_name))
+                continue
+
+            self._botdb.remove_not_found(wrongName)
+            not_found = [n for n in not_found if n != wrongName]
+            # wrongName may also have been found, but as the wrong game.
+            games = [g for g in games if g.name.lower() != wrongName.lower()]
+            if tmp_game.id not in [g.id for g in games]:
+                games.append(tmp_game)
+
+        new_reply = self._renderResponse(parent.id, games, not_found, mode)
+        log.debug(u'Replacing bot comment {} with: {}'.format(parent.id, new_reply))
+        self._edit(parent, new_reply, (mode, [g.id for g in games], not_found))
+
+    def _repairFromBody(self, parent, repairs):
+        '''Repair a reply the bot has no record of, made before replies were stored, by
+        rewriting its text as a getinfo request and running that.'''
+        #
+        # The repair is done by replacing the new games names with the old (wrong)
+        # games names in the original /u/r2d8 response, then recreating the entire
+        # post by regenerating it with the new (fixed) bolded game names. The just replacing
+        # the orginal response with the new one.
+        #
         pbody = parent.body
         for wrongName, repairedName in repairs.iteritems():
             # check to see if it's actually a game.
@@ -376,6 +676,7 @@ class CommentHandler(object):
             tmp_name = alias if alias else repairedName
             tmp_game = self._bggQueryGame(tmp_name)  # with caching it's ok to check twice
             if tmp_game:
+                self._botdb.remove_not_found(wrongName)
                 # In the parent body we want to replace [NAME](http://... with **NAME**(http://
                 pbody = pbody.replace(u'[' + wrongName + u']', u'**' + tmp_name + u'**')
             else:
@@ -400,14 +701,14 @@ class CommentHandler(object):
             pbody += u' /u/{} getinfo'.format(self._botname)
 
         parent = parent.edit(pbody)
-        new_reply = self._getInfoResponseBody(parent)
+        new_reply, mode, games, not_found = self._getInfoResponseBody(parent)
 
         # should check for Editiable class somehow here. GTL
         log.debug(u'Replacing bot comment {} with: {}'.format(parent.id, new_reply))
-        parent.edit(new_reply)
+        self._edit(parent, new_reply, (mode, [g.id for g in games], not_found))
 
     def xyzzy(self, comment):
-        comment.reply(u'Nothing happens.')
+        self._reply(comment, u'Nothing happens.')
 
     def getParentInfo(self, comment):
         '''Allows others to call the bot to getInfo for parent posts.'''
@@ -422,10 +723,8 @@ class CommentHandler(object):
             log.info(u'Got a repair comment as root, ignoring.')
             return
 
-        m = re.search(u'getparentinfo\s(\w+)', comment.body, re.IGNORECASE)
-        mode = None
-        if m:
-            mode = u'short' if m.group(1).lower() == u'short' else u'long'
+        # any word after the command but short asks for long info.
+        mode = parse(comment, self._botname).mode(u'getparentinfo', other=u'long')
 
         parent = comment.reddit_session.get_info(thing_id=comment.parent_id)
         self.getInfo(parent, comment, mode)
@@ -438,13 +737,13 @@ class CommentHandler(object):
             return
 
         response = u'executing alias command.\n\n'
-        for match in re.findall(u'\*\*([^\*]+)\*\*=\*\*([^\*]+)\*\*', comment.body):
+        for match in parse(comment, self._botname).pairs:
             mess = u'Adding alias to database: "{}" = "{}"'.format(match[0], match[1])
             log.info(mess)
             response += mess + u'\n\n'
             self._botdb.add_alias(match[0], match[1])
 
-        comment.reply(response)
+        self._reply(comment, response)
 
     def getaliases(self, comment):
         if self._botdb.ignore_user(comment.author.name):
@@ -457,4 +756,43 @@ class CommentHandler(object):
             response += u' * {} = {}\n'.format(alias, name)
 
         log.info(u'Responding to getalaises request with {} aliases'.format(len(aliases)))
-        comment.reply(response)
+        self._reply(comment, response)
+
+    def cachestats(self, comment):
+        '''Reply with the size, hit rate and age of the BGG cache. Admins only.'''
+        if not self._botdb.is_admin(comment.author.name):
+            log.info(u'got cachestats command from non admin {}, ignoring.'.format(
+                comment.author.name))
+            return
+
+        stats = self._bgg.cacheStats(fresh=True)
+        if stats is None:
+            self._reply(comment, u'The BGG cache is not managed.')
+            return
+
+        response = u'BGG cache:\n\n'
+        for line in report(stats):
+            response += u' * {}\n'.format(line)
+        response += u' * Since start: {} hits, {} misses\n'.format(stats[u'hits'], stats[u'misses'])
+        self._reply(comment, response)
+
+    def profile(self, comment):
+        '''Profile the next N commands, N being the word after the command, and reply with
+        the spans that took the most time. Admins only.'''
+        if not self._botdb.is_admin(comment.author.name):
+            log.info(u'got profile command from non admin {}, ignoring.'.format(
+                comment.author.name))
+            return
+
+        arg = next((a for c, a in parse(comment, self._botname).commands if c == u'profile'), None)
+        count = min(int(arg), 1000) if arg and arg.isdigit() and int(arg) else 20
+        if not profiler.start(count, onDone=lambda summary: self._reply(comment, self._fit(summary))):
+            self._reply(comment, u'Already profiling. Try again once that is done.')
+
+    def _fit(self, text, limit=10000):
+        '''text cut at a line to fit in a Reddit comment, which holds limit characters.'''
+        if len(text) <= limit:
+            return text
+
+        note = u'\n\n*Cut short. The rest is in the log.*'
+        return text[:limit - len(note)].rsplit(u'\n', 1)[0] + note
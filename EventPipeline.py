@@ -0,0 +1,176 @@
+import logging
+import threading
+from collections import deque
+from Queue import Queue, Empty
+from time import time
+
+from BotPipeline import BotPipeline
+from CommandParser import parse
+from Profiler import profiler
+
+log = logging.getLogger(__name__)
+
+
+class EventPipeline(BotPipeline):
+    '''Runs the bot as an event loop instead of a pool of command workers. One thread owns
+    the loop: it starts inbox polls, starts a command for each new comment while fewer
+    than concurrency are in flight, and records each comment once its command is done.
+    Everything that blocks on the network, the poll and the commands with their BGG
+    lookups and replies, runs off the loop in a thread of its own and reports back
+    through an event queue, so a slow poll never holds up dispatch and the number of
+    commands in flight is set by concurrency alone.
+
+    Comments are handled by the same CommentHandler commands as in BotPipeline. New
+    comments wait in a backlog while concurrency commands are running, and the inbox is
+    not polled while the backlog holds concurrency or more.'''
+    def __init__(self, reddit, botdb, botname, cmdmap, concurrency=16, timeout=300,
+                 poller=None, replyQueue=None):
+        super(EventPipeline, self).__init__(reddit, botdb, botname, cmdmap, workers=0,
+                                            timeout=timeout, poller=poller, replyQueue=replyQueue)
+        self._concurrency = concurrency
+        self._events = Queue()
+        self._backlog = deque()
+        # comment id --> (comment, time started).
+        self._running = {}
+        # ids of running comments given up on by _expire(). They keep their place in
+        # _running, and so against concurrency, until their thread is done.
+        self._overdue = set()
+        self._polling = False
+        self._nextPoll = 0
+
+    def _gauges(self):
+        return {u'queue_depth': len(self._backlog), u'pending_comments': len(self._pending),
+                u'commands_in_flight': len(self._running),
+                u'poll_interval_seconds': self._poller.interval}
+
+    def _spawn(self, target, name, *args):
+        t = threading.Thread(target=target, args=args, name=name)
+        t.daemon = True
+        t.start()
+
+    def run(self):
+        '''Run until stop() is called.'''
+        while not self._stop.is_set():
+            canPoll = not self._polling and len(self._backlog) < self._concurrency
+            if canPoll and time() >= self._nextPoll:
+                self._polling = True
+                self._spawn(self._poll, u'inbox-poll')
+
+            while self._backlog and len(self._running) < self._concurrency:
+                self._start(self._backlog.popleft())
+
+            self._expire()
+            # wake for the next event or poll, and at least every second to check timeouts.
+            wait = self._nextPoll - time() if canPoll and not self._polling else 1
+            try:
+                self._dispatch(self._events.get(timeout=min(1, max(0.01, wait))))
+                while True:
+                    self._dispatch(self._events.get_nowait())
+            except Empty:
+                pass
+
+            if time() - self._lastPrune > 3600:
+                self._lastPrune = time()
+                try:
+                    self._botdb.prune_comments()
+                except Exception as e:
+                    log.error(u'Caught exception pruning comments: {}'.format(e))
+
+        # commands in flight are finished, the backlog is left for the next start.
+        deadline = time() + self._timeout
+        while len(self._running) > len(self._overdue) and time() < deadline:
+            try:
+                self._dispatch(self._events.get(timeout=0.1))
+            except Empty:
+                pass
+
+        self._botdb.commit()
+        if self._replies:
+            self._replies.close(self._timeout)
+        log.info(u'Stopped with {} comments left unhandled. They will be handled on the '
+                 u'next start.'.format(len(self._pending) - len(self._running) + len(self._overdue)))
+
+    def _dispatch(self, event):
+        kind, value = event
+        try:
+            if kind == u'polled':
+                self._polled(*value)
+            elif kind == u'done':
+                self._done(*value)
+        except Exception as e:
+            # a locked database or a Reddit error must not end the loop.
+            log.error(u'Caught exception handling {} event: {}'.format(kind, e))
+
+    def _poll(self):
+        start = time()
+        try:
+            comments = self._poller.poll()
+        except Exception as e:
+            log.error(u'Caught exception: {}'.format(e))
+            comments = []
+        self._events.put((u'polled', (comments, time() - start)))
+
+    def _polled(self, comments, took):
+        self._polling = False
+        self._nextPoll = time() + self._poller.interval
+        for comment in comments:
+            if profiler.active:
+                self._fetched[comment.id] = (took, time())
+            self._pending.add(comment.id)
+            self._backlog.append(comment)
+
+        # one commit for all the comments recorded since the last poll.
+        self._botdb.commit()
+        # pick up aliases, admins and ignored users added by other bot processes.
+        self._botdb.refresh()
+
+    def _start(self, comment):
+        self._running[comment.id] = (comment, time())
+        self._spawn(self._command, u'command-{}'.format(comment.id), comment)
+
+    def _command(self, comment):
+        # if the claim fails the comment is offered again on a later poll.
+        claimed = False
+        try:
+            start = time()
+            fetched = self._fetched.pop(comment.id, None)
+            claimed = self._botdb.claim_comment(comment)
+            if claimed:
+                before = ()
+                if profiler.active:
+                    before = [(u'dedup', time() - start)]
+                    if fetched:
+                        before += [(u'inbox fetch', fetched[0]), (u'queue wait', start - fetched[1])]
+
+                comment.body = self._hp.unescape(comment.body)
+                for cmd, arg in parse(comment, self._botname).commands:
+                    if cmd not in self._cmdmap:
+                        log.info(u'Got unknown command: {}'.format(cmd))
+                        continue
+                    self._runCommand(cmd, comment, before)
+        except Exception as e:
+            log.error(u'Caught exception handling {}: {}'.format(comment.id, e))
+        finally:
+            self._events.put((u'done', (comment, claimed)))
+
+    def _done(self, comment, claimed):
+        self._running.pop(comment.id, None)
+        self._overdue.discard(comment.id)
+        self._pending.discard(comment.id)
+        if not claimed:
+            log.debug(u'Comment {} is claimed by another worker.'.format(comment.id))
+            self._poller.forget(comment)
+            return
+
+        self._record(comment)
+
+    def _expire(self):
+        now = time()
+        for cid, (comment, started) in self._running.items():
+            if cid not in self._overdue and now - started > self._timeout:
+                # There is no killing a thread. Leave it to finish on its own, and the
+                # comment unrecorded until it does: it may never be replied to. If the
+                # bot stops first the comment is handled again on the next start.
+                log.error(u'Comment {} took more than {} seconds. Giving up waiting for '
+                          u'it.'.format(cid, self._timeout))
+                self._overdue.add(cid)
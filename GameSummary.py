@@ -0,0 +1,109 @@
+import json
+import logging
+import sqlite3
+import threading
+from time import time
+
+log = logging.getLogger(__name__)
+
+
+class GameSummary(object):
+    '''The parts of a BGG game the bot uses, built once from a boardgamegeek game. ranks is
+    a tuple of (friendly name, rank) pairs. The description, which is only needed in long
+    mode and is by far the biggest part, can be left out and loaded on first use by
+    descriptionLoader, which is called with the game id. fetched is when the game was
+    fetched from BGG, if known.'''
+    FIELDS = (u'id', u'name', u'year', u'designers', u'min_players', u'max_players',
+              u'playing_time', u'image', u'mechanics', u'rating_average', u'users_rated',
+              u'rating_average_weight', u'rating_num_weights', u'ranks')
+
+    __slots__ = FIELDS + (u'fetched', u'_description', u'_descriptionLoader')
+
+    def __init__(self, description=None, descriptionLoader=None, fetched=None, **fields):
+        for f in self.FIELDS:
+            setattr(self, f, fields.get(f))
+        self.fetched = fetched
+        self._description = description
+        self._descriptionLoader = descriptionLoader
+
+    @classmethod
+    def fromGame(cls, game, keepDescription=True, descriptionLoader=None, fetched=None):
+        fields = {f: getattr(game, f, None) for f in cls.FIELDS}
+        fields[u'id'] = int(game.id)
+        fields[u'designers'] = tuple(game.designers or [])
+        fields[u'mechanics'] = tuple(game.mechanics or [])
+        fields[u'ranks'] = tuple((r[u'friendlyname'], r[u'value']) for r in game.ranks or [])
+        return cls(description=game.description if keepDescription else None,
+                   descriptionLoader=descriptionLoader, fetched=fetched, **fields)
+
+    @property
+    def description(self):
+        if self._description is None and self._descriptionLoader:
+            self._description = self._descriptionLoader(self.id)
+        return self._description
+
+    def toJSON(self):
+        '''The summary, without the description, as a JSON string.'''
+        return json.dumps([getattr(self, f) for f in self.FIELDS])
+
+    @classmethod
+    def fromJSON(cls, data, descriptionLoader=None, fetched=None):
+        values = json.loads(data)
+        fields = dict(zip(cls.FIELDS, values))
+        for f in [u'designers', u'mechanics']:
+            fields[f] = tuple(fields[f])
+        fields[u'ranks'] = tuple(tuple(r) for r in fields[u'ranks'])
+        return cls(descriptionLoader=descriptionLoader, fetched=fetched, **fields)
+
+
+class GameStore(object):
+    '''Keeps GameSummarys by game id in a sqlite table, with the time they were fetched
+    from BGG. Descriptions are kept in their own column and only read when asked for. The
+    game each name was last found as is kept too. Several processes may share the one
+    store.'''
+    def __init__(self, path):
+        super(GameStore, self).__init__()
+        # wait for writes by other processes rather than fail.
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute(u'PRAGMA journal_mode=WAL')
+            self._connection.execute(u'CREATE TABLE IF NOT EXISTS games (id integer PRIMARY KEY, '
+                                     u'fetched real, summary text, description text)')
+            self._connection.execute(u'CREATE TABLE IF NOT EXISTS names (name text PRIMARY KEY, '
+                                     u'id integer)')
+            self._connection.commit()
+
+    def get(self, game_id):
+        '''Return (summary, time fetched) or None.'''
+        with self._lock:
+            row = self._connection.execute(u'SELECT summary, fetched FROM games WHERE id=?',
+                                           (game_id,)).fetchone()
+        if not row:
+            return None
+
+        summary = GameSummary.fromJSON(row[0], descriptionLoader=self.description, fetched=row[1])
+        return summary, row[1]
+
+    def getByName(self, name):
+        '''Return (summary, time fetched) for the game name was last found as, or None.'''
+        with self._lock:
+            row = self._connection.execute(u'SELECT id FROM names WHERE name=?', (name,)).fetchone()
+        return self.get(row[0]) if row else None
+
+    def description(self, game_id):
+        with self._lock:
+            row = self._connection.execute(u'SELECT description FROM games WHERE id=?',
+                                           (game_id,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, summary, description, fetched=None, name=None):
+        '''Keep summary, and that it was found by name if given.'''
+        with self._lock:
+            self._connection.execute(u'INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?)',
+                                     (summary.id, fetched if fetched else time(), summary.toJSON(),
+                                      description))
+            if name:
+                self._connection.execute(u'INSERT OR REPLACE INTO names VALUES (?, ?)',
+                                         (name, summary.id))
+            self._connection.commit()
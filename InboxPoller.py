@@ -0,0 +1,82 @@
+import logging
+from time import time
+
+from LRUCache import LRUCache
+
+log = logging.getLogger(__name__)
+
+# default seconds between polls while busy, and at most while idle.
+MIN_INTERVAL = 2
+MAX_INTERVAL = 30
+
+
+class InboxPoller(object):
+    '''Fetches new mentions and unread items from the inbox. Known ids are remembered in
+    memory so most of them never reach the bot database, and paging through mentions stops
+    at the first known one. The time to wait between polls shrinks to minInterval when
+    there is something new and backs off towards maxInterval when there is not. Known
+    items that are still unread, say because the bot stopped before marking them, are
+    passed to markRead if it is given.
+
+    Items older than the bot database's comment retention are taken as known, since
+    whether they were handled has been forgotten. They are never answered.'''
+    def __init__(self, reddit, botdb, minInterval=MIN_INTERVAL, maxInterval=MAX_INTERVAL,
+                 backoff=1.5, limit=100, seenSize=10000, markRead=None):
+        super(InboxPoller, self).__init__()
+        self._reddit = reddit
+        self._botdb = botdb
+        self._minInterval = minInterval
+        self._maxInterval = maxInterval
+        self._backoff = backoff
+        self._limit = limit
+        self._seen = LRUCache(seenSize)
+        self._markRead = markRead
+        self.interval = minInterval
+
+    def _known(self, comment):
+        if comment.id in self._seen:
+            return True
+
+        if self._botdb.comment_exists(comment) or self._tooOld(comment):
+            self._seen.put(comment.id, True)
+            return True
+
+        return False
+
+    def _tooOld(self, comment):
+        retention = self._botdb.comment_retention
+        return bool(retention) and comment.created_utc < time() - retention
+
+    def forget(self, comment):
+        '''Offer comment again on later polls, unless the bot database says it is handled.
+        For comments another bot process has claimed, in case it never handles them.'''
+        self._seen.pop(comment.id)
+
+    def poll(self):
+        '''Return the comments not seen before. Each is returned only once.'''
+        new = []
+        # Mentions come newest first and are kept whether read or not, so the first known
+        # one means everything after it has been seen. Anything older that was not handled
+        # is still unread and so is found below.
+        for comment in self._reddit.get_mentions(limit=self._limit):
+            if self._known(comment):
+                break
+            new.append(comment)
+            self._seen.put(comment.id, True)
+
+        # The unread list is short, but it holds more than mentions, so look at all of it.
+        for comment in self._reddit.get_unread(limit=self._limit):
+            if not self._known(comment):
+                new.append(comment)
+                self._seen.put(comment.id, True)
+            elif self._markRead and (self._botdb.comment_exists(comment) or self._tooOld(comment)):
+                # handled or too old to answer, not just queued.
+                self._markRead(comment)
+
+        if new:
+            self.interval = self._minInterval
+        else:
+            self.interval = min(self._maxInterval, self.interval * self._backoff)
+
+        log.debug(u'Got {} new items. Next poll in {:.1f} seconds.'.format(len(new), self.interval))
+        return new
@@ -0,0 +1,54 @@
+import threading
+from collections import OrderedDict
+from time import time
+
+
+class LRUCache(object):
+    '''A small thread safe least recently used cache. If ttl is given, entries older than
+    ttl seconds are treated as missing.'''
+    def __init__(self, maxsize, ttl=None):
+        super(LRUCache, self).__init__()
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, stamp = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if self._ttl is not None and time() - stamp > self._ttl:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._data[key] = (value, stamp)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time())
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return item[0] if item else default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,188 @@
+import logging
+import re
+import threading
+from bisect import bisect_left
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from time import time
+
+log = logging.getLogger(__name__)
+
+# seconds
+DEFAULT_BUCKETS = [0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+
+def _labelText(labels):
+    if not labels:
+        return u''
+    return u'{' + u','.join([u'{}="{}"'.format(k, unicode(v).replace(u'"', u'\\"'))
+                             for k, v in labels]) + u'}'
+
+
+class _Timer(object):
+    def __init__(self, metrics, name, help, labels):
+        self._metrics = metrics
+        self._name = name
+        self._help = help
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time()
+        return self
+
+    def __exit__(self, *exc):
+        self._metrics.observe(self._name, time() - self._start, help=self._help, **self._labels)
+        return False
+
+
+class Metrics(object):
+    '''Counters, gauges and histograms, rendered in the Prometheus text format. Safe to use
+    from any thread. Gauges can also be collector functions, called at render time, that
+    return a dict of name to value.'''
+    def __init__(self, prefix=u'r2d8_'):
+        super(Metrics, self).__init__()
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._types = {}
+        self._help = {}
+        self._values = {}     # name --> {labels: value}
+        self._buckets = {}    # histogram name --> bucket bounds
+        self._collectors = []
+
+    def _key(self, name, kind, help, labels):
+        if name not in self._types:
+            self._types[name] = kind
+            self._help[name] = help
+            self._values[name] = {}
+        return tuple(sorted(labels.iteritems()))
+
+    def inc(self, name, amount=1, help=u'', **labels):
+        with self._lock:
+            key = self._key(name, u'counter', help, labels)
+            self._values[name][key] = self._values[name].get(key, 0) + amount
+
+    def set(self, name, value, help=u'', **labels):
+        with self._lock:
+            key = self._key(name, u'gauge', help, labels)
+            self._values[name][key] = value
+
+    def observe(self, name, value, help=u'', buckets=DEFAULT_BUCKETS, **labels):
+        with self._lock:
+            key = self._key(name, u'histogram', help, labels)
+            bounds = self._buckets.setdefault(name, buckets)
+            h = self._values[name].get(key)
+            if h is None:
+                h = self._values[name][key] = [[0] * (len(bounds) + 1), 0.0, 0]
+            h[0][bisect_left(bounds, value)] += 1
+            h[1] += value
+            h[2] += 1
+
+    def timer(self, name, help=u'', **labels):
+        '''Context manager observing the time spent in it.'''
+        return _Timer(self, name, help, labels)
+
+    def collect(self, collector):
+        '''Add a function called at render time returning a dict of gauge name to value.'''
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        gauges = {}
+        for collector in self._collectors:
+            try:
+                gauges.update(collector())
+            except Exception as e:
+                log.error(u'Error collecting metrics: {}'.format(e))
+
+        with self._lock:
+            for name in sorted(self._types):
+                full = self._prefix + name
+                if self._help[name]:
+                    lines.append(u'# HELP {} {}'.format(full, self._help[name]))
+                lines.append(u'# TYPE {} {}'.format(full, self._types[name]))
+                for key, value in sorted(self._values[name].iteritems()):
+                    if self._types[name] != u'histogram':
+                        lines.append(u'{}{} {}'.format(full, _labelText(key), value))
+                        continue
+
+                    counts, total, count = value
+                    cumulative = 0
+                    bounds = [unicode(b) for b in self._buckets[name]] + [u'+Inf']
+                    for bound, c in zip(bounds, counts):
+                        cumulative += c
+                        lines.append(u'{}_bucket{} {}'.format(
+                            full, _labelText(key + ((u'le', bound),)), cumulative))
+                    lines.append(u'{}_sum{} {}'.format(full, _labelText(key), total))
+                    lines.append(u'{}_count{} {}'.format(full, _labelText(key), count))
+
+        for name in sorted(gauges):
+            lines.append(u'# TYPE {}{} gauge'.format(self._prefix, name))
+            lines.append(u'{}{} {}'.format(self._prefix, name, gauges[name]))
+
+        return u'\n'.join(lines) + u'\n'
+
+    def serve(self, port, host=u'127.0.0.1'):
+        '''Serve the metrics at http://host:port/metrics from a background thread.'''
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != u'/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header(u'Content-Type', u'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header(u'Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format % args)
+
+        server = HTTPServer((host, port), Handler)
+        t = threading.Thread(target=server.serve_forever, name=u'metrics-server')
+        t.daemon = True
+        t.start()
+        log.info(u'Serving metrics at http://{}:{}/metrics'.format(host, port))
+        return server
+
+    def dumpEvery(self, path, interval):
+        '''Write the metrics to path every interval seconds from a background thread.'''
+        def dump():
+            while True:
+                threading.Event().wait(interval)
+                try:
+                    with open(path, 'w') as fd:
+                        fd.write(self.render().encode('utf-8'))
+                except IOError as e:
+                    log.error(u'Could not write metrics to {}: {}'.format(path, e))
+
+        t = threading.Thread(target=dump, name=u'metrics-dump')
+        t.daemon = True
+        t.start()
+
+
+def flatten(stats, prefix=u''):
+    '''Flatten a nested dict of numbers, as returned by CommentHandler.cacheStats(), into
+    gauge names. Runs of characters not allowed in a metric name become "_". Each pair of
+    FOOhits and FOOmisses also gets a FOOhit_ratio.'''
+    flat = {}
+    for k, v in stats.iteritems():
+        # anything else makes the name, and so the whole page, invalid to Prometheus.
+        name = re.sub(u'[^a-zA-Z0-9_:]+', u'_', u'{}{}'.format(prefix, k))
+        if isinstance(v, dict):
+            flat.update(flatten(v, name + u'_'))
+        elif isinstance(v, (int, long, float)):
+            flat[name] = v
+
+    for name in [n for n in flat if n.endswith(u'hits')]:
+        misses = flat.get(name[:-4] + u'misses')
+        if misses is not None:
+            total = flat[name] + misses
+            flat[name[:-4] + u'hit_ratio'] = flat[name] / float(total) if total else 0.0
+    return flat
+
+
+# The one set of metrics for the bot.
+metrics = Metrics()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+import argparse
+import array
+import csv
+import logging
+import mmap
+import re
+import struct
+from bisect import bisect_left
+from collections import defaultdict
+from zlib import crc32
+
+from argParseLog import addLoggingArgs, handleLoggingArgs
+
+log = logging.getLogger(__name__)
+
+# number of entries in each of the arrays in the .idx file.
+_HEADER = struct.Struct('=IIII')
+
+
+def normalize_title(name):
+    '''Normalize a game title for matching: lower case, "&" is "and", no punctuation,
+    no leading "the" and single spaces.'''
+    name = name.lower().replace(u'&', u' and ')
+    name = re.sub(u'[^\w\s]', u'', name, flags=re.UNICODE)
+    name = re.sub(u'\s+', u' ', name, flags=re.UNICODE).strip()
+    return re.sub(u'^the ', u'', name)
+
+
+def _trigrams(name):
+    padded = u'  {} '.format(name)
+    return set(padded[i:i + 3] for i in xrange(len(padded) - 2))
+
+
+def _key(gram):
+    return crc32(gram.encode('utf-8')) & 0xffffffff
+
+
+def _editDistance(a, b):
+    if len(a) < len(b):
+        a, b = b, a
+
+    previous = range(len(b) + 1)
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+
+    return previous[-1]
+
+
+class NameIndex(object):
+    '''A read only, on disk index of BGG game names and alternate names. It is two files:
+    PREFIX.names, the normalized names in sorted order, which is memory mapped, and
+    PREFIX.idx, a set of flat arrays (name offsets, game ids, weights and trigram postings)
+    that are read in one go. Use build() to create the index from a dump file.'''
+    def __init__(self, prefix, maxCandidates=20, minSimilarity=0.5):
+        super(NameIndex, self).__init__()
+        self._maxCandidates = maxCandidates
+        self._minSimilarity = minSimilarity
+
+        with open(u'{}.idx'.format(prefix), 'rb') as fd:
+            nnames, nkeys, nposts, _ = _HEADER.unpack(fd.read(_HEADER.size))
+            self._offsets = self._readArray(fd, nnames + 1)
+            self._ids = self._readArray(fd, nnames)
+            self._weights = self._readArray(fd, nnames)
+            self._keys = self._readArray(fd, nkeys)
+            self._starts = self._readArray(fd, nkeys + 1)
+            self._postings = self._readArray(fd, nposts)
+
+        self._names = ''
+        if nnames:
+            with open(u'{}.names'.format(prefix), 'rb') as fd:
+                self._names = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+        log.info(u'Loaded name index {} with {} names.'.format(prefix, nnames))
+
+    @staticmethod
+    def _readArray(fd, count):
+        a = array.array('I')
+        a.fromfile(fd, count)
+        return a
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _name(self, i):
+        return self._names[self._offsets[i]:self._offsets[i + 1] - 1]
+
+    def lookup(self, name, fuzzy=True):
+        '''Return the BGG id of the game best matching name, or None if nothing is close. If
+        fuzzy is False only a game whose name is, once normalized, exactly name matches.'''
+        title = normalize_title(name)
+        if not title or not len(self):
+            return None
+
+        i = self._exact(title.encode('utf-8'))
+        if i is not None:
+            log.debug(u'name index: exact match for {}'.format(title))
+            return self._ids[i]
+
+        return self._fuzzy(title) if fuzzy else None
+
+    def contains(self, name):
+        '''Return True if name is, once normalized, exactly the name of a game.'''
+        title = normalize_title(name)
+        return bool(title and len(self)) and self._exact(title.encode('utf-8')) is not None
+
+    def _exact(self, key):
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        # equal names are stored best first.
+        return lo if lo < len(self) and self._name(lo) == key else None
+
+    def _fuzzy(self, title):
+        grams = _trigrams(title)
+        counts = defaultdict(int)
+        for gram in grams:
+            k = _key(gram)
+            j = bisect_left(self._keys, k)
+            if j == len(self._keys) or self._keys[j] != k:
+                continue
+
+            # very common trigrams say little and cost a lot to count.
+            start, end = self._starts[j], self._starts[j + 1]
+            if len(grams) > 3 and end - start > max(1000, len(self) // 10):
+                continue
+
+            for entry in self._postings[start:end]:
+                counts[entry] += 1
+
+        candidates = sorted(counts.iteritems(), key=lambda c: -c[1])[:self._maxCandidates]
+        best = None
+        for entry, shared in candidates:
+            name = self._name(entry).decode('utf-8')
+            similarity = 2.0 * shared / (len(grams) + len(_trigrams(name)))
+            if similarity < self._minSimilarity:
+                continue
+
+            distance = _editDistance(title, name)
+            if distance > max(1, len(title) // 4):
+                continue
+
+            rank = (distance, -self._weights[entry], entry)
+            if not best or rank < best[0]:
+                best = (rank, name, self._ids[entry])
+
+        if best:
+            log.debug(u'name index: fuzzy match {} --> {}'.format(title, best[1]))
+            return best[2]
+
+        return None
+
+    @staticmethod
+    def build(dumpPath, prefix):
+        '''Build an index at prefix from a CSV dump of BGG names. The dump must have a header
+        with at least "id" and "name" columns. A game may appear on several rows, once for
+        each alternate name. Optional columns: "primary" (1 or 0, default 1), "owned" or
+        "usersrated" (used to break ties in favor of popular games) and "is_expansion"
+        (expansions are skipped), which makes BGG's own boardgames_ranks.csv usable as is.'''
+        entries = {}
+        with open(dumpPath, 'rb') as fd:
+            for row in csv.DictReader(fd):
+                if row.get('is_expansion', '0') == '1':
+                    continue
+
+                title = normalize_title(row['name'].decode('utf-8'))
+                if not title:
+                    continue
+
+                game_id = int(row['id'])
+                primary = row.get('primary', '1') != '0'
+                weight = int(row.get('owned') or row.get('usersrated') or 0)
+                key = (title.encode('utf-8'), game_id)
+                entries[key] = max(entries.get(key, (False, 0)), (primary, weight))
+
+        # sort by name, then best first: primary names, then the most popular.
+        entries = sorted(entries.iteritems(), key=lambda e: (e[0][0], not e[1][0], -e[1][1], e[0][1]))
+
+        offsets = array.array('I', [0])
+        ids = array.array('I')
+        weights = array.array('I')
+        postings = defaultdict(list)
+        with open(u'{}.names'.format(prefix), 'wb') as fd:
+            for i, ((name, game_id), (primary, weight)) in enumerate(entries):
+                fd.write(name + '\n')
+                offsets.append(offsets[-1] + len(name) + 1)
+                ids.append(game_id)
+                weights.append(weight)
+                for gram in _trigrams(name.decode('utf-8')):
+                    postings[_key(gram)].append(i)
+
+        keys = array.array('I', sorted(postings))
+        starts = array.array('I', [0])
+        posts = array.array('I')
+        for k in keys:
+            posts.extend(postings[k])
+            starts.append(len(posts))
+
+        with open(u'{}.idx'.format(prefix), 'wb') as fd:
+            fd.write(_HEADER.pack(len(ids), len(keys), len(posts), 0))
+            for a in [offsets, ids, weights, keys, starts, posts]:
+                a.tofile(fd)
+
+        log.info(u'Built name index {} with {} names.'.format(prefix, len(ids)))
+        return len(ids)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description=u'Build the local BGG name index from a CSV dump.')
+    ap.add_argument(u'dump', help=u'The CSV dump of BGG names.')
+    ap.add_argument(u'prefix', help=u'Where to write the index, PREFIX.names and PREFIX.idx.')
+    addLoggingArgs(ap)
+    args = ap.parse_args()
+    handleLoggingArgs(args)
+
+    NameIndex.build(args.dump, args.prefix)
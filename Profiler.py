@@ -0,0 +1,277 @@
+import cProfile
+import json
+import logging
+import pstats
+import threading
+from StringIO import StringIO
+from time import time
+
+log = logging.getLogger(__name__)
+
+
+class _Null(object):
+    '''What span() and command() return while the profiler is off.'''
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _Null()
+
+
+class _Span(object):
+    __slots__ = (u'_trace', u'_name', u'_start')
+
+    def __init__(self, trace, name):
+        self._trace = trace
+        self._name = name
+
+    def __enter__(self):
+        self._start = time()
+        return self
+
+    def __exit__(self, *exc):
+        self._trace.add(self._name, self._start, time() - self._start)
+        return False
+
+
+class Trace(object):
+    '''The spans timed while handling one command. Spans may be added from any thread the
+    command hands work to.'''
+    def __init__(self, comment_id, command):
+        self.comment_id = comment_id
+        self.command = command
+        self.start = time()
+        self.total = None
+        # time spent on the comment before the command started.
+        self.before = 0.0
+        self.spans = []
+
+    def add(self, name, start, duration):
+        # list.append is atomic, so no lock.
+        self.spans.append((name, start - self.start, duration))
+
+    def toJSON(self):
+        return json.dumps({u'comment': self.comment_id, u'command': self.command,
+                           u'start': self.start, u'total': self.total, u'before': self.before,
+                           u'spans': [[n, round(s, 6), round(d, 6)] for n, s, d in self.spans]})
+
+
+class _Command(object):
+    def __init__(self, profiler, trace, before, generation):
+        self._profiler = profiler
+        self._trace = trace
+        self._before = before
+        self._generation = generation
+
+    def __enter__(self):
+        # time spent on the comment before the command started, such as its inbox fetch.
+        for name, duration in self._before:
+            self._trace.add(name, self._trace.start - duration, duration)
+            self._trace.before += duration
+        self._profiler._local.trace = self._trace
+        self._cprofile = cProfile.Profile() if self._profiler._cprofile else None
+        if self._cprofile:
+            self._cprofile.enable()
+        return self._trace
+
+    def __exit__(self, *exc):
+        if self._cprofile:
+            self._cprofile.disable()
+        self._profiler._local.trace = None
+        self._trace.total = time() - self._trace.start
+        self._profiler._finish(self._trace, self._cprofile, self._generation)
+        return False
+
+
+class Profiler(object):
+    '''Times named spans of the work done for the next few commands, on request. While off
+    span() and command() hand back a do nothing context manager after checking a single
+    attribute, so the hooks can stay in place.
+
+    start(count) profiles the next count commands. Each is written to the profile file as
+    a line of JSON with the offset and duration of each span. Spans nest, a BGG request
+    inside a lookup step say. Once count commands are done onDone, if given, is called
+    with a summary of the spans that took the most time. A profile whose commands are not
+    all done within its timeout, say because one hung, ends then with those that are. If
+    cprofile is set each command is also run under cProfile and the summary lists the top
+    functions too. cProfile only sees the command's own thread, not the threads it hands
+    lookups to.'''
+    def __init__(self, path=u'profile.jsonl', top=10, cprofile=False):
+        super(Profiler, self).__init__()
+        self.active = False
+        self._path = path
+        self._top = top
+        self._cprofile = cprofile
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._remaining = 0
+        self._count = 0
+        self._traces = []
+        self._stats = None
+        self._onDone = None
+        # which profile a command belongs to, so one that ends late is left out of the next.
+        self._generation = 0
+
+    def configure(self, path=None, top=None, cprofile=None):
+        with self._lock:
+            self._path = path if path is not None else self._path
+            self._top = top if top is not None else self._top
+            self._cprofile = cprofile if cprofile is not None else self._cprofile
+
+    def start(self, count, onDone=None, timeout=3600):
+        '''Profile the next count commands, for at most timeout seconds. Returns False if
+        already profiling.'''
+        with self._lock:
+            if self.active:
+                return False
+
+            self._remaining = self._count = count
+            self._traces = []
+            self._stats = None
+            self._onDone = onDone
+            self._generation += 1
+            generation = self._generation
+            # the file is opened for each trace, so start it empty.
+            open(self._path, u'w').close()
+            self.active = True
+
+        if timeout:
+            timer = threading.Timer(timeout, self._timeout, (generation,))
+            timer.daemon = True
+            timer.start()
+
+        log.info(u'Profiling the next {} commands into {}.'.format(count, self._path))
+        return True
+
+    def command(self, comment_id, command, before=()):
+        '''Context manager around running command on comment_id. If it is one of those
+        being profiled it gives the Trace, else None. before is a list of (span name,
+        duration) spent on the comment before the command started.'''
+        if not self.active:
+            return _NULL
+
+        with self._lock:
+            if self._remaining <= 0:
+                return _NULL
+            self._remaining -= 1
+            generation = self._generation
+
+        return _Command(self, Trace(comment_id, command), before, generation)
+
+    def span(self, name):
+        '''Context manager timing its body as span name of the current command's trace.'''
+        if not self.active:
+            return _NULL
+
+        trace = getattr(self._local, u'trace', None)
+        return _Span(trace, name) if trace else _NULL
+
+    def bind(self, fn):
+        '''Return fn, or, while a command is profiled, a wrapper that adds the spans timed by
+        fn to the command's trace when it is run in another thread.'''
+        if not self.active:
+            return fn
+
+        trace = getattr(self._local, u'trace', None)
+        if not trace:
+            return fn
+
+        def bound(*args, **kwargs):
+            previous = getattr(self._local, u'trace', None)
+            self._local.trace = trace
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._local.trace = previous
+        return bound
+
+    def _finish(self, trace, cprofile, generation):
+        with self._lock:
+            if generation != self._generation or not self.active:
+                # its profile timed out.
+                return
+
+            self._traces.append(trace)
+            try:
+                with open(self._path, u'a') as fd:
+                    fd.write(trace.toJSON() + u'\n')
+            except IOError as e:
+                log.error(u'Could not write profile to {}: {}'.format(self._path, e))
+
+            if cprofile:
+                if self._stats:
+                    self._stats.add(cprofile)
+                else:
+                    self._stats = pstats.Stats(cprofile, stream=StringIO())
+
+            # done when all the commands started under this profile have finished.
+            done = len(self._traces) >= self._count
+            if done:
+                self.active = False
+                onDone, self._onDone = self._onDone, None
+
+        if done:
+            self._done(onDone)
+
+    def _timeout(self, generation):
+        with self._lock:
+            if generation != self._generation or not self.active:
+                return
+
+            log.warn(u'Profile timed out with {} of {} commands done.'.format(
+                len(self._traces), self._count))
+            self.active = False
+            onDone, self._onDone = self._onDone, None
+
+        self._done(onDone)
+
+    def _done(self, onDone):
+        summary = self.summary()
+        log.info(u'Profile done:\n{}'.format(summary))
+        if onDone:
+            onDone(summary)
+
+    def summary(self):
+        '''The spans that took the most time across the profiled commands, as text.'''
+        with self._lock:
+            traces = list(self._traces)
+            stats = self._stats
+
+        totals = {}
+        for trace in traces:
+            for name, start, duration in trace.spans:
+                t = totals.setdefault(name, [0.0, 0, 0.0])
+                t[0] += duration
+                t[1] += 1
+                t[2] = max(t[2], duration)
+
+        commandTime = sum(t.total for t in traces)
+        # from the inbox fetch to the end of the command.
+        elapsed = commandTime + sum(t.before for t in traces)
+        lines = [u'Profiled {} commands taking {:.3f}s to run and {:.3f}s from inbox to done. Top '
+                 u'spans by time, with their share of the latter (spans nest, so shares '
+                 u'overlap):'.format(len(traces), commandTime, elapsed), u'']
+        if len(traces) < self._count:
+            lines[0] = u'Timed out waiting for {} more. '.format(self._count - len(traces)) + lines[0]
+        lines.append(u'span | total (s) | count | max (ms) | share')
+        lines.append(u':--|--:|--:|--:|--:')
+        for name, (total, count, longest) in sorted(totals.iteritems(),
+                                                     key=lambda t: -t[1][0])[:self._top]:
+            lines.append(u'{} | {:.3f} | {} | {:.1f} | {:.0%}'.format(
+                name, total, count, longest * 1000, total / elapsed if elapsed else 0))
+
+        if stats:
+            out = StringIO()
+            stats.stream = out
+            stats.sort_stats(u'cumulative').print_stats(self._top)
+            lines += [u'', u'Top functions by cumulative time:', u'']
+            lines += [u'    ' + l for l in out.getvalue().splitlines() if l.strip()]
+
+        return u'\n'.join(lines)
+
+
+# The one profiler for the bot.
+profiler = Profiler()
@@ -0,0 +1,218 @@
+import logging
+import threading
+from collections import OrderedDict
+from Queue import Queue, Empty
+from time import time
+
+from LRUCache import LRUCache
+from Metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+class ReplyQueue(object):
+    '''Sends the bot's replies and edits to Reddit from a background thread, one every
+    interval seconds at most, so a slow or throttling Reddit holds up the queue instead of
+    the commands. A post Reddit says was rate limited is retried after the wait Reddit asks
+    for. Other failures are retried retries times with growing waits, then dropped. An
+    edit of a reply that was dropped is made as the reply instead.
+
+    Everything queued is also kept in the bot database until sent, and queued again on
+    start, so a restart does not lose replies. Comments are marked read in batches of up
+    to readBatch, at least every readInterval seconds.'''
+    def __init__(self, reddit, botdb, interval=2.0, retries=5, backoff=5.0, readBatch=25,
+                 readInterval=10):
+        super(ReplyQueue, self).__init__()
+        self._reddit = reddit
+        self._botdb = botdb
+        self._interval = interval
+        self._retries = retries
+        self._backoff = backoff
+        self._readBatch = readBatch
+        self._readInterval = readInterval
+        self._queue = Queue()
+        self._stop = threading.Event()
+        # comment id --> comment, waiting to be marked read.
+        self._toMark = OrderedDict()
+        self._markLock = threading.Lock()
+        self._lastMark = time()
+        # outbox id --> reply made for it, for edits queued before the reply was made.
+        self._sent = LRUCache(1000)
+        # outbox id --> (thing_id, target) of a reply given up on. An edit of it is made as
+        # the reply instead.
+        self._unsent = LRUCache(1000)
+
+        pending = self._botdb.pending_outgoing()
+        for oid, action, thing_id, body, record in pending:
+            self._queue.put((oid, action, thing_id, None, body, record))
+        if pending:
+            log.info(u'Queued {} replies left unsent last time.'.format(len(pending)))
+
+        metrics.collect(lambda: {u'reply_queue_depth': self._queue.qsize()})
+        self._thread = threading.Thread(target=self._send, name=u'reddit-sender')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def reply(self, target, text, record=None):
+        '''Queue a reply to target. If given, record is (mode, game ids, not found names),
+        stored for the reply once it is made. See BotDatabase.add_reply(). Returns an id
+        that edit() takes in place of the reply, which may not have been made yet.'''
+        return self._put(u'reply', target, text, record)
+
+    def edit(self, target, text, record=None):
+        '''Queue an edit replacing the text of target, one of the bot's comments or an id
+        returned by reply().'''
+        self._put(u'edit', target, text, record)
+
+    def _put(self, action, target, text, record):
+        if isinstance(target, (int, long)):
+            sent = self._sent.get(target)
+            if sent:
+                target = sent
+            else:
+                # replaced with the real id once the reply is sent.
+                thing_id = self._ref(target)
+                target = None
+
+        if target:
+            thing_id = self._fullname(target)
+
+        oid = self._botdb.add_outgoing(action, thing_id, text, record)
+        self._queue.put((oid, action, thing_id, target, text, record))
+        return oid
+
+    def _ref(self, oid):
+        return u'outbox:{}'.format(oid)
+
+    def _fullname(self, thing):
+        return getattr(thing, u'fullname', thing.id)
+
+    def markRead(self, comment):
+        with self._markLock:
+            self._toMark[comment.id] = comment
+            full = len(self._toMark) >= self._readBatch
+
+        if full:
+            self._flushMarks()
+
+    def _flushMarks(self):
+        with self._markLock:
+            comments = self._toMark.values()
+            self._toMark = OrderedDict()
+            self._lastMark = time()
+
+        if not comments:
+            return
+
+        user = getattr(self._reddit, u'user', None)
+        try:
+            if user and hasattr(user, u'mark_as_read'):
+                user.mark_as_read(comments)
+            else:
+                for comment in comments:
+                    comment.mark_as_read()
+            log.debug(u'Marked {} comments read.'.format(len(comments)))
+        except Exception as e:
+            # They are in the bot database already, so the poller will offer them again.
+            log.error(u'Could not mark {} comments read: {}'.format(len(comments), e))
+
+    def close(self, timeout=60):
+        '''Wait up to timeout seconds for the queue to empty, then stop. Anything unsent is
+        sent on the next start.'''
+        deadline = time() + timeout
+        while not self._queue.empty() and time() < deadline:
+            self._stop.wait(0.1)
+
+        self._stop.set()
+        self._thread.join(max(0, deadline - time()))
+        self._flushMarks()
+        if not self._queue.empty():
+            log.info(u'{} replies left unsent. They will be sent on the next start.'.format(
+                self._queue.qsize()))
+
+    def _send(self):
+        while not self._stop.is_set():
+            try:
+                item = self._queue.get(timeout=1)
+            except Empty:
+                item = None
+
+            if item:
+                self._deliver(*item)
+
+            if time() - self._lastMark > self._readInterval:
+                self._flushMarks()
+
+            if item:
+                self._stop.wait(self._interval)
+
+    def _deliver(self, oid, action, thing_id, target, text, record):
+        # the outbox id of the reply an edit was queued for, if it had not been made yet.
+        ref = None
+        if not target and thing_id.startswith(u'outbox:'):
+            ref = int(thing_id.split(u':')[1])
+            target = self._sent.get(ref)
+            if not target:
+                unsent = self._unsent.pop(ref)
+                if not unsent:
+                    # given up on before a restart. There is nothing to edit.
+                    log.error(u'Reply {} was never made, dropping an {} of it.'.format(
+                        thing_id, action))
+                    self._botdb.remove_outgoing(oid)
+                    return
+                log.info(u'Reply {} was never made, making the {} of it the reply.'.format(
+                    thing_id, action))
+                action = u'reply'
+                thing_id, target = unsent
+
+        attempt = 0
+        while not self._stop.is_set():
+            try:
+                if not target:
+                    target = self._reddit.get_info(thing_id=thing_id)
+                    if not target:
+                        log.error(u'Cannot find {} to {} to, dropping it.'.format(thing_id, action))
+                        break
+
+                sent = target.reply(text) if action == u'reply' else target.edit(text)
+            except Exception as e:
+                # praw.errors.RateLimitExceeded says how long to wait.
+                wait = getattr(e, u'sleep_time', None)
+                if wait:
+                    log.info(u'Reddit rate limited a {}, waiting {} seconds.'.format(action, wait))
+                    metrics.inc(u'reddit_throttled_total', action=action,
+                                help=u'Replies and edits Reddit rate limited.')
+                    self._stop.wait(wait)
+                    continue
+
+                attempt += 1
+                if attempt > self._retries:
+                    log.error(u'Giving up on {} to {}: {}'.format(action, thing_id, e))
+                    if action == u'reply':
+                        self._unsent.put(ref or oid, (thing_id, target))
+                    metrics.inc(u'reddit_dropped_total', action=action,
+                                help=u'Replies and edits given up on.')
+                    break
+
+                log.warn(u'Error sending {} to {}, will retry: {}'.format(action, thing_id, e))
+                self._stop.wait(self._backoff * 2 ** (attempt - 1))
+                continue
+
+            if action == u'reply' and sent:
+                self._sent.put(oid, sent)
+                self._botdb.retarget_outgoing(self._ref(oid), self._fullname(sent))
+                if ref:
+                    # later edits of the reply given up on are edits of this one.
+                    self._sent.put(ref, sent)
+                    self._botdb.retarget_outgoing(self._ref(ref), self._fullname(sent))
+
+            if record:
+                reply_id = sent.id if action == u'reply' and sent else target.id
+                self._botdb.add_reply(reply_id, *record)
+            metrics.inc(u'reddit_sent_total', action=action, help=u'Replies and edits sent.')
+            break
+        else:
+            # stopped before it was sent. It stays in the database for the next start.
+            return
+
+        self._botdb.remove_outgoing(oid)
@@ -0,0 +1,182 @@
+import logging
+import threading
+from Queue import Queue, Full, Empty
+from time import time
+
+from BotDatabase import normalize_query
+from CommandParser import parse
+from LRUCache import LRUCache
+from Metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+class StreamScanner(object):
+    '''Watches the comment streams of subreddits, each a name or several joined with "+",
+    and answers comments that bold the names of games without summoning the bot.
+
+    Each stream is read every interval seconds, newest first, up to the first comment seen
+    before or limit comments, so a stream busier than that between reads is sampled. Most
+    comments are thrown out by a cheap filter: no "**" in the body, a mention of the bot
+    (the inbox has those), the bot's own comments, ignored users and comments already
+    handled. The bold text of what is left is matched against names the bot
+    already knows: names it has resolved before, aliases and, if given, the local name
+    index. Only comments with a known name are queued for handler, which is called with
+    the comment and those names from worker threads.
+
+    The queue holds queueSize comments. While it is more than half full the streams are
+    read less often, up to maxInterval seconds apart, and when it is full new candidates
+    are dropped and counted, so a busy stream never holds up the inbox.'''
+    def __init__(self, reddit, botdb, botname, subreddits, handler, nameIndex=None, interval=10,
+                 maxInterval=120, limit=100, queueSize=50, workers=1, namesRefresh=600):
+        super(StreamScanner, self).__init__()
+        self._reddit = reddit
+        self._botdb = botdb
+        self._botname = botname
+        self._mention = u'u/' + botname.lower()
+        self._subreddits = subreddits
+        self._handler = handler
+        self._nameIndex = nameIndex
+        self._minInterval = interval
+        self._maxInterval = maxInterval
+        self._limit = limit
+        self._workers = workers
+        self._namesRefresh = namesRefresh
+        self.interval = interval
+        self._queue = Queue(queueSize)
+        self._stop = threading.Event()
+        self._threads = []
+        self._seen = LRUCache(10000)
+        self._names = set()
+        self._namesLoaded = 0
+        # subreddit --> {seen, candidates, answered, dropped}
+        self._counts = {}
+        self._countLock = threading.Lock()
+        self._started = time()
+        metrics.collect(lambda: {u'stream_queue_depth': self._queue.qsize(),
+                                 u'stream_interval_seconds': self.interval})
+
+    def start(self):
+        targets = [(self._read, u'stream-reader')] + [
+            (self._work, u'stream-worker-{}'.format(i)) for i in xrange(self._workers)]
+        for target, name in targets:
+            t = threading.Thread(target=target, name=name)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        log.info(u'Scanning the comments of {}.'.format(u', '.join(self._subreddits)))
+
+    def stop(self, timeout=60):
+        '''Stop reading and wait up to timeout seconds for the comment being handled.
+        Queued candidates are dropped.'''
+        self._stop.set()
+        deadline = time() + timeout
+        for t in self._threads:
+            t.join(max(0, deadline - time()))
+
+    def _count(self, subreddit, what, amount=1):
+        with self._countLock:
+            counts = self._counts.setdefault(subreddit, {
+                u'seen': 0, u'candidates': 0, u'answered': 0, u'dropped': 0})
+            counts[what] += amount
+        metrics.inc(u'stream_{}_total'.format(what), amount, subreddit=subreddit,
+                    help=u'Stream comments {}.'.format(what))
+
+    def stats(self):
+        '''Return {subreddit: counts} with the comments seen per second for each.'''
+        elapsed = max(1.0, time() - self._started)
+        with self._countLock:
+            return {sub: dict(c, seen_per_second=c[u'seen'] / elapsed)
+                    for sub, c in self._counts.iteritems()}
+
+    def _loadNames(self):
+        if time() - self._namesLoaded < self._namesRefresh:
+            return
+        self._names = set(self._botdb.known_queries())
+        self._namesLoaded = time()
+        log.debug(u'Stream filter knows {} names.'.format(len(self._names)))
+
+    def _known(self, name):
+        if normalize_query(name) in self._names or self._botdb.get_name_from_alias(name):
+            return True
+        return bool(self._nameIndex and self._nameIndex.contains(name))
+
+    def candidateNames(self, comment):
+        '''The known game names bolded in comment, or an empty list if it is not one to
+        answer.'''
+        body = comment.body
+        if u'**' not in body or self._mention in body.lower():
+            return []
+
+        author = comment.author.name if comment.author else None
+        if not author or author.lower() == self._botname.lower() or self._botdb.ignore_user(author):
+            return []
+
+        if self._botdb.comment_exists(comment):
+            return []
+
+        return [n for n in parse(comment, self._botname).gameNames() if self._known(n)]
+
+    def _read(self):
+        while not self._stop.is_set():
+            try:
+                self._loadNames()
+                candidates = []
+                for stream in self._subreddits:
+                    candidates += self._scan(stream)
+                # oldest first, so when the queue fills no subreddit is favoured.
+                candidates.sort(key=lambda c: c[1].created_utc)
+                for subreddit, comment, names in candidates:
+                    try:
+                        self._queue.put_nowait((subreddit, comment, names))
+                    except Full:
+                        self._count(subreddit, u'dropped')
+            except Exception as e:
+                log.error(u'Error reading comment streams: {}'.format(e))
+
+            # read less often while the workers are behind.
+            if self._queue.qsize() > self._queue.maxsize / 2:
+                self.interval = min(self._maxInterval, self.interval * 2)
+            else:
+                self.interval = self._minInterval
+            self._stop.wait(self.interval)
+
+    def _scan(self, stream):
+        '''Read the new comments of stream, a subreddit or several joined with "+". Returns
+        a (subreddit, comment, names) for each candidate.'''
+        candidates = []
+        for comment in self._reddit.get_comments(stream, limit=self._limit):
+            if comment.id in self._seen:
+                break
+            self._seen.put(comment.id, True)
+
+            # counted by the comment's own subreddit, so "a+b" streams are split up.
+            subreddit = comment.subreddit.display_name.lower()
+            self._count(subreddit, u'seen')
+            names = self.candidateNames(comment)
+            if names:
+                self._count(subreddit, u'candidates')
+                candidates.append((subreddit, comment, names))
+        return candidates
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                subreddit, comment, names = self._queue.get(timeout=1)
+            except Empty:
+                continue
+
+            try:
+                if not self._botdb.claim_comment(comment):
+                    continue
+
+                try:
+                    if self._handler(comment, names):
+                        self._count(subreddit, u'answered')
+                finally:
+                    # recorded even if answering failed, so it is not tried again.
+                    self._botdb.add_comment(comment)
+                    self._botdb.commit()
+            except Exception as e:
+                # a locked database must not take the worker with it.
+                log.error(u'Caught exception answering stream comment {}: {}'.format(comment.id, e))
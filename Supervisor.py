@@ -0,0 +1,79 @@
+import logging
+import subprocess
+import threading
+from time import time
+
+log = logging.getLogger(__name__)
+
+
+class Supervisor(object):
+    '''Runs a process for each of commands, each a list of program arguments, and starts
+    again any that exit until stop() is called. A process that exits within stableAfter
+    seconds of starting waits delay seconds before it is started again, twice as long
+    each time it does so in a row, up to maxDelay. On stop each process is sent SIGTERM
+    and given stopTimeout seconds to finish before it is killed.'''
+    def __init__(self, commands, delay=1.0, maxDelay=300, stableAfter=60, stopTimeout=330):
+        super(Supervisor, self).__init__()
+        self._commands = commands
+        self._delay = delay
+        self._maxDelay = maxDelay
+        self._stableAfter = stableAfter
+        self._stopTimeout = stopTimeout
+        self._stop = threading.Event()
+        self._procs = [None] * len(commands)
+        self._started = [0] * len(commands)
+        self._nextStart = [0] * len(commands)
+        self._failures = [0] * len(commands)
+        self.restarts = 0
+
+    def stop(self, signum=None, frame=None):
+        '''Stop the processes and return from run(). Can be used as a signal handler.'''
+        if not self._stop.is_set():
+            log.info(u'Stopping workers.')
+        self._stop.set()
+
+    def pids(self):
+        return [p.pid if p and p.poll() is None else None for p in self._procs]
+
+    def run(self):
+        '''Run until stop() is called.'''
+        while not self._stop.is_set():
+            for i in xrange(len(self._commands)):
+                self._check(i)
+            self._stop.wait(0.5)
+
+        running = [p for p in self._procs if p and p.poll() is None]
+        for p in running:
+            p.terminate()
+
+        deadline = time() + self._stopTimeout
+        while any(p.poll() is None for p in running) and time() < deadline:
+            self._stop.wait(0.1)
+
+        for p in running:
+            if p.poll() is None:
+                log.warn(u'Worker {} did not stop in time. Killing it.'.format(p.pid))
+                p.kill()
+                p.wait()
+
+    def _check(self, i):
+        proc = self._procs[i]
+        if proc and proc.poll() is None:
+            return
+
+        now = time()
+        if proc:
+            ran = now - self._started[i]
+            self._failures[i] = 0 if ran >= self._stableAfter else self._failures[i] + 1
+            delay = min(self._maxDelay, self._delay * 2 ** (self._failures[i] - 1)) \
+                if self._failures[i] else 0
+            log.warn(u'Worker {} exited with status {} after {:.0f} seconds. Restarting it in '
+                     u'{:.0f} seconds.'.format(i, proc.returncode, ran, delay))
+            self._procs[i] = None
+            self._nextStart[i] = now + delay
+            self.restarts += 1
+
+        if now >= self._nextStart[i]:
+            self._procs[i] = subprocess.Popen(self._commands[i])
+            self._started[i] = now
+            log.info(u'Started worker {}, pid {}.'.format(i, self._procs[i].pid))
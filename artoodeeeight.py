@@ -1,13 +1,24 @@
 import argparse
 import praw
 import logging
-import re
-from HTMLParser import HTMLParser
-from time import sleep
+import signal
+import sys
+from os import getcwd
+from os.path import abspath, join as pjoin
 
 from argParseLog import addLoggingArgs, handleLoggingArgs
+from BGGClient import BGGClient
 from BotDatabase import BotDatabase
+from BotPipeline import BotPipeline
 from CommentHandler import CommentHandler
+from EventPipeline import EventPipeline
+from InboxPoller import InboxPoller, MIN_INTERVAL, MAX_INTERVAL
+from ReplyQueue import ReplyQueue
+from StreamScanner import StreamScanner
+from Metrics import metrics, flatten
+from NameIndex import NameIndex
+from Profiler import profiler
+from Supervisor import Supervisor
 
 from r2d8_auth import login as oauth_login
 
@@ -19,48 +30,188 @@ if __name__ == '__main__':
     dbname = '{}-bot.db'.format(botname)
     ap.add_argument(u'-d', u'--database', help=u'The bot database. Default is {}'.format(dbname),
                     default=u'{}'.format(dbname))
+    ap.add_argument(u'-w', u'--workers', type=int, default=1,
+                    help=u'Number of threads used to look up the games in a single getinfo '
+                    u'request. Default is 1 (one game at a time).')
+    ap.add_argument(u'--probe-workers', dest=u'probe_workers', type=int, default=0,
+                    help=u'If more than 0, the spelling variants of a game name BGG does not '
+                    u'know are looked up concurrently by this many threads. Faster, but can use '
+                    u'more BGG requests. Default is 0 (one variant at a time).')
+    ap.add_argument(u'--bgg-interval', dest=u'bgg_interval', type=float, default=0.5,
+                    help=u'Shortest average number of seconds between requests to BGG. This '
+                    u'is shared by all workers and grows while BGG is throttling us. 0 is no '
+                    u'limit. Default is 0.5.')
+    ap.add_argument(u'--not-found-ttl', dest=u'not_found_ttl', type=int, default=86400,
+                    help=u'Number of seconds a name BGG could not find is remembered as not '
+                    u'found. 0 disables this. Default is 86400.')
+    ap.add_argument(u'--name-index', dest=u'name_index',
+                    help=u'Prefix of a local BGG name index built with NameIndex.py. If given it '
+                    u'is used to match game names before asking BGG.')
+    ap.add_argument(u'--comment-retention', dest=u'comment_retention', type=int, default=30,
+                    help=u'Number of days handled comment ids are kept in the bot database. '
+                    u'Default is 30.')
+    ap.add_argument(u'-c', u'--command-workers', dest=u'command_workers', type=int, default=1,
+                    help=u'Number of threads handling bot commands. Default is 1.')
+    ap.add_argument(u'--engine', choices=[u'threads', u'event'], default=u'threads',
+                    help=u'How commands are run. "threads" has --command-workers threads each '
+                    u'handling one comment at a time. "event" runs an event loop that polls the '
+                    u'inbox and keeps up to --concurrency commands in flight. Default is threads.')
+    ap.add_argument(u'--concurrency', type=int, default=16,
+                    help=u'Most commands in flight at once with --engine event. Default is 16.')
+    ap.add_argument(u'--queue-size', dest=u'queue_size', type=int, default=100,
+                    help=u'Maximum number of comments waiting to be handled. When full the bot '
+                    u'stops fetching new ones until there is room. Default is 100.')
+    ap.add_argument(u'--command-timeout', dest=u'command_timeout', type=int, default=300,
+                    help=u'Number of seconds to wait for a single command before giving up on '
+                    u'it. Default is 300.')
+    ap.add_argument(u'--min-poll', dest=u'min_poll', type=float, default=MIN_INTERVAL,
+                    help=u'Seconds between inbox polls while busy. Default is {}.'.format(MIN_INTERVAL))
+    ap.add_argument(u'--max-poll', dest=u'max_poll', type=float, default=MAX_INTERVAL,
+                    help=u'Longest time in seconds between inbox polls when idle. Default is '
+                    u'{}.'.format(MAX_INTERVAL))
+    ap.add_argument(u'--max-stale', dest=u'max_stale', type=int, default=7 * 86400,
+                    help=u'Seconds past its expiry a cached BGG game may still be used while a '
+                    u'fresh copy is fetched in the background. Default is 604800.')
+    ap.add_argument(u'--prefetch-budget', dest=u'prefetch_budget', type=int, default=20,
+                    help=u'Maximum number of popular games refreshed ahead of expiry each '
+                    u'prefetch round. 0 disables prefetching. Default is 20.')
+    ap.add_argument(u'--prefetch-interval', dest=u'prefetch_interval', type=int, default=600,
+                    help=u'Seconds between prefetch rounds. Default is 600.')
+    ap.add_argument(u'--cache-max-entries', dest=u'cache_max_entries', type=int, default=100000,
+                    help=u'Most BGG responses kept in the BGG cache. The least used and least '
+                    u'recently used are evicted first. Default is 100000.')
+    ap.add_argument(u'--cache-max-mb', dest=u'cache_max_mb', type=int, default=512,
+                    help=u'Most megabytes of BGG responses kept in the BGG cache. Default is 512.')
+    ap.add_argument(u'--cache-compact-interval', dest=u'cache_compact_interval', type=int,
+                    default=600, help=u'Seconds between compactions of the BGG cache, which '
+                    u'remove expired responses, evict to the limits above and shrink the file. '
+                    u'Default is 600.')
+    ap.add_argument(u'--progress-deadline', dest=u'progress_deadline', type=float,
+                    help=u'If given, a getinfo still looking up games after this many seconds '
+                    u'replies with the games found so far, then edits the reply once the rest '
+                    u'are found.')
+    ap.add_argument(u'--reply-interval', dest=u'reply_interval', type=float, default=2,
+                    help=u'Shortest time in seconds between replies or edits posted to Reddit. '
+                    u'Default is 2.')
+    ap.add_argument(u'--metrics-port', dest=u'metrics_port', type=int,
+                    help=u'If given, serve metrics in the Prometheus text format at '
+                    u'http://127.0.0.1:PORT/metrics.')
+    ap.add_argument(u'--metrics-file', dest=u'metrics_file',
+                    help=u'If given, write the metrics to this file every --metrics-interval '
+                    u'seconds.')
+    ap.add_argument(u'--metrics-interval', dest=u'metrics_interval', type=int, default=60,
+                    help=u'Seconds between writes of --metrics-file. Default is 60.')
+    ap.add_argument(u'--profile', type=int, default=0,
+                    help=u'Profile the first PROFILE commands handled, writing the time spent in '
+                    u'each part of each to --profile-file and logging a summary. Admins can ask '
+                    u'for the same at any time with "u/{} profile N".'.format(botname))
+    ap.add_argument(u'--profile-file', dest=u'profile_file', default=u'{}-profile.jsonl'.format(botname),
+                    help=u'Where profiles are written. Default is {}-profile.jsonl.'.format(botname))
+    ap.add_argument(u'--profile-top', dest=u'profile_top', type=int, default=10,
+                    help=u'Number of entries in a profile summary. Default is 10.')
+    ap.add_argument(u'--profile-cprofile', dest=u'profile_cprofile', action=u'store_true',
+                    help=u'Also run profiled commands under cProfile and list the top functions.')
+    ap.add_argument(u'--stream', default=u'',
+                    help=u'Comma separated subreddits whose every comment is read. Comments that '
+                    u'bold the names of games the bot knows are answered without the bot being '
+                    u'summoned. Off by default.')
+    ap.add_argument(u'--stream-interval', dest=u'stream_interval', type=float, default=10,
+                    help=u'Seconds between reads of the --stream subreddits. Default is 10.')
+    ap.add_argument(u'--stream-queue', dest=u'stream_queue', type=int, default=50,
+                    help=u'Most stream comments waiting to be answered. Past this new ones are '
+                    u'dropped. Default is 50.')
+    ap.add_argument(u'--stream-workers', dest=u'stream_workers', type=int, default=1,
+                    help=u'Threads answering stream comments. Default is 1.')
+    ap.add_argument(u'-p', u'--processes', type=int, default=1,
+                    help=u'Number of bot processes. More than 1 starts a supervisor that runs '
+                    u'and restarts that many workers. They share the databases, the BGG cache '
+                    u'and the BGG rate limit, and each comment is handled by whichever worker '
+                    u'claims it first. Default is 1.')
+    # set by the supervisor for each worker it starts.
+    ap.add_argument(u'--worker', type=int, help=argparse.SUPPRESS)
     addLoggingArgs(ap)
     args = ap.parse_args()
+    if args.bgg_interval < 0:
+        ap.error(u'--bgg-interval cannot be negative.')
     handleLoggingArgs(args)
 
     dbname = args.database if args.database else dbname
 
-    hp = HTMLParser()
-
     # quiet requests
     logging.getLogger(u"requests").setLevel(logging.WARNING)
 
+    if args.processes > 1 and args.worker is None:
+        # create or migrate the tables once, before the workers race to.
+        BotDatabase(args.database)
+        supervisor = Supervisor([[sys.executable, abspath(__file__)] + sys.argv[1:] +
+                                 [u'--worker', unicode(i)] for i in xrange(args.processes)],
+                                stopTimeout=args.command_timeout + 30)
+        signal.signal(signal.SIGINT, supervisor.stop)
+        signal.signal(signal.SIGTERM, supervisor.stop)
+        log.info(u'Starting {} workers.'.format(args.processes))
+        supervisor.run()
+        sys.exit(0)
+
+    worker = u'worker-{}'.format(args.worker) if args.worker is not None else None
+    if args.worker:
+        # one port and file per worker. Only the first prefetches popular games, reads the
+        # --stream subreddits and compacts the BGG cache.
+        args.metrics_port = args.metrics_port + args.worker if args.metrics_port else None
+        args.metrics_file = u'{}.{}'.format(args.metrics_file, args.worker) if args.metrics_file else None
+        args.profile_file = u'{}.{}'.format(args.profile_file, args.worker)
+        args.prefetch_budget = 0
+        args.stream = u''
+
     reddit = oauth_login()
 
-    bdb = BotDatabase(args.database)
+    bdb = BotDatabase(args.database, not_found_ttl=args.not_found_ttl,
+                      comment_retention=args.comment_retention * 86400, worker=worker,
+                      claim_expiry=2 * args.command_timeout)
     log.info(u'Bot database opened/created.')
-    ch = CommentHandler(botname, bdb)
+    nameIndex = NameIndex(args.name_index) if args.name_index else None
+    bgg = BGGClient.sqlite(pjoin(getcwd(), u'{}-bgg.db'.format(botname)),
+                           sharedRate=args.processes > 1, maxEntries=args.cache_max_entries,
+                           maxBytes=args.cache_max_mb * 2 ** 20,
+                           compactInterval=args.cache_compact_interval,
+                           compact=not args.worker, interval=args.bgg_interval,
+                           maxStale=args.max_stale, popular=bdb.popular_games,
+                           prefetchBudget=args.prefetch_budget,
+                           prefetchInterval=args.prefetch_interval)
+    replies = ReplyQueue(reddit, bdb, interval=args.reply_interval)
+    ch = CommentHandler(botname, bdb, workers=args.workers, nameIndex=nameIndex, bgg=bgg,
+                        probeWorkers=args.probe_workers, replyQueue=replies,
+                        progressDeadline=args.progress_deadline)
     log.info(u'Comment/notification handler created.')
-    botcmds = re.compile(u'/?u/{}\s(\w+)'.format(botname), re.IGNORECASE)
-    cmdmap = {
-        u'getinfo': ch.getInfo,
-        u'repair': ch.repairComment,
-        u'xyzzy': ch.xyzzy,
-        u'alias': ch.alias,
-        u'getaliases': ch.getaliases,
-        u'getparentinfo': ch.getParentInfo
-    }
-    log.info(u'Waiting for new PMs and/or notifications.')
-    while True:
-        try:
-            for comment in list(reddit.get_mentions()) + list(reddit.get_unread()):
-                # log.debug(u'got {}'.format(comment.id))
-                if not bdb.comment_exists(comment):
-                    bdb.add_comment(comment)
-                    for cmd in [c.lower() for c in botcmds.findall(comment.body)]:
-                        if cmd in cmdmap:
-                            comment.body = hp.unescape(comment.body)
-                            cmdmap[cmd](comment)
-                        else:
-                            log.info(u'Got unknown command: {}'.format(cmd))
+    poller = InboxPoller(reddit, bdb, minInterval=args.min_poll, maxInterval=args.max_poll,
+                         markRead=replies.markRead)
+    if args.engine == u'event':
+        pipeline = EventPipeline(reddit, bdb, botname, ch.commands(), concurrency=args.concurrency,
+                                 timeout=args.command_timeout, poller=poller, replyQueue=replies)
+    else:
+        pipeline = BotPipeline(reddit, bdb, botname, ch.commands(), workers=args.command_workers,
+                               queueSize=args.queue_size, timeout=args.command_timeout,
+                               poller=poller, replyQueue=replies)
+    metrics.collect(lambda: flatten(ch.cacheStats(), u'cache_'))
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    if args.metrics_file:
+        metrics.dumpEvery(args.metrics_file, args.metrics_interval)
 
-        except Exception as e:
-            log.error(u'Caught exception: {}'.format(e))
+    profiler.configure(path=args.profile_file, top=args.profile_top, cprofile=args.profile_cprofile)
+    if args.profile:
+        profiler.start(args.profile)
 
-        # get_mentions is non-blocking
-        sleep(5)
+    scanner = None
+    if args.stream:
+        scanner = StreamScanner(reddit, bdb, botname, [s.strip() for s in args.stream.split(u',') if s.strip()],
+                                ch.streamInfo, nameIndex=nameIndex, interval=args.stream_interval,
+                                queueSize=args.stream_queue, workers=args.stream_workers)
+        scanner.start()
+
+    signal.signal(signal.SIGINT, pipeline.stop)
+    signal.signal(signal.SIGTERM, pipeline.stop)
+
+    log.info(u'Waiting for new PMs and/or notifications.')
+    pipeline.run()
+    if scanner:
+        scanner.stop(args.command_timeout)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+'''Find how many getinfo requests at once each engine keeps going. A burst of getinfo
+comments, each naming games nobody has asked about yet so every lookup goes to BGG, is
+put in a fake inbox and handled by the threaded pipeline (BotPipeline, one command per
+worker) and by the event loop (EventPipeline) at each level of concurrency, against a
+fake BGG and a fake Reddit that both take a while to answer. Reports throughput, latency
+percentiles and the most commands seen in flight at once for each run.'''
+
+import argparse
+import json
+import logging
+import random
+import shutil
+import sys
+import threading
+from os.path import abspath, dirname, join as pjoin
+from tempfile import mkdtemp
+from time import time, sleep
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from argParseLog import addLoggingArgs, handleLoggingArgs  # noqa: E402
+from BGGClient import BGGClient  # noqa: E402
+from BotDatabase import BotDatabase  # noqa: E402
+from BotPipeline import BotPipeline  # noqa: E402
+from CommentHandler import CommentHandler  # noqa: E402
+from EventPipeline import EventPipeline  # noqa: E402
+from InboxPoller import InboxPoller  # noqa: E402
+from ReplyQueue import ReplyQueue  # noqa: E402
+from fakebgg import FakeBGG  # noqa: E402
+from fakereddit import FakeReddit  # noqa: E402
+from replay import BOTNAME, HERE, percentile  # noqa: E402
+
+log = logging.getLogger(__name__)
+
+
+def makeGames(base, count):
+    '''count games made from the base ones, each with a name of its own.'''
+    games = []
+    for i in xrange(count):
+        game = dict(base[i % len(base)])
+        game[u'id'] = 500000 + i
+        game[u'name'] = u'{} {}'.format(game[u'name'], i)
+        game[u'alternates'] = []
+        games.append(game)
+    return games
+
+
+class _Tracked(object):
+    '''Wraps a command, noting when it finishes for each comment and the most running at
+    once.'''
+    def __init__(self, command):
+        self._command = command
+        self._lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+        self.finished = {}
+
+    def __call__(self, comment):
+        with self._lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            return self._command(comment)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.finished[comment.id] = time()
+
+
+def runOne(args, engine, concurrency, games):
+    server = FakeBGG(games, latency=args.bgg_latency, jitter=args.bgg_latency / 2).start()
+    tmpdir = mkdtemp(prefix=u'r2d8-concurrency-')
+    try:
+        bdb = BotDatabase(pjoin(tmpdir, u'bot.db'))
+        bgg = BGGClient.sqlite(pjoin(tmpdir, u'bgg.db'), interval=args.bgg_interval,
+                               api=server.api, prefetchBudget=0)
+        reddit = FakeReddit(BOTNAME, latency=args.reddit_latency)
+        replies = ReplyQueue(reddit, bdb, interval=0, backoff=0.1, readInterval=0.5)
+        ch = CommentHandler(BOTNAME, bdb, workers=args.workers, bgg=bgg, replyQueue=replies)
+        getinfo = _Tracked(ch.getInfo)
+        cmdmap = dict(ch.commands(), getinfo=getinfo)
+
+        random.seed(args.seed)
+        names = [g[u'name'] for g in games]
+        random.shuffle(names)
+        start = time() + 0.5
+        for i in xrange(args.comments):
+            bolded = names[i * args.names:(i + 1) * args.names]
+            reddit.add(u'c{}'.format(i), u'/u/{} getinfo {}'.format(
+                BOTNAME, u' '.join(u'**{}**'.format(n) for n in bolded)), u'user{}'.format(i % 50),
+                arrive=start)
+
+        poller = InboxPoller(reddit, bdb, minInterval=0.05, maxInterval=0.2, markRead=replies.markRead)
+        if engine == u'event':
+            pipeline = EventPipeline(reddit, bdb, BOTNAME, cmdmap, concurrency=concurrency,
+                                     timeout=args.timeout, poller=poller, replyQueue=replies)
+        else:
+            pipeline = BotPipeline(reddit, bdb, BOTNAME, cmdmap, workers=concurrency,
+                                   timeout=args.timeout, poller=poller, replyQueue=replies)
+        t = threading.Thread(target=pipeline.run, name=u'pipeline')
+        t.start()
+        deadline = time() + args.timeout
+        while len(getinfo.finished) < args.comments and time() < deadline:
+            sleep(0.05)
+        pipeline.stop()
+        t.join()
+
+        latencies = [f - start for f in getinfo.finished.itervalues()]
+        elapsed = max(latencies) if latencies else None
+        return {
+            u'engine': engine,
+            u'concurrency': concurrency,
+            u'handled': len(latencies),
+            u'elapsed': elapsed,
+            u'throughput': len(latencies) / elapsed if elapsed else None,
+            u'p50': percentile(latencies, 50),
+            u'p95': percentile(latencies, 95),
+            u'peak_in_flight': getinfo.peak,
+            u'bgg_requests': server.counts[u'search'] + server.counts[u'thing'],
+            u'bgg_peak_rate': server.peakRate()
+        }
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def run(args):
+    with open(args.games) as fd:
+        games = makeGames(json.load(fd), args.comments * args.names)
+    runs = []
+    for concurrency in args.concurrency:
+        for engine in args.engines:
+            result = runOne(args, engine, concurrency, games)
+            log.info(u'{engine} at {concurrency}: {throughput} getinfo/s'.format(**result))
+            runs.append(result)
+    return {u'config': {k: v for k, v in vars(args).iteritems() if k != u'output'}, u'runs': runs}
+
+
+def show(results):
+    print(u'{:8} {:>11} {:>8} {:>10} {:>9} {:>9} {:>10} {:>6}'.format(
+        u'engine', u'concurrency', u'handled', u'getinfo/s', u'p50 (s)', u'p95 (s)', u'in flight',
+        u'BGG/s'))
+    for r in results[u'runs']:
+        print(u'{:8} {:11} {:8} {:10.2f} {:9.2f} {:9.2f} {:10} {:6.0f}'.format(
+            r[u'engine'], r[u'concurrency'], r[u'handled'], r[u'throughput'] or 0, r[u'p50'] or 0,
+            r[u'p95'] or 0, r[u'peak_in_flight'], r[u'bgg_peak_rate']))
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument(u'--games', default=pjoin(HERE, u'games.json'),
+                    help=u'Games the made up ones are copied from.')
+    ap.add_argument(u'-n', u'--comments', type=int, default=256, help=u'getinfo comments. Default is 256.')
+    ap.add_argument(u'--names', type=int, default=2, help=u'Games named by each. Default is 2.')
+    ap.add_argument(u'-c', u'--concurrency', type=int, nargs=u'+', default=[4, 16, 64, 128],
+                    help=u'Levels of concurrency to run at. Default is 4 16 64 128.')
+    ap.add_argument(u'-e', u'--engines', nargs=u'+', default=[u'threads', u'event'],
+                    choices=[u'threads', u'event'], help=u'Engines to run. Default is both.')
+    ap.add_argument(u'-w', u'--workers', type=int, default=1, help=u'Lookup threads per getinfo.')
+    ap.add_argument(u'--bgg-latency', dest=u'bgg_latency', type=float, default=0.2,
+                    help=u'Seconds the fake BGG takes per request. Default is 0.2.')
+    ap.add_argument(u'--bgg-interval', dest=u'bgg_interval', type=float, default=0.005,
+                    help=u'The bot\'s BGG rate limit, as in artoodeeeight.py. Default is 0.005.')
+    ap.add_argument(u'--reddit-latency', dest=u'reddit_latency', type=float, default=0.1,
+                    help=u'Seconds the fake Reddit takes per inbox read or reply. Default is 0.1.')
+    ap.add_argument(u'--seed', type=int, default=1, help=u'Random seed for the names.')
+    ap.add_argument(u'--timeout', type=float, default=300, help=u'Give up on a run after this many seconds.')
+    ap.add_argument(u'-o', u'--output', default=u'concurrency-results.json', help=u'Where to save the results.')
+    addLoggingArgs(ap)
+    args = ap.parse_args()
+    handleLoggingArgs(args)
+
+    results = run(args)
+    show(results)
+    with open(args.output, u'w') as fd:
+        json.dump(results, fd, indent=1, sort_keys=True)
+    print(u'Results saved to {}'.format(args.output))
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+'''A local stand in for the BGG xmlapi2. It answers the search and thing calls the bot
+makes, in BGG's XML format, from the games in a JSON fixture file. Latency and an error
+rate can be injected. Can be run on its own or started in process with FakeBGG.'''
+
+import argparse
+import json
+import logging
+import random
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from time import time, sleep
+from urlparse import urlparse, parse_qs
+from xml.sax.saxutils import quoteattr, escape
+
+log = logging.getLogger(__name__)
+
+
+def _thingXML(game):
+    g = game
+    lines = [u'<item type={} id="{}">'.format(quoteattr(g.get(u'type', u'boardgame')), g[u'id'])]
+    lines.append(u'<thumbnail>{}</thumbnail>'.format(escape(g.get(u'image', u''))))
+    lines.append(u'<image>{}</image>'.format(escape(g.get(u'image', u''))))
+    lines.append(u'<name type="primary" sortindex="1" value={} />'.format(quoteattr(g[u'name'])))
+    for alt in g.get(u'alternates', []):
+        lines.append(u'<name type="alternate" sortindex="1" value={} />'.format(quoteattr(alt)))
+    lines.append(u'<description>{}</description>'.format(escape(g.get(u'description', u''))))
+    for tag, key in [(u'yearpublished', u'year'), (u'minplayers', u'min_players'),
+                     (u'maxplayers', u'max_players'), (u'playingtime', u'playing_time'),
+                     (u'minplaytime', u'playing_time'), (u'maxplaytime', u'playing_time'),
+                     (u'minage', u'min_age')]:
+        lines.append(u'<{} value="{}" />'.format(tag, g.get(key, 0)))
+    for designer in g.get(u'designers', []):
+        lines.append(u'<link type="boardgamedesigner" id="1" value={} />'.format(quoteattr(designer)))
+    for mechanic in g.get(u'mechanics', []):
+        lines.append(u'<link type="boardgamemechanic" id="1" value={} />'.format(quoteattr(mechanic)))
+    lines.append(u'<statistics page="1"><ratings>')
+    lines.append(u'<usersrated value="{}" />'.format(g.get(u'users_rated', 0)))
+    lines.append(u'<average value="{}" />'.format(g.get(u'rating_average', 0)))
+    lines.append(u'<bayesaverage value="{}" />'.format(g.get(u'rating_average', 0)))
+    lines.append(u'<ranks>')
+    for i, rank in enumerate(g.get(u'ranks', [])):
+        lines.append(u'<rank type="{}" id="{}" name="r{}" friendlyname={} value="{}" '
+                     u'bayesaverage="0" />'.format(u'subtype' if i == 0 else u'family', i + 1, i,
+                                                   quoteattr(rank[u'friendlyname']), rank[u'value']))
+    lines.append(u'</ranks>')
+    for tag in [u'stddev', u'median', u'trading', u'wanting', u'wishing', u'numcomments']:
+        lines.append(u'<{} value="0" />'.format(tag))
+    lines.append(u'<owned value="{}" />'.format(g.get(u'owned', 0)))
+    lines.append(u'<numweights value="{}" />'.format(g.get(u'rating_num_weights', 0)))
+    lines.append(u'<averageweight value="{}" />'.format(g.get(u'rating_average_weight', 0)))
+    lines.append(u'</ratings></statistics></item>')
+    return u'\n'.join(lines)
+
+
+class FakeBGG(ThreadingMixIn, HTTPServer):
+    '''Serves /xmlapi2/search and /xmlapi2/thing from a list of game dicts. Each request
+    waits latency seconds, give or take jitter, and fails with a 503 or 429 with
+    probability errorRate. fail() queues statuses to answer the next requests with. The url
+    of the API is in the api attribute.'''
+    daemon_threads = True
+
+    def __init__(self, games, port=0, latency=0.0, jitter=0.0, errorRate=0.0):
+        HTTPServer.__init__(self, (u'127.0.0.1', port), _Handler)
+        self.games = {int(g[u'id']): g for g in games}
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.api = u'http://127.0.0.1:{}/xmlapi2'.format(self.server_address[1])
+        self._lock = threading.Lock()
+        self.counts = {u'search': 0, u'thing': 0, u'errors': 0}
+        self.stamps = []
+        self._failures = []
+
+    def count(self, what):
+        with self._lock:
+            self.counts[what] += 1
+            self.stamps.append(time())
+
+    def fail(self, *statuses):
+        '''Answer the next requests with these statuses, one each, and no wait to retry.'''
+        with self._lock:
+            self._failures.extend(statuses)
+
+    def nextFailure(self):
+        with self._lock:
+            return self._failures.pop(0) if self._failures else None
+
+    def peakRate(self, window=1.0):
+        '''The most requests received in any window seconds, per second.'''
+        with self._lock:
+            stamps = sorted(self.stamps)
+        peak = start = 0
+        for end in xrange(len(stamps)):
+            while stamps[end] - stamps[start] > window:
+                start += 1
+            peak = max(peak, end - start + 1)
+        return peak / window
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever, name=u'fake-bgg')
+        t.daemon = True
+        t.start()
+        return self
+
+    def search(self, query, exact):
+        query = query.lower()
+        found = []
+        # like BGG, a boardgame search also finds expansions.
+        for g in self.games.values():
+            names = [n.lower() for n in [g[u'name']] + g.get(u'alternates', [])]
+            if (exact and query in names) or (not exact and any(query in n for n in names)):
+                found.append(g)
+
+        items = [u'<item type={} id="{}"><name type="primary" value={} />'
+                 u'<yearpublished value="{}" /></item>'.format(
+                     quoteattr(g.get(u'type', u'boardgame')), g[u'id'], quoteattr(g[u'name']),
+                     g.get(u'year', 0)) for g in found]
+        return u'<items total="{}" termsofuse="">{}</items>'.format(len(items), u''.join(items))
+
+    def things(self, ids):
+        items = [_thingXML(self.games[i]) for i in ids if i in self.games]
+        return u'<items termsofuse="">{}</items>'.format(u''.join(items))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).iteritems()}
+
+        delay = server.latency + random.uniform(-server.jitter, server.jitter)
+        if delay > 0:
+            sleep(delay)
+
+        status = server.nextFailure()
+        if status:
+            server.count(u'errors')
+            self.send_response(status)
+            self.send_header(u'Retry-After', u'0')
+            self.end_headers()
+            return
+
+        if random.random() < server.errorRate:
+            server.count(u'errors')
+            self.send_response(random.choice([429, 503]))
+            self.send_header(u'Retry-After', u'1')
+            self.end_headers()
+            return
+
+        if url.path.endswith(u'/search'):
+            server.count(u'search')
+            body = server.search(params.get(u'query', u'').decode('utf-8'),
+                                 params.get(u'exact') == u'1')
+        elif url.path.endswith(u'/thing'):
+            server.count(u'thing')
+            ids = [int(i) for i in params.get(u'id', u'').split(u',') if i.isdigit()]
+            body = server.things(ids)
+        else:
+            self.send_error(404)
+            return
+
+        body = u'<?xml version="1.0" encoding="utf-8"?>' + body
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header(u'Content-Type', u'text/xml; charset=utf-8')
+        self.send_header(u'Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument(u'-g', u'--games', default=u'games.json', help=u'JSON file of games to serve.')
+    ap.add_argument(u'-p', u'--port', type=int, default=8008)
+    ap.add_argument(u'--latency', type=float, default=0.0, help=u'Seconds per request.')
+    ap.add_argument(u'--error-rate', dest=u'error_rate', type=float, default=0.0,
+                    help=u'Fraction of requests that fail.')
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.DEBUG)
+
+    with open(args.games) as fd:
+        server = FakeBGG(json.load(fd), port=args.port, latency=args.latency,
+                         errorRate=args.error_rate)
+    print(u'Serving fake BGG at {}'.format(server.api))
+    server.serve_forever()
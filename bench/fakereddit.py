@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+'''A local stand in for the few parts of a PRAW Reddit session the bot uses: the inbox,
+get_info() and comments that can be replied to, edited and marked read. Replies and edits
+are timed so the latency of each command can be measured.'''
+
+import random
+import threading
+from time import time, sleep
+
+
+class FakeRateLimit(Exception):
+    '''Like praw.errors.RateLimitExceeded, says how long to wait.'''
+    def __init__(self, sleep_time):
+        super(FakeRateLimit, self).__init__(u'you are doing that too much')
+        self.sleep_time = sleep_time
+
+
+class FakeUser(object):
+    def __init__(self, reddit):
+        self._reddit = reddit
+
+    def mark_as_read(self, comments):
+        '''Mark comments read in one call, like PRAW's LoggedInRedditor.mark_as_read().'''
+        with self._reddit._lock:
+            self._reddit.markCalls += 1
+        for comment in comments:
+            self._reddit.mark_read(comment)
+
+
+class FakeAuthor(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeSubreddit(object):
+    def __init__(self, name):
+        self.display_name = name
+
+
+class FakeComment(object):
+    def __init__(self, reddit, thing_id, body, author, subreddit=u'boardgames', parent_id=None):
+        self.reddit_session = reddit
+        self.id = thing_id
+        self.body = body
+        self.author = FakeAuthor(author)
+        self.subreddit = FakeSubreddit(subreddit)
+        self.parent_id = parent_id
+        self.is_root = parent_id is None
+        self.arrived = None
+        self.answered = None
+        self.handled = None
+
+    def _answer(self):
+        if self.answered is None:
+            self.answered = time()
+
+    def reply(self, text):
+        self.reddit_session.throttle()
+        self._answer()
+        return self.reddit_session.add(None, text, self.reddit_session.botname, parent_id=self.id)
+
+    def edit(self, text):
+        self.reddit_session.throttle()
+        self.body = text
+        # repair edits the bot's comment, which is the answer to the repair request.
+        for c in self.reddit_session.inbox:
+            if c.parent_id == self.id:
+                c._answer()
+        return self
+
+    def mark_as_read(self):
+        with self.reddit_session._lock:
+            self.reddit_session.markCalls += 1
+        self.reddit_session.mark_read(self)
+
+
+class FakeReddit(object):
+    '''Holds every comment by id. Comments added to the inbox only show up in
+    get_mentions() and get_unread() once their arrival time has passed, and those added to
+    a stream show up in get_comments() for their subreddit the same way. A throttleRate
+    fraction of replies and edits fail with FakeRateLimit. Inbox reads, replies and edits
+    take latency seconds, as a call to Reddit would.'''
+    def __init__(self, botname, throttleRate=0.0, latency=0.0):
+        self.botname = botname
+        self.throttleRate = throttleRate
+        self.latency = latency
+        self.user = FakeUser(self)
+        self.things = {}
+        self.inbox = []
+        self.stream = []
+        self._read = set()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.markCalls = 0
+        self.throttled = 0
+
+    def throttle(self):
+        if self.latency:
+            sleep(self.latency)
+        if random.random() < self.throttleRate:
+            with self._lock:
+                self.throttled += 1
+            raise FakeRateLimit(0.05)
+
+    def add(self, thing_id, body, author, subreddit=u'boardgames', parent_id=None, arrive=None,
+            stream=False):
+        '''Add a comment. If arrive is given it is put in the inbox, or the subreddit stream
+        if stream is True, at that time. A thing_id of None gets a made up one.'''
+        with self._lock:
+            if thing_id is None:
+                thing_id = u'reply{}'.format(len(self.things))
+            comment = FakeComment(self, thing_id, body, author, subreddit, parent_id)
+            self.things[thing_id] = comment
+            if arrive is not None:
+                comment.arrived = arrive
+                comment.created_utc = arrive
+                (self.stream if stream else self.inbox).append(comment)
+            return comment
+
+    def mark_read(self, comment):
+        with self._lock:
+            self._read.add(comment.id)
+            comment.handled = time()
+
+    def _arrived(self):
+        if self.latency:
+            sleep(self.latency)
+        now = time()
+        with self._lock:
+            self.calls += 1
+            return sorted([c for c in self.inbox if c.arrived <= now], key=lambda c: -c.arrived)
+
+    def get_mentions(self, limit=None):
+        return self._arrived()[:limit]
+
+    def get_unread(self, limit=None):
+        return [c for c in self._arrived() if c.id not in self._read][:limit]
+
+    def get_comments(self, subreddit, limit=None):
+        '''The newest comments in subreddit, or several joined with "+".'''
+        now = time()
+        names = set(subreddit.lower().split(u'+'))
+        with self._lock:
+            self.calls += 1
+            comments = [c for c in self.stream
+                        if c.arrived <= now and c.subreddit.display_name.lower() in names]
+        return sorted(comments, key=lambda c: -c.arrived)[:limit]
+
+    def get_info(self, thing_id=None):
+        return self.things.get(thing_id)
+
+    def done(self):
+        '''True once every item in the inbox has been handled.'''
+        with self._lock:
+            return all(c.id in self._read for c in self.inbox)
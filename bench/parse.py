@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+'''Compares CommandParser with the regexes it replaced: time on ordinary and adversarial
+comment bodies, and agreement on randomly generated ones. tests/test_commandparser.py
+checks the agreement where it is expected.'''
+
+import argparse
+import random
+import re
+import sys
+import timeit
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from CommandParser import ParsedComment  # noqa: E402
+
+BOTNAME = u'r2d8'
+OLD_BOLD = re.compile(u'\\*\\*([\\w][\\w\\.\\s:\\-?$,!\'–&()\\[\\]]*[\\w\\.:\\-?$,!\'–&()\\[\\]])\\*\\*', re.UNICODE)
+OLD_PAIRS = re.compile(u'\\*\\*([^\\*]+)\\*\\*=\\*\\*([^\\*]+)\\*\\*')
+OLD_COMMANDS = re.compile(u'/?u/{}\\s(\\w+)'.format(BOTNAME), re.IGNORECASE)
+
+
+def old(body):
+    return ([c.lower() for c in OLD_COMMANDS.findall(body)], OLD_BOLD.findall(body),
+            OLD_PAIRS.findall(body))
+
+
+def new(body):
+    p = ParsedComment(body, BOTNAME)
+    return [c for c, a in p.commands], p.gameNames(), p.pairs
+
+
+def bodies(n):
+    ordinary = (u'/u/r2d8 getinfo short\n\nWe played **Scythe**, **Twilight Struggle** and '
+                u'**Terraforming Mars** last night. **Seven Wonders**=**7 Wonders** ')
+    return [
+        (u'ordinary', ordinary),
+        (u'long ordinary', ordinary * (n // len(ordinary) + 1)),
+        (u'unclosed bold', u'**' + u'a ' * (n // 2) + u'!'),
+        (u'many stars', u'**' * (n // 2) + u'a'),
+        (u'open, no close', u'**a' * (n // 3)),
+        (u'bold, no pair', (u'**a**=' * (n // 6)) + u'*'),
+    ]
+
+
+def fuzz(count, seed):
+    '''Random bodies made of the pieces that matter to the parsers. Returns the number on
+    which old and new agree and a few that they do not.'''
+    rnd = random.Random(seed)
+    pieces = [u'**', u'*', u'=', u' ', u'\n', u'Catan', u'a b', u'7', u'[x]', u'é', u'–',
+              u'u/r2d8 ', u'/u/r2d8 ', u'getinfo', u' short', u' long', u'repair']
+    same = 0
+    differ = []
+    for i in xrange(count):
+        body = u''.join(rnd.choice(pieces) for j in xrange(rnd.randint(0, 30)))
+        result = new(body)    # must not raise
+        if result == old(body):
+            same += 1
+        elif len(differ) < 5:
+            differ.append((body, old(body), result))
+    return same, differ
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument(u'-s', u'--size', type=int, default=20000, help=u'Characters in the long bodies.')
+    ap.add_argument(u'-n', u'--number', type=int, default=5, help=u'Runs per body.')
+    ap.add_argument(u'-f', u'--fuzz', type=int, default=20000, help=u'Random bodies to compare.')
+    ap.add_argument(u'--seed', type=int, default=1)
+    args = ap.parse_args()
+
+    print(u'{:16} {:>8} {:>12} {:>12}'.format(u'body', u'chars', u'regex (ms)', u'parser (ms)'))
+    for name, body in bodies(args.size):
+        o = timeit.timeit(lambda: old(body), number=args.number) * 1000 / args.number
+        p = timeit.timeit(lambda: new(body), number=args.number) * 1000 / args.number
+        print(u'{:16} {:8} {:12.2f} {:12.2f}'.format(name, len(body), o, p))
+
+    same, differ = fuzz(args.fuzz, args.seed)
+    print(u'Random bodies: {} of {} parsed the same as the regexes.'.format(same, args.fuzz))
+    for body, o, p in differ:
+        print(u'  {!r}\n    regex:  {}\n    parser: {}'.format(body, o, p))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+'''Micro-benchmark of the per reply cost of rendering game info, with and without the
+render cache.'''
+
+import argparse
+import sys
+import timeit
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from CommentHandler import CommentHandler  # noqa: E402
+
+
+class FakeGame(object):
+    '''Has the attributes the renderers use.'''
+    def __init__(self, game_id):
+        self.id = game_id
+        self.name = u'Game Number {}'.format(game_id)
+        self.year = 2016
+        self.designers = [u'Jamey Stegmaier', u'Someone Else']
+        self.min_players = 1
+        self.max_players = 5
+        self.playing_time = 115
+        self.image = u'https://cf.geekdo-images.com/images/pic{}.jpg'.format(game_id)
+        self.mechanics = [u'Area Control / Area Influence', u'Grid Movement', u'Variable Player Powers']
+        self.rating_average = 8.2
+        self.users_rated = 25000
+        self.rating_average_weight = 3.4
+        self.rating_num_weights = 1500
+        self.ranks = ((u'Board Game Rank', 7), (u'Strategy Game Rank', 5))
+        self.description = u'It is a time of unrest in 1920s Europa. ' * 60
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument(u'-n', u'--number', type=int, default=2000, help=u'Replies to render per mode.')
+    ap.add_argument(u'-g', u'--games', type=int, default=5, help=u'Games per reply.')
+    args = ap.parse_args()
+
+    ch = CommentHandler(u'r2d8', None, bgg=object())
+    games = [FakeGame(i) for i in xrange(args.games)]
+    modes = [(u'short', ch._getShortInfo, ch._getShortInfos),
+             (u'normal', ch._getStdInfo, ch._getStdInfos),
+             (u'long', ch._getLongInfo, ch._getLongInfos)]
+
+    print(u'{:8} {:>14} {:>14} {:>8}'.format(u'mode', u'uncached (us)', u'cached (us)', u'speedup'))
+    for mode, render, renderCached in modes:
+        uncached = timeit.timeit(lambda: [render(g) for g in games], number=args.number)
+        renderCached(games)  # warm the cache
+        cached = timeit.timeit(lambda: renderCached(games), number=args.number)
+        print(u'{:8} {:14.1f} {:14.1f} {:7.1f}x'.format(
+            mode, 1e6 * uncached / args.number, 1e6 * cached / args.number, uncached / cached))
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+'''Replay a corpus of comments through the bot, end to end, against a fake Reddit inbox
+and a fake BGG. Reports throughput, latency percentiles per command, BGG requests per
+command and cache hit rates, and saves them as JSON so runs can be compared.'''
+
+import argparse
+import json
+import logging
+import re
+import shutil
+import sys
+import threading
+from os.path import abspath, dirname, join as pjoin
+from tempfile import mkdtemp
+from time import time, sleep
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from argParseLog import addLoggingArgs, handleLoggingArgs  # noqa: E402
+from BGGClient import BGGClient  # noqa: E402
+from BotDatabase import BotDatabase  # noqa: E402
+from BotPipeline import BotPipeline  # noqa: E402
+from CommentHandler import CommentHandler  # noqa: E402
+from EventPipeline import EventPipeline  # noqa: E402
+from InboxPoller import InboxPoller  # noqa: E402
+from Profiler import profiler  # noqa: E402
+from ReplyQueue import ReplyQueue  # noqa: E402
+from fakebgg import FakeBGG  # noqa: E402
+from fakereddit import FakeReddit  # noqa: E402
+
+log = logging.getLogger(__name__)
+
+BOTNAME = u'r2d8'
+HERE = dirname(abspath(__file__))
+
+
+def percentile(values, p):
+    '''Nearest rank percentile of values, p in 0-100.'''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(round(p / 100.0 * len(values))) - 1)]
+
+
+def commandName(body):
+    '''The command and, for the info commands, the mode: "getinfo short" and so on.'''
+    m = re.search(u'/?u/{}\s(\w+)(\s(short|long))?'.format(BOTNAME), body, re.IGNORECASE)
+    if not m:
+        return u'none'
+    cmd = m.group(1).lower()
+    if cmd in [u'getinfo', u'getparentinfo']:
+        return u'{} {}'.format(cmd, m.group(3).lower() if m.group(3) else u'normal')
+    return cmd
+
+
+def load(reddit, corpus, passes, rate, start):
+    '''Add passes copies of the corpus to the fake reddit. Inbox comments arrive rate per
+    second from start, or all at once if rate is 0.'''
+    n = 0
+    for p in xrange(passes):
+        for c in corpus:
+            arrive = None
+            if c.get(u'inbox'):
+                arrive = start + (n / float(rate) if rate else 0)
+                n += 1
+            parent = u'{}-p{}'.format(c[u'parent'], p) if c.get(u'parent') else None
+            reddit.add(u'{}-p{}'.format(c[u'id'], p), c[u'body'], c[u'author'],
+                       subreddit=c.get(u'subreddit', u'boardgames'), parent_id=parent, arrive=arrive)
+
+
+def run(args):
+    with open(args.games) as fd:
+        server = FakeBGG(json.load(fd), latency=args.bgg_latency, jitter=args.bgg_latency / 2,
+                         errorRate=args.bgg_error_rate).start()
+    with open(args.corpus) as fd:
+        corpus = json.load(fd)
+
+    tmpdir = mkdtemp(prefix=u'r2d8-replay-')
+    try:
+        bdb = BotDatabase(pjoin(tmpdir, u'bot.db'))
+        bgg = BGGClient.sqlite(pjoin(tmpdir, u'bgg.db'), interval=args.bgg_interval,
+                               api=server.api, prefetchBudget=0, maxEntries=args.cache_max_entries,
+                               compactInterval=args.cache_compact_interval)
+        reddit = FakeReddit(BOTNAME, throttleRate=args.reddit_throttle_rate)
+        replies = ReplyQueue(reddit, bdb, interval=args.reply_interval, backoff=0.1, readInterval=0.5)
+        ch = CommentHandler(BOTNAME, bdb, workers=args.workers, bgg=bgg, probeWorkers=args.probe_workers,
+                            replyQueue=replies, progressDeadline=args.progress_deadline)
+
+        start = time() + 0.5
+        load(reddit, corpus, args.passes, args.rate, start)
+        if args.profile:
+            profiler.configure(path=args.profile_file, cprofile=args.profile_cprofile)
+            profiler.start(args.profile)
+
+        poller = InboxPoller(reddit, bdb, minInterval=0.01, maxInterval=0.1, markRead=replies.markRead)
+        if args.engine == u'event':
+            pipeline = EventPipeline(reddit, bdb, BOTNAME, ch.commands(), concurrency=args.concurrency,
+                                     timeout=args.timeout, poller=poller, replyQueue=replies)
+        else:
+            pipeline = BotPipeline(reddit, bdb, BOTNAME, ch.commands(), workers=args.command_workers,
+                                   timeout=args.timeout, poller=poller, replyQueue=replies)
+        t = threading.Thread(target=pipeline.run, name=u'pipeline')
+        t.start()
+        deadline = time() + args.timeout
+        while not reddit.done() and time() < deadline:
+            sleep(0.05)
+        pipeline.stop()
+        t.join()
+        elapsed = time() - start
+
+        return report(args, reddit, server, ch, elapsed)
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def report(args, reddit, server, ch, elapsed):
+    latencies = {}
+    unhandled = 0
+    for c in reddit.inbox:
+        finished = c.answered or c.handled
+        if finished is None:
+            unhandled += 1
+            continue
+        latencies.setdefault(commandName(c.body), []).append(finished - c.arrived)
+
+    handled = sum(len(v) for v in latencies.values())
+    bggRequests = server.counts[u'search'] + server.counts[u'thing'] + server.counts[u'errors']
+    results = {
+        u'config': {k: v for k, v in vars(args).iteritems() if k != u'output'},
+        u'elapsed': elapsed,
+        u'handled': handled,
+        u'unhandled': unhandled,
+        u'throughput': handled / elapsed if elapsed else None,
+        u'commands': {},
+        u'bgg': dict(server.counts, total=bggRequests,
+                     per_command=bggRequests / float(handled) if handled else None),
+        u'reddit_inbox_calls': reddit.calls,
+        u'reddit_mark_read_calls': reddit.markCalls,
+        u'reddit_throttled': reddit.throttled,
+        u'caches': ch.cacheStats()
+    }
+    for cmd, values in sorted(latencies.iteritems()):
+        results[u'commands'][cmd] = {
+            u'count': len(values),
+            u'mean': sum(values) / len(values),
+            u'p50': percentile(values, 50),
+            u'p95': percentile(values, 95),
+            u'p99': percentile(values, 99)
+        }
+
+    return results
+
+
+def show(results):
+    print(u'Handled {} commands in {:.2f}s: {:.2f} commands/s. {} unhandled.'.format(
+        results[u'handled'], results[u'elapsed'], results[u'throughput'], results[u'unhandled']))
+    print(u'{:22} {:>6} {:>9} {:>9} {:>9}'.format(u'command', u'count', u'p50 (s)', u'p95 (s)', u'p99 (s)'))
+    for cmd, r in sorted(results[u'commands'].iteritems()):
+        print(u'{:22} {:6} {:9.3f} {:9.3f} {:9.3f}'.format(cmd, r[u'count'], r[u'p50'], r[u'p95'], r[u'p99']))
+    bgg = results[u'bgg']
+    print(u'BGG requests: {} ({} search, {} thing, {} errors), {:.2f} per command.'.format(
+        bgg[u'total'], bgg[u'search'], bgg[u'thing'], bgg[u'errors'], bgg[u'per_command'] or 0))
+    caches = results[u'caches']
+    print(u'Caches: games {game_hits}/{game_misses} hit/miss, things {thing_hits}/{thing_misses}'.format(
+        **caches[u'bgg']))
+    print(u'        resolutions {hits}/{misses} hit/miss'.format(**caches[u'resolutions']))
+    print(u'        render {}/{} hit/miss'.format(caches[u'render_hits'], caches[u'render_misses']))
+    print(u'        http {hits}/{misses} hit/miss, {entries} entries, {evicted} evicted'.format(
+        **caches[u'http']))
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument(u'--corpus', default=pjoin(HERE, u'corpus.json'), help=u'Comments to replay.')
+    ap.add_argument(u'--games', default=pjoin(HERE, u'games.json'), help=u'Games the fake BGG knows.')
+    ap.add_argument(u'-p', u'--passes', type=int, default=3,
+                    help=u'Times to replay the corpus. Later passes run against warm caches.')
+    ap.add_argument(u'-r', u'--rate', type=float, default=0,
+                    help=u'Comments arriving per second. 0, the default, delivers them all at once.')
+    ap.add_argument(u'-w', u'--workers', type=int, default=1, help=u'Lookup threads per getinfo.')
+    ap.add_argument(u'--probe-workers', dest=u'probe_workers', type=int, default=0,
+                    help=u'Threads probing name variants concurrently. Default is 0.')
+    ap.add_argument(u'-c', u'--command-workers', dest=u'command_workers', type=int, default=1,
+                    help=u'Command worker threads.')
+    ap.add_argument(u'--engine', choices=[u'threads', u'event'], default=u'threads',
+                    help=u'Run commands on worker threads (the default) or the event loop.')
+    ap.add_argument(u'--concurrency', type=int, default=16,
+                    help=u'Most commands in flight with --engine event. Default is 16.')
+    ap.add_argument(u'--bgg-latency', dest=u'bgg_latency', type=float, default=0.05,
+                    help=u'Seconds the fake BGG takes per request. Default is 0.05.')
+    ap.add_argument(u'--bgg-error-rate', dest=u'bgg_error_rate', type=float, default=0.0,
+                    help=u'Fraction of fake BGG requests that fail with 429 or 503.')
+    ap.add_argument(u'--bgg-interval', dest=u'bgg_interval', type=float, default=0.01,
+                    help=u'The bot\'s BGG rate limit, as in artoodeeeight.py. Default is 0.01.')
+    ap.add_argument(u'--progress-deadline', dest=u'progress_deadline', type=float,
+                    help=u'Seconds before a getinfo replies with what it has found so far.')
+    ap.add_argument(u'--reply-interval', dest=u'reply_interval', type=float, default=0.0,
+                    help=u'Seconds between replies sent to the fake Reddit. Default is 0.')
+    ap.add_argument(u'--reddit-throttle-rate', dest=u'reddit_throttle_rate', type=float, default=0.0,
+                    help=u'Fraction of replies and edits the fake Reddit rate limits.')
+    ap.add_argument(u'--cache-max-entries', dest=u'cache_max_entries', type=int, default=100000,
+                    help=u'Most responses kept in the BGG cache. Default is 100000.')
+    ap.add_argument(u'--cache-compact-interval', dest=u'cache_compact_interval', type=float,
+                    default=600, help=u'Seconds between BGG cache compactions. Default is 600.')
+    ap.add_argument(u'--profile', type=int, default=0,
+                    help=u'Profile the first PROFILE commands and log the summary.')
+    ap.add_argument(u'--profile-file', dest=u'profile_file', default=u'replay-profile.jsonl',
+                    help=u'Where to write the profile. Default is replay-profile.jsonl.')
+    ap.add_argument(u'--profile-cprofile', dest=u'profile_cprofile', action=u'store_true',
+                    help=u'Also profile with cProfile.')
+    ap.add_argument(u'--timeout', type=float, default=600, help=u'Give up after this many seconds.')
+    ap.add_argument(u'-o', u'--output', default=u'replay-results.json', help=u'Where to save the results.')
+    addLoggingArgs(ap)
+    args = ap.parse_args()
+    handleLoggingArgs(args)
+
+    results = run(args)
+    show(results)
+    with open(args.output, u'w') as fd:
+        json.dump(results, fd, indent=1, sort_keys=True)
+    print(u'Results saved to {}'.format(args.output))
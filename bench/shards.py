@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+'''Run several bot worker processes under the Supervisor against one fake BGG, sharing the
+bot database, the BGG cache and, unless told otherwise, the BGG rate limit. Every worker
+sees the whole corpus in its own fake inbox, as every process of the real bot sees the
+one inbox, so each comment is answered once only if the claims work. Reports comments
+answered more than once, BGG requests in total and the peak BGG request rate.'''
+
+import argparse
+import glob
+import json
+import logging
+import os
+import shutil
+import signal
+import sqlite3
+import sys
+import threading
+from os.path import abspath, dirname, join as pjoin
+from tempfile import mkdtemp
+from time import time, sleep
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from argParseLog import addLoggingArgs, handleLoggingArgs  # noqa: E402
+from BotDatabase import BotDatabase  # noqa: E402
+from Supervisor import Supervisor  # noqa: E402
+from fakebgg import FakeBGG  # noqa: E402
+from replay import BOTNAME, HERE, load  # noqa: E402
+
+log = logging.getLogger(__name__)
+
+
+def work(args):
+    '''One worker process. Runs until SIGTERM, then saves what it answered.'''
+    from BGGClient import BGGClient
+    from BotPipeline import BotPipeline
+    from CommentHandler import CommentHandler
+    from InboxPoller import InboxPoller
+    from ReplyQueue import ReplyQueue
+    from fakereddit import FakeReddit
+
+    with open(args.corpus) as fd:
+        corpus = json.load(fd)
+
+    name = u'worker-{}'.format(args.worker)
+    bdb = BotDatabase(pjoin(args.dir, u'bot.db'), worker=name, claim_expiry=args.claim_expiry)
+    bgg = BGGClient.sqlite(pjoin(args.dir, u'bgg.db'), sharedRate=args.shared_rate,
+                           interval=args.bgg_interval, api=args.api, prefetchBudget=0,
+                           compact=not args.worker)
+    reddit = FakeReddit(BOTNAME)
+    load(reddit, corpus, args.passes, args.rate, args.start)
+    replies = ReplyQueue(reddit, bdb, interval=0, backoff=0.1, readInterval=0.5)
+    ch = CommentHandler(BOTNAME, bdb, bgg=bgg, replyQueue=replies)
+    poller = InboxPoller(reddit, bdb, minInterval=0.05, maxInterval=0.2, markRead=replies.markRead)
+    pipeline = BotPipeline(reddit, bdb, BOTNAME, ch.commands(), poller=poller, replyQueue=replies)
+    signal.signal(signal.SIGTERM, pipeline.stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pipeline.run()
+
+    with open(pjoin(args.dir, u'{}-{}.json'.format(name, os.getpid())), u'w') as fd:
+        json.dump({u'worker': name, u'answered': [c.id for c in reddit.inbox if c.answered],
+                   u'bgg': bgg.stats()}, fd)
+    # skip the interpreter tearing down modules under the daemon threads.
+    os._exit(0)
+
+
+def handled(path):
+    connection = sqlite3.connect(path, timeout=30)
+    try:
+        return connection.execute(u'SELECT COUNT(*) FROM comments').fetchone()[0]
+    finally:
+        connection.close()
+
+
+def run(args):
+    with open(args.games) as fd:
+        server = FakeBGG(json.load(fd), latency=args.bgg_latency, jitter=args.bgg_latency / 2).start()
+    with open(args.corpus) as fd:
+        expected = args.passes * len([c for c in json.load(fd) if c.get(u'inbox')])
+
+    tmpdir = mkdtemp(prefix=u'r2d8-shards-')
+    try:
+        dbpath = pjoin(tmpdir, u'bot.db')
+        BotDatabase(dbpath)
+        # give the workers time to start before the first comment arrives.
+        start = time() + 2
+        command = [sys.executable, abspath(__file__), u'--dir', tmpdir, u'--api', server.api,
+                   u'--start', repr(start), u'--corpus', args.corpus, u'--passes', unicode(args.passes),
+                   u'--rate', unicode(args.rate), u'--bgg-interval', unicode(args.bgg_interval),
+                   u'--claim-expiry', unicode(args.claim_expiry), u'-l', args.loglevel]
+        if not args.shared_rate:
+            command.append(u'--no-shared-rate')
+        supervisor = Supervisor([command + [u'--worker', unicode(i)] for i in xrange(args.processes)],
+                                delay=0.2, stableAfter=5, stopTimeout=args.timeout)
+        t = threading.Thread(target=supervisor.run, name=u'supervisor')
+        t.start()
+
+        killed = False
+        deadline = time() + args.timeout
+        while handled(dbpath) < expected and time() < deadline:
+            if args.kill and not killed and time() > start + args.kill:
+                pid = supervisor.pids()[0]
+                if pid:
+                    log.info(u'Killing worker 0, pid {}.'.format(pid))
+                    os.kill(pid, signal.SIGKILL)
+                    killed = True
+            sleep(0.1)
+        elapsed = time() - start
+        count = handled(dbpath)
+        supervisor.stop()
+        t.join()
+
+        answered = {}
+        workers = {}
+        for path in glob.glob(pjoin(tmpdir, u'worker-*.json')):
+            with open(path) as fd:
+                result = json.load(fd)
+            workers.setdefault(result[u'worker'], 0)
+            workers[result[u'worker']] += len(result[u'answered'])
+            for cid in result[u'answered']:
+                answered[cid] = answered.get(cid, 0) + 1
+
+        bggRequests = server.counts[u'search'] + server.counts[u'thing'] + server.counts[u'errors']
+        return {
+            u'config': {k: v for k, v in vars(args).iteritems() if k != u'output'},
+            u'elapsed': elapsed,
+            u'handled': count,
+            u'expected': expected,
+            u'answered_by_worker': workers,
+            u'answered_twice': sorted([cid for cid, n in answered.iteritems() if n > 1]),
+            u'restarts': supervisor.restarts,
+            u'bgg': dict(server.counts, total=bggRequests, peak_rate=server.peakRate(),
+                         budget=1.0 / args.bgg_interval)
+        }
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def show(results):
+    print(u'{} processes handled {} of {} comments in {:.2f}s. {} restarts.'.format(
+        results[u'config'][u'processes'], results[u'handled'], results[u'expected'],
+        results[u'elapsed'], results[u'restarts']))
+    print(u'Answered per worker: {}'.format(u', '.join(
+        u'{} {}'.format(w, n) for w, n in sorted(results[u'answered_by_worker'].iteritems()))))
+    print(u'Answered more than once: {}'.format(len(results[u'answered_twice'])))
+    bgg = results[u'bgg']
+    print(u'BGG requests: {} ({} search, {} thing). Peak {:.1f}/s against a budget of {:.1f}/s.'.format(
+        bgg[u'total'], bgg[u'search'], bgg[u'thing'], bgg[u'peak_rate'], bgg[u'budget']))
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument(u'--corpus', default=pjoin(HERE, u'corpus.json'), help=u'Comments to replay.')
+    ap.add_argument(u'--games', default=pjoin(HERE, u'games.json'), help=u'Games the fake BGG knows.')
+    ap.add_argument(u'-n', u'--processes', type=int, default=4, help=u'Worker processes. Default is 4.')
+    ap.add_argument(u'-p', u'--passes', type=int, default=3, help=u'Times to replay the corpus.')
+    ap.add_argument(u'-r', u'--rate', type=float, default=0,
+                    help=u'Comments arriving per second. 0, the default, delivers them all at once.')
+    ap.add_argument(u'--bgg-latency', dest=u'bgg_latency', type=float, default=0.05,
+                    help=u'Seconds the fake BGG takes per request. Default is 0.05.')
+    ap.add_argument(u'--bgg-interval', dest=u'bgg_interval', type=float, default=0.1,
+                    help=u'The BGG rate limit, as in artoodeeeight.py. Default is 0.1.')
+    ap.add_argument(u'--no-shared-rate', dest=u'shared_rate', action=u'store_false',
+                    help=u'Give each worker its own BGG rate limit instead of one for all.')
+    ap.add_argument(u'--claim-expiry', dest=u'claim_expiry', type=float, default=10,
+                    help=u'Seconds before a claimed but unhandled comment can be taken over.')
+    ap.add_argument(u'--kill', type=float,
+                    help=u'Kill worker 0 this many seconds in, to see it restarted.')
+    ap.add_argument(u'--timeout', type=float, default=120, help=u'Give up after this many seconds.')
+    ap.add_argument(u'-o', u'--output', default=u'shards-results.json', help=u'Where to save the results.')
+    # for the worker processes.
+    ap.add_argument(u'--worker', type=int, help=argparse.SUPPRESS)
+    ap.add_argument(u'--dir', help=argparse.SUPPRESS)
+    ap.add_argument(u'--api', help=argparse.SUPPRESS)
+    ap.add_argument(u'--start', type=float, help=argparse.SUPPRESS)
+    addLoggingArgs(ap)
+    args = ap.parse_args()
+    handleLoggingArgs(args)
+
+    if args.worker is not None:
+        work(args)
+
+    results = run(args)
+    show(results)
+    with open(args.output, u'w') as fd:
+        json.dump(results, fd, indent=1, sort_keys=True)
+    print(u'Results saved to {}'.format(args.output))
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+'''Run the StreamScanner over made up comment streams of a few subreddits against a fake
+Reddit and a fake BGG. Most comments bold nothing, some bold things that are not games,
+some bold games the bot knows and some summon the bot, which the scanner must leave to
+the inbox. Reports how fast the filter throws comments out, the counts for each
+subreddit, comments answered that should not have been and, with a small --queue-size or
+a slow BGG, how many were dropped to keep up.'''
+
+import argparse
+import json
+import logging
+import random
+import shutil
+import sys
+from os.path import abspath, dirname, join as pjoin
+from tempfile import mkdtemp
+from time import time, sleep
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from argParseLog import addLoggingArgs, handleLoggingArgs  # noqa: E402
+from BGGClient import BGGClient  # noqa: E402
+from BotDatabase import BotDatabase  # noqa: E402
+from CommentHandler import CommentHandler  # noqa: E402
+from ReplyQueue import ReplyQueue  # noqa: E402
+from StreamScanner import StreamScanner  # noqa: E402
+from fakebgg import FakeBGG  # noqa: E402
+from fakereddit import FakeReddit  # noqa: E402
+from replay import BOTNAME, HERE  # noqa: E402
+
+log = logging.getLogger(__name__)
+
+WORDS = (u'the a game table play turn card dice board group friends night rules box expansion '
+         u'worker meeple engine luck strategy theme art solo coop').split()
+
+
+def sentence(n=12):
+    return u' '.join(random.choice(WORDS) for _ in xrange(n))
+
+
+def makeComment(kind, names):
+    '''Body of a made up comment of the given kind.'''
+    if kind == u'plain':
+        return sentence()
+    if kind == u'bold':
+        return u'{} **{}** {}'.format(sentence(6), sentence(2), sentence(6))
+    if kind == u'game':
+        return u'{} **{}** {}'.format(sentence(6), random.choice(names), sentence(6))
+    # summons the bot, so is the inbox's to answer.
+    return u'/u/{} getinfo **{}**'.format(BOTNAME, random.choice(names))
+
+
+def load(reddit, args, names, start):
+    '''Add args.comments comments spread over the subreddits, arriving args.rate per second.
+    Returns {comment id: kind}.'''
+    weights = [(u'plain', args.plain), (u'bold', args.bold), (u'game', args.game),
+               (u'mention', args.mention)]
+    kinds = {}
+    for i in xrange(args.comments):
+        r = random.random() * sum(w for k, w in weights)
+        kind = next(k for k, w in _cumulative(weights) if r < w)
+        cid = u's{}'.format(i)
+        reddit.add(cid, makeComment(kind, names), u'user{}'.format(i % 50),
+                   subreddit=random.choice(args.subreddits), arrive=start + i / float(args.rate), stream=True)
+        kinds[cid] = kind
+    return kinds
+
+
+def _cumulative(weights):
+    total = 0
+    for k, w in weights:
+        total += w
+        yield k, total
+
+
+def filterSpeed(scanner, reddit):
+    '''Comments per second the filter gets through, on its own.'''
+    start = time()
+    for comment in reddit.stream:
+        scanner.candidateNames(comment)
+    return len(reddit.stream) / (time() - start)
+
+
+def run(args):
+    random.seed(args.seed)
+    with open(args.games) as fd:
+        games = json.load(fd)
+    server = FakeBGG(games, latency=args.bgg_latency, jitter=args.bgg_latency / 2).start()
+
+    tmpdir = mkdtemp(prefix=u'r2d8-stream-')
+    try:
+        bdb = BotDatabase(pjoin(tmpdir, u'bot.db'))
+        # the names the bot has been asked about before.
+        for game in games:
+            bdb.add_resolution(game[u'name'], game[u'id'], u'exact')
+        names = [g[u'name'] for g in games]
+        bgg = BGGClient.sqlite(pjoin(tmpdir, u'bgg.db'), interval=args.bgg_interval,
+                               api=server.api, prefetchBudget=0)
+        reddit = FakeReddit(BOTNAME)
+        replies = ReplyQueue(reddit, bdb, interval=0, backoff=0.1, readInterval=0.5)
+        ch = CommentHandler(BOTNAME, bdb, bgg=bgg, replyQueue=replies)
+        scanner = StreamScanner(reddit, bdb, BOTNAME, [u'+'.join(args.subreddits)] if args.multi
+                                else args.subreddits, ch.streamInfo, interval=args.interval,
+                                maxInterval=args.interval * 8, limit=args.limit,
+                                queueSize=args.queue_size, workers=args.stream_workers)
+
+        start = time() + 0.5
+        kinds = load(reddit, args, names, start)
+        # every comment has arrived by then.
+        sleep(0.6)
+        speed = filterSpeed(scanner, reddit)
+        reddit.stream = []
+
+        start = time() + 0.5
+        kinds = load(reddit, args, names, start)
+        scanner.start()
+        end = start + args.comments / float(args.rate)
+        while time() < end + args.drain:
+            sleep(0.1)
+        scanner.stop()
+        elapsed = time() - start
+
+        answered = [c for c in reddit.stream if c.answered]
+        wrong = [c.id for c in answered if kinds[c.id] != u'game']
+        stats = scanner.stats()
+        return {
+            u'config': {k: v for k, v in vars(args).iteritems() if k != u'output'},
+            u'elapsed': elapsed,
+            u'filter_per_second': speed,
+            u'comments': len(kinds),
+            u'naming_games': sum(1 for k in kinds.itervalues() if k == u'game'),
+            u'answered': len(answered),
+            u'answered_wrongly': wrong,
+            u'subreddits': stats,
+            u'totals': {k: sum(s[k] for s in stats.itervalues())
+                        for k in [u'seen', u'candidates', u'answered', u'dropped']},
+            u'bgg': server.counts
+        }
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def show(results):
+    print(u'Filter: {:.0f} comments/s.'.format(results[u'filter_per_second']))
+    print(u'{} comments in {:.2f}s, {} naming known games. {} answered, {} of them wrongly.'.format(
+        results[u'comments'], results[u'elapsed'], results[u'naming_games'], results[u'answered'],
+        len(results[u'answered_wrongly'])))
+    print(u'{:24} {:>7} {:>8} {:>11} {:>9} {:>8}'.format(
+        u'subreddit', u'seen', u'seen/s', u'candidates', u'answered', u'dropped'))
+    for sub, s in sorted(results[u'subreddits'].iteritems()):
+        print(u'{:24} {:7} {:8.1f} {:11} {:9} {:8}'.format(
+            sub, s[u'seen'], s[u'seen_per_second'], s[u'candidates'], s[u'answered'], s[u'dropped']))
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument(u'--games', default=pjoin(HERE, u'games.json'), help=u'Games the fake BGG knows.')
+    ap.add_argument(u'-s', u'--subreddits', nargs=u'+', default=[u'boardgames', u'tabletop', u'soloboardgaming'],
+                    help=u'Subreddits to make streams for.')
+    ap.add_argument(u'--multi', action=u'store_true',
+                    help=u'Read the subreddits as one "a+b" stream, as Reddit allows.')
+    ap.add_argument(u'-n', u'--comments', type=int, default=2000, help=u'Comments in all. Default is 2000.')
+    ap.add_argument(u'-r', u'--rate', type=float, default=200,
+                    help=u'Comments arriving per second, over all subreddits. Default is 200.')
+    ap.add_argument(u'--plain', type=float, default=0.8, help=u'Share of comments bolding nothing.')
+    ap.add_argument(u'--bold', type=float, default=0.12, help=u'Share bolding something not a game.')
+    ap.add_argument(u'--game', type=float, default=0.05, help=u'Share bolding a known game.')
+    ap.add_argument(u'--mention', type=float, default=0.03, help=u'Share summoning the bot.')
+    ap.add_argument(u'--interval', type=float, default=0.2, help=u'Seconds between reads of the streams.')
+    ap.add_argument(u'--limit', type=int, default=100, help=u'Comments per read. Default is 100.')
+    ap.add_argument(u'--queue-size', dest=u'queue_size', type=int, default=50,
+                    help=u'Stream comments waiting to be answered. Default is 50.')
+    ap.add_argument(u'--stream-workers', dest=u'stream_workers', type=int, default=1,
+                    help=u'Threads answering stream comments. Default is 1.')
+    ap.add_argument(u'--bgg-latency', dest=u'bgg_latency', type=float, default=0.05,
+                    help=u'Seconds the fake BGG takes per request. Default is 0.05.')
+    ap.add_argument(u'--bgg-interval', dest=u'bgg_interval', type=float, default=0.01,
+                    help=u'The bot\'s BGG rate limit, as in artoodeeeight.py. Default is 0.01.')
+    ap.add_argument(u'--drain', type=float, default=5,
+                    help=u'Seconds to keep going after the last comment arrives. Default is 5.')
+    ap.add_argument(u'--seed', type=int, default=1, help=u'Random seed for the comments.')
+    ap.add_argument(u'-o', u'--output', default=u'stream-results.json', help=u'Where to save the results.')
+    addLoggingArgs(ap)
+    args = ap.parse_args()
+    handleLoggingArgs(args)
+
+    results = run(args)
+    show(results)
+    with open(args.output, u'w') as fd:
+        json.dump(results, fd, indent=1, sort_keys=True)
+    print(u'Results saved to {}'.format(args.output))
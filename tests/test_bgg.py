@@ -0,0 +1,200 @@
+import json
+import shutil
+import sys
+import unittest
+from os.path import abspath, dirname, join as pjoin
+from tempfile import mkdtemp
+from time import time
+
+HERE = dirname(abspath(__file__))
+sys.path.insert(0, dirname(HERE))
+sys.path.insert(0, pjoin(dirname(HERE), u'bench'))
+
+from BGGClient import BGGClient, RateLimiter  # noqa: E402
+from BotDatabase import BotDatabase  # noqa: E402
+from CommentHandler import CommentHandler  # noqa: E402
+from fakebgg import FakeBGG  # noqa: E402
+
+with open(pjoin(dirname(HERE), u'bench', u'games.json')) as fd:
+    GAMES = json.load(fd)
+IDS = [g[u'id'] for g in GAMES]
+
+
+class BGGTest(unittest.TestCase):
+    latency = 0.0
+
+    def setUp(self):
+        self.server = FakeBGG(GAMES, latency=self.latency).start()
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def client(self, interval=0.01, **kwargs):
+        kwargs.setdefault(u'prefetchBudget', 0)
+        return BGGClient.sqlite(pjoin(self.dir, u'bgg.db'), interval=interval,
+                                api=self.server.api, **kwargs)
+
+
+class RetryTest(BGGTest):
+    def test_retries(self):
+        bgg = self.client()
+        self.server.fail(202, 429, 503)
+        things = bgg.things([IDS[0]])
+        self.assertEqual([IDS[0]], [t.id for t in things])
+        self.assertEqual(3, self.server.counts[u'errors'])
+        stats = bgg.stats()
+        self.assertEqual(4, stats[u'requests'])
+        self.assertEqual(3, stats[u'errors'])
+
+    def test_gives_up(self):
+        bgg = self.client(retries=1)
+        self.server.fail(503, 503)
+        with self.assertRaises(Exception):
+            bgg.things([IDS[0]])
+        self.assertEqual(2, self.server.counts[u'errors'])
+
+    def test_slows_down_and_recovers(self):
+        bgg = self.client()
+        maxRate = bgg.stats()[u'rate']
+        self.server.fail(429)
+        bgg.things([IDS[0]])
+        # halved by the 429, nudged back up by the success after it.
+        self.assertLess(bgg.stats()[u'rate'], maxRate)
+
+        for i in IDS[1:12]:
+            bgg.things([i])
+        self.assertEqual(maxRate, bgg.stats()[u'rate'])
+
+    def test_no_limit(self):
+        bgg = self.client(interval=0)
+        self.assertIsNone(bgg.stats()[u'rate'])
+        self.server.fail(429)
+        self.assertEqual(3, len(bgg.things(IDS[:3])))
+        self.assertIsNone(bgg.stats()[u'rate'])
+
+        limiter = RateLimiter(None)
+        start = time()
+        for _ in xrange(100):
+            limiter.wait()
+        self.assertLess(time() - start, 0.5)
+
+
+class StoreTest(BGGTest):
+    def requests(self):
+        return self.server.counts[u'search'] + self.server.counts[u'thing']
+
+    def test_refresh_survives_a_restart(self):
+        name = GAMES[0][u'name']
+        bgg = self.client()
+        # as the background refresh does, past the requests cache.
+        bgg._fetch((name, None), fresh=True)
+        bgg._fetch((None, IDS[1]), fresh=True)
+        before = self.requests()
+
+        bgg = self.client()
+        self.assertEqual(IDS[0], bgg.game(name).id)
+        self.assertEqual(IDS[1], bgg.game(game_id=IDS[1]).id)
+        self.assertEqual(before, self.requests())
+
+    def test_games_fresh_in_the_store_are_not_prefetched(self):
+        self.client().game(game_id=IDS[0])
+        bgg = self.client(popular=lambda count: IDS[:2], prefetchBudget=20)
+        queued = []
+        bgg._refresh = queued.append
+        bgg._prefetch()
+        self.assertEqual([(None, IDS[1])], queued)
+
+
+class Item(object):
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+class SearchBGG(object):
+    '''Finds the given items in a sloppy search, and nothing in an exact one. Things come
+    from client. Keeps the ids of the games asked for.'''
+    def __init__(self, client, items):
+        self.client = client
+        self.items = items
+        self.asked = []
+
+    def search(self, name, search_type=None, exact=False):
+        return [] if exact else self.items
+
+    def things(self, ids):
+        return self.client.things(ids)
+
+    def game(self, name=None, game_id=None):
+        self.asked.append(game_id)
+        return game_id
+
+
+class SearchTest(BGGTest):
+    # 45 games, so 3 requests of 20. The most owned is an expansion, and 1030 and 1005
+    # tie after it.
+    QUESTS = [{u'id': 1000 + i, u'name': u'Quest {}'.format(i), u'owned': i} for i in xrange(45)]
+    QUESTS[40].update(type=u'boardgameexpansion', owned=10 ** 6)
+    QUESTS[5][u'owned'] = QUESTS[30][u'owned'] = 500
+
+    def setUp(self):
+        self.server = FakeBGG(self.QUESTS).start()
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+
+    def test_things_in_chunks(self):
+        bgg = self.client()
+        ids = [q[u'id'] for q in self.QUESTS]
+        self.assertEqual(ids, [t.id for t in bgg.things(ids)])
+        self.assertEqual(3, self.server.counts[u'thing'])
+
+        # known ones are not asked for again, and unknown ones are left out.
+        self.assertEqual(ids[:5], [t.id for t in bgg.things(ids[:5] + [5000])])
+        self.assertEqual(4, self.server.counts[u'thing'])
+        self.assertEqual(ids[::-1], [t.id for t in bgg.things(ids[::-1])])
+        self.assertEqual(4, self.server.counts[u'thing'])
+
+    def test_most_owned_game_is_chosen(self):
+        # in search order, not id order, so the first of the tie is 1030.
+        items = [Item(q[u'id'], q[u'name']) for q in self.QUESTS[25:] + self.QUESTS[:25]]
+        bgg = SearchBGG(self.client(), items)
+        handler = CommentHandler(u'r2d8', BotDatabase(pjoin(self.dir, u'bot.db')), bgg=bgg)
+        self.assertEqual(1030, handler._bggSearchGame(u'quest'))
+        self.assertEqual([1030], bgg.asked)
+        self.assertEqual(3, self.server.counts[u'thing'])
+
+        bgg.items = items[::-1]
+        self.assertEqual(1005, handler._bggSearchGame(u'quest'))
+        self.assertEqual(3, self.server.counts[u'thing'])
+
+
+class Comment(object):
+    def __init__(self, id):
+        self.id = id
+        self.body = u''
+
+
+class ConcurrencyTest(BGGTest):
+    latency = 0.2
+
+    def lookup(self, handler, names):
+        start = time()
+        response, mode, games, not_found = handler._getInfoResponseBody(
+            Comment(u'c1'), names=names)
+        self.assertEqual(sorted(names), sorted(g.name for g in games))
+        return time() - start
+
+    def test_lookups_overlap(self):
+        names = [g[u'name'] for g in GAMES[:5]]
+        handler = CommentHandler(u'r2d8', BotDatabase(pjoin(self.dir, u'bot.db')), workers=4,
+                                 bgg=self.client(interval=0))
+        one = self.lookup(handler, names[:1])
+        # each name is new, so every lookup waits on the slow BGG.
+        four = self.lookup(handler, names[1:])
+        self.assertLess(four, 2 * one)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import shutil
+import sys
+import unittest
+from os.path import abspath, dirname, join as pjoin
+from tempfile import mkdtemp
+from time import sleep
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from BotDatabase import BotDatabase  # noqa: E402
+
+
+class Comment(object):
+    def __init__(self, id):
+        self.id = id
+
+
+class ClaimTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+        self.path = pjoin(self.dir, u'bot.db')
+        BotDatabase(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def workers(self, expiry):
+        return [BotDatabase(self.path, worker=u'worker-{}'.format(i), claim_expiry=expiry)
+                for i in xrange(2)]
+
+    def test_one_claim(self):
+        a, b = self.workers(600)
+        comment = Comment(u'c1')
+        self.assertTrue(a.claim_comment(comment))
+        self.assertFalse(b.claim_comment(comment))
+        # claiming again is fine for the holder.
+        self.assertTrue(a.claim_comment(comment))
+
+    def test_expired_claim_is_taken_over(self):
+        a, b = self.workers(0.01)
+        comment = Comment(u'c1')
+        self.assertTrue(a.claim_comment(comment))
+        sleep(0.05)
+        self.assertTrue(b.claim_comment(comment))
+
+    def test_handled_comment_is_never_claimed(self):
+        a, b = self.workers(0.01)
+        comment = Comment(u'c1')
+        self.assertTrue(a.claim_comment(comment))
+        a.add_comment(comment)
+        sleep(0.05)
+        self.assertFalse(b.claim_comment(comment))
+        self.assertFalse(a.claim_comment(comment))
+
+        # nor one handled without ever being claimed.
+        other = Comment(u'c2')
+        b.add_comment(other)
+        self.assertFalse(a.claim_comment(other))
+
+
+class CountTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+        self.path = pjoin(self.dir, u'bot.db')
+        self.db = BotDatabase(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_counts_written_on_commit(self):
+        self.db.add_resolution(u'Catan', 13, u'name')
+        for _ in xrange(3):
+            self.assertEqual((13, u'name'), self.db.get_resolution(u'catan'))
+        self.db.add_game_requests([13, 822])
+        self.db.add_game_requests([822])
+
+        # nothing is written until the commit.
+        other = BotDatabase(self.path)
+        self.assertEqual({u'name': 0}, other.resolution_stats()[u'saved'])
+        self.assertEqual([], other.popular_games(10))
+
+        self.db.commit()
+        self.assertEqual(3, other.resolution_stats()[u'saved'][u'name'])
+        self.assertEqual([822, 13], other.popular_games(10))
+        # and this process sees its own counts straight away.
+        self.db.add_game_requests([13, 13])
+        self.assertEqual([13, 822], self.db.popular_games(10))
+
+
+class NotFoundTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+        self.db = BotDatabase(pjoin(self.dir, u'bot.db'), not_found_ttl=0.05)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_expires(self):
+        self.db.add_not_found(u'Cataan')
+        self.assertTrue(self.db.is_not_found(u'  cataan '))
+        sleep(0.1)
+        self.assertFalse(self.db.is_not_found(u'Cataan'))
+
+    def test_no_ttl_remembers_nothing(self):
+        db = BotDatabase(pjoin(self.dir, u'other.db'), not_found_ttl=0)
+        db.add_not_found(u'Cataan')
+        self.assertFalse(db.is_not_found(u'Cataan'))
+
+    def test_alias_clears_not_found_and_resolution(self):
+        self.db.add_not_found(u'Settlers')
+        self.db.add_not_found(u'Catan')
+        self.db.add_resolution(u'Settlers', 1, u'search')
+        self.db.add_alias(u'settlers', u'Catan')
+
+        self.assertFalse(self.db.is_not_found(u'Settlers'))
+        self.assertFalse(self.db.is_not_found(u'Catan'))
+        self.assertIsNone(self.db.get_resolution(u'Settlers'))
+        self.assertEqual(u'Catan', self.db.get_name_from_alias(u'Settlers'))
+
+
+class TableCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+        self.path = pjoin(self.dir, u'bot.db')
+        self.db = BotDatabase(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_normalized(self):
+        self.db.add_alias(u'Settlers  of Catan', u'Catan')
+        self.db.add_ignored_user(u'SomeOne')
+        self.assertEqual(u'Catan', self.db.get_name_from_alias(u' settlers of\tcatan'))
+        # admins added when the database is made.
+        self.assertTrue(self.db.is_admin(u'Phil_S_Stein '))
+        self.assertTrue(self.db.ignore_user(u'someone '))
+        self.assertFalse(self.db.ignore_user(u'someone else'))
+
+    def test_changes_seen_at_once(self):
+        # read, so the tables are held in memory.
+        self.assertIsNone(self.db.get_name_from_alias(u'Settlers'))
+        self.assertFalse(self.db.is_admin(u'someone'))
+        self.assertFalse(self.db.ignore_user(u'spammer'))
+
+        self.db.add_alias(u'Settlers', u'Catan')
+        self.db.add_admin(u'someone')
+        self.db.add_ignored_user(u'spammer')
+        self.assertEqual(u'Catan', self.db.get_name_from_alias(u'Settlers'))
+        self.assertTrue(self.db.is_admin(u'someone'))
+        self.assertTrue(self.db.ignore_user(u'spammer'))
+
+    def test_changes_by_another_process_seen_after_refresh(self):
+        self.assertIsNone(self.db.get_name_from_alias(u'Settlers'))
+        self.assertFalse(self.db.is_admin(u'someone'))
+        self.assertFalse(self.db.ignore_user(u'spammer'))
+
+        other = BotDatabase(self.path)
+        other.add_alias(u'Settlers', u'Catan')
+        other.add_admin(u'someone')
+        other.add_ignored_user(u'spammer')
+        # still the copies in memory.
+        self.assertIsNone(self.db.get_name_from_alias(u'Settlers'))
+
+        self.db.refresh()
+        self.assertEqual(u'Catan', self.db.get_name_from_alias(u'Settlers'))
+        self.assertTrue(self.db.is_admin(u'someone'))
+        self.assertTrue(self.db.ignore_user(u'spammer'))
+
+        # nothing more to reload until there is another change.
+        self.db.refresh()
+        self.assertIsNotNone(self.db._alias_map)
+        other.add_ignored_user(u'troll')
+        self.db.refresh()
+        self.assertTrue(self.db.ignore_user(u'troll'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import shutil
+import sqlite3
+import sys
+import unittest
+from datetime import datetime, timedelta
+from os.path import abspath, dirname, join as pjoin
+from tempfile import mkdtemp
+from time import time
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from CacheManager import CacheManager, _TrackedCache  # noqa: E402
+
+
+class Backend(object):
+    '''A requests cache backend holding one response, saved age seconds ago.'''
+    def __init__(self, age):
+        self.stamp = datetime.utcnow() - timedelta(seconds=age)
+
+    def get_response_and_time(self, key, default=(None, None)):
+        return (u'response', self.stamp) if key == u'cached' else default
+
+
+class CacheManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+        self.path = pjoin(self.dir, u'bgg.db')
+        self.manager = CacheManager(self.path, interval=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_expired_is_a_miss(self):
+        for age, hits in [(10, 1), (100, 0)]:
+            manager = CacheManager(self.path, interval=0)
+            cache = _TrackedCache(Backend(age), manager, timedelta(seconds=60))
+            cache.get_response_and_time(u'cached')
+            cache.get_response_and_time(u'other')
+            self.assertEqual((hits, 2 - hits), (manager.hits, manager.misses))
+
+    def test_new_cache_uses_incremental_vacuum(self):
+        self.assertEqual(2, self.manager._connection.execute(u'PRAGMA auto_vacuum').fetchone()[0])
+
+    def test_vacuum_waits_for_a_quiet_database(self):
+        # made before the manager, so not incremental.
+        path = pjoin(self.dir, u'old.db')
+        old = sqlite3.connect(path)
+        old.execute(u'CREATE TABLE responses (key PRIMARY KEY, value)')
+        old.commit()
+        old.close()
+        manager = CacheManager(path, interval=0)
+        vacuum = lambda: manager._connection.execute(u'PRAGMA auto_vacuum').fetchone()[0]
+        self.assertEqual(0, vacuum())
+
+        # not by compacting, which must never block the bot.
+        manager.compact()
+        self.assertEqual(0, vacuum())
+
+        other = sqlite3.connect(path, isolation_level=None)
+        other.execute(u'BEGIN EXCLUSIVE')
+        self.assertFalse(manager.vacuum())
+        other.execute(u'ROLLBACK')
+
+        self.assertTrue(manager.vacuum())
+        self.assertEqual(2, vacuum())
+
+
+class EvictTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+        self.path = pjoin(self.dir, u'bgg.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def fill(self, manager):
+        '''Five responses of each kind, 1000 bytes each. With a half life of 100 seconds
+        they score: a (often, a while ago) 10.5, d (a few times, lately) 5.6, b (once, just
+        now) 1 and c (a few times, long ago) 0.5.'''
+        now = time()
+        c = manager._connection
+        for kind, uses, age in [(u'a', 20, 100), (u'b', 0, 0), (u'c', 3, 300), (u'd', 5, 10)]:
+            for i in xrange(5):
+                key = u'{}{}'.format(kind, i)
+                c.execute(u'INSERT INTO responses VALUES (?, ?)', (key, sqlite3.Binary(b'x' * 1000)))
+                c.execute(u'INSERT INTO urls VALUES (?, ?)', (u'url-' + key, key))
+                c.execute(u'INSERT INTO cache_access VALUES (?, ?, ?, ?)', (key, uses, now - age, now))
+        c.commit()
+
+    def left(self, manager):
+        return sorted(r[0] for r in manager._connection.execute(u'SELECT key FROM responses'))
+
+    def check_evicts_lowest_scores(self, **limits):
+        manager = CacheManager(self.path, interval=0, halfLife=100, batch=3, **limits)
+        self.fill(manager)
+        size = manager.measure()[u'file_bytes']
+        manager.compact()
+
+        # to 10% under the limit, 10 of the 20.
+        expected = [u'{}{}'.format(kind, i) for kind in u'ad' for i in xrange(5)]
+        self.assertEqual(expected, self.left(manager))
+        self.assertEqual(10, manager.measure()[u'evicted'])
+        self.assertEqual(10, manager._connection.execute(u'SELECT COUNT(*) FROM urls').fetchone()[0])
+        # and the space is given back.
+        self.assertLess(manager.measure()[u'file_bytes'], size)
+
+    def test_evicts_to_entries(self):
+        self.check_evicts_lowest_scores(maxEntries=12)
+
+    def test_evicts_to_bytes(self):
+        self.check_evicts_lowest_scores(maxBytes=12000)
+
+    def test_under_limits_evicts_nothing(self):
+        manager = CacheManager(self.path, interval=0, halfLife=100)
+        self.fill(manager)
+        manager.compact()
+        self.assertEqual(20, len(self.left(manager)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+import shutil
+import sys
+import unittest
+from os.path import abspath, dirname, join as pjoin
+from tempfile import mkdtemp
+from time import sleep
+
+from boardgamegeek.exceptions import BoardGameGeekError
+
+HERE = dirname(abspath(__file__))
+sys.path.insert(0, dirname(HERE))
+sys.path.insert(0, pjoin(dirname(HERE), u'bench'))
+
+from BotDatabase import BotDatabase  # noqa: E402
+from CommentHandler import CommentHandler  # noqa: E402
+from GameSummary import GameSummary  # noqa: E402
+from fakereddit import FakeReddit  # noqa: E402
+
+
+class DownBGG(object):
+    '''A BGGClient whose every request fails, slowly.'''
+    def game(self, name=None, game_id=None):
+        sleep(0.1)
+        raise BoardGameGeekError(u'BGG is down')
+
+    search = game
+
+
+class VariantBGG(object):
+    '''A BGGClient that knows some spellings of a game, each taking its own time to look
+    up. Keeps the names it has answered, in the order it answered them.'''
+    def __init__(self, games):
+        # name --> (seconds to answer, game or None)
+        self.games = games
+        self.answered = []
+
+    def game(self, name=None, game_id=None):
+        delay, game = self.games.get(name, (0.05, None))
+        sleep(delay)
+        self.answered.append(name)
+        return game
+
+
+class KnownBGG(object):
+    '''A BGGClient that knows a few games by name and id.'''
+    def __init__(self, *games):
+        self.games = games
+        self.asked = 0
+
+    def game(self, name=None, game_id=None):
+        self.asked += 1
+        for g in self.games:
+            if g.id == game_id or (name and g.name.lower() == name.lower()):
+                return g
+        return None
+
+    def search(self, name, **kwargs):
+        return []
+
+
+class LookupReddit(FakeReddit):
+    '''Keeps the ids passed to get_info() and counts the edits of each comment.'''
+    def __init__(self, botname):
+        super(LookupReddit, self).__init__(botname)
+        self.lookups = []
+        self.edits = {}
+
+    def get_info(self, thing_id=None):
+        self.lookups.append(thing_id)
+        return super(LookupReddit, self).get_info(thing_id)
+
+    def add(self, *args, **kwargs):
+        comment = super(LookupReddit, self).add(*args, **kwargs)
+        edit = comment.edit
+
+        def counted(text):
+            self.edits[comment.id] = self.edits.get(comment.id, 0) + 1
+            return edit(text)
+        comment.edit = counted
+        return comment
+
+
+class ProgressTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+        self.reddit = FakeReddit(u'r2d8')
+        self.handler = CommentHandler(u'r2d8', BotDatabase(pjoin(self.dir, u'bot.db')),
+                                      bgg=DownBGG(), progressDeadline=0.05)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_partial_reply_is_always_replaced(self):
+        comment = self.reddit.add(u'c1', u'/u/r2d8 getinfo **Catan**', u'user')
+        self.handler.getInfo(comment)
+
+        replies = [c for c in self.reddit.things.values() if c.parent_id == u'c1']
+        self.assertEqual(1, len(replies))
+        self.assertNotIn(u'Still looking', replies[0].body)
+        self.assertIn(u'Could not reach BGG', replies[0].body)
+
+
+class HandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+        self.handler = CommentHandler(u'r2d8', BotDatabase(pjoin(self.dir, u'bot.db')),
+                                      bgg=DownBGG())
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class RenderTest(HandlerTest):
+    def game(self, year, fetched):
+        return GameSummary(id=13, name=u'Catan', year=year, designers=(u'Klaus Teuber',),
+                           fetched=fetched)
+
+    def test_refreshed_game_is_rendered_again(self):
+        self.assertIn(u'1995', self.handler._renderInfo(self.game(1995, 100), u'short'))
+        # the same fetch is rendered from the cache.
+        self.assertIn(u'1995', self.handler._renderInfo(self.game(1996, 100), u'short'))
+        self.assertIn(u'1996', self.handler._renderInfo(self.game(1996, 200), u'short'))
+
+
+class ProbeTest(HandlerTest):
+    def cascade(self, probeWorkers, name):
+        bgg = VariantBGG({
+            # the name itself is slow to come back not found, "removing the's" finds the
+            # game slowly, and the less preferred "& --> and" finds another one at once.
+            u'the catan & co': (0.2, None),
+            u'catan & co': (0.2, GameSummary(id=13, name=u'Catan')),
+            u'the catan and co': (0, GameSummary(id=14, name=u'Catan and Co')),
+        })
+        handler = CommentHandler(u'r2d8', self.handler._botdb, bgg=bgg, probeWorkers=probeWorkers)
+        game, step = handler._bggCascade(name)
+        return game.id, step, bgg.answered
+
+    def test_most_preferred_variant_wins(self):
+        sequential = self.cascade(0, u'the catan & co')
+        self.assertEqual((13, u'removing "the"s'), sequential[:2])
+        # tried one after another, up to the first found.
+        self.assertEqual([u'the catan & co', u'catan & co'], sequential[2])
+
+        concurrent = self.cascade(8, u'the catan & co')
+        self.assertEqual(sequential[:2], concurrent[:2])
+        # the less preferred variant came back first, and lost.
+        self.assertEqual(u'the catan and co', concurrent[2][0])
+
+
+class RepairTest(unittest.TestCase):
+    CATAN = GameSummary(id=13, name=u'Catan', year=1995, designers=(u'Klaus Teuber',))
+    CARCASSONNE = GameSummary(id=822, name=u'Carcassonne', year=2000,
+                              designers=(u'Klaus-J\xfcrgen Wrede',))
+
+    def setUp(self):
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+        self.botdb = BotDatabase(pjoin(self.dir, u'bot.db'))
+        self.handler = CommentHandler(u'r2d8', self.botdb, bgg=KnownBGG(self.CATAN, self.CARCASSONNE))
+        self.reddit = LookupReddit(u'r2d8')
+        self.reddit.add(u'g1', u'/u/r2d8 getinfo short **Catan** **Carcasonne**', u'someone')
+        body = self.handler._renderResponse(u'g1', [self.CATAN], [u'Carcasonne'], u'short')
+        self.reply = self.reddit.add(u'r1', body, u'r2d8', parent_id=u'g1')
+        self.repair = self.reddit.add(u'c2', u'/u/r2d8 repair **Carcasonne**=**Carcassonne**',
+                                      u'someone', parent_id=u'r1')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def check_repaired(self):
+        self.assertIn(u'Carcassonne', self.reply.body)
+        self.assertIn(u'Catan', self.reply.body)
+        self.assertNotIn(u'geeksearch', self.reply.body)
+        mode, game_ids, not_found = self.botdb.get_reply(u'r1')
+        self.assertEqual((u'short', [13, 822], []), (mode, sorted(game_ids), not_found))
+
+    def test_repair_from_the_stored_reply(self):
+        self.botdb.add_reply(u'r1', u'short', [13], [u'Carcasonne'])
+        self.botdb.add_not_found(u'Carcasonne')
+        self.handler.repairComment(self.repair)
+
+        self.check_repaired()
+        self.assertFalse(self.botdb.is_not_found(u'Carcasonne'))
+        self.assertEqual({u'r1': 1}, self.reddit.edits)
+        # neither the grandparent nor the reply text is needed.
+        self.assertEqual([u'r1'], self.reddit.lookups)
+
+    def test_repair_from_the_reply_text(self):
+        self.handler.repairComment(self.repair)
+
+        self.check_repaired()
+        # the mode comes from the grandparent.
+        self.assertEqual([u'r1', u'g1'], self.reddit.lookups)
+
+
+class NotFoundTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+        self.bgg = KnownBGG(RepairTest.CATAN)
+        self.handler = CommentHandler(u'r2d8', BotDatabase(pjoin(self.dir, u'bot.db'),
+                                                           not_found_ttl=0.2), bgg=self.bgg)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_not_found_skips_bgg_until_it_expires(self):
+        self.assertIsNone(self.handler._bggQueryGame(u'Cataan'))
+        asked = self.bgg.asked
+        self.assertGreater(asked, 0)
+
+        self.assertIsNone(self.handler._bggQueryGame(u'cataan '))
+        self.assertEqual(asked, self.bgg.asked)
+
+        sleep(0.3)
+        self.assertIsNone(self.handler._bggQueryGame(u'Cataan'))
+        self.assertEqual(2 * asked, self.bgg.asked)
+
+
+class FitTest(HandlerTest):
+    def test_long_text_is_cut_at_a_line(self):
+        handler = self.handler
+        short = u'a\nb'
+        self.assertEqual(short, handler._fit(short))
+
+        text = u'\n'.join(u'line {}'.format(i) for i in xrange(3000))
+        fitted = handler._fit(text)
+        self.assertLessEqual(len(fitted), 10000)
+        self.assertTrue(text.startswith(fitted.split(u'\n\n*Cut short')[0] + u'\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
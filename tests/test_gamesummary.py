@@ -0,0 +1,133 @@
+import shutil
+import sys
+import unittest
+from os.path import abspath, dirname, join as pjoin
+from tempfile import mkdtemp
+from time import time
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from BGGClient import BGGClient  # noqa: E402
+from GameSummary import GameSummary, GameStore  # noqa: E402
+
+
+class Game(object):
+    '''The parts of a boardgamegeek BoardGame GameSummary.fromGame() reads.'''
+    def __init__(self, id, name):
+        self.id = unicode(id)
+        self.name = name
+        self.year = 1995
+        self.designers = [u'Klaus Teuber']
+        self.min_players = 3
+        self.max_players = 4
+        self.playing_time = 120
+        self.image = u'https://example.com/catan.jpg'
+        self.mechanics = [u'Dice Rolling', u'Trading']
+        self.rating_average = 7.1
+        self.users_rated = 100000
+        self.rating_average_weight = 2.3
+        self.rating_num_weights = 7000
+        self.ranks = [{u'friendlyname': u'Board Game Rank', u'value': 400},
+                      {u'friendlyname': u'Family Game Rank', u'value': 90}]
+        self.description = u'Trade and build on the island of Catan.'
+
+
+class FakeBGG(object):
+    '''A boardgamegeek BoardGameGeek that knows the one game, and counts the asking.'''
+    def __init__(self):
+        self.asked = 0
+
+    def game(self, name=None, game_id=None):
+        self.asked += 1
+        return Game(13, u'Catan')
+
+
+class CountingStore(GameStore):
+    def __init__(self, path):
+        super(CountingStore, self).__init__(path)
+        self.loads = 0
+
+    def description(self, game_id):
+        self.loads += 1
+        return super(CountingStore, self).description(game_id)
+
+
+class GameStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+        self.path = pjoin(self.dir, u'games.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_round_trip(self):
+        game = Game(13, u'Catan')
+        summary = GameSummary.fromGame(game, keepDescription=False)
+        GameStore(self.path).put(summary, game.description, fetched=100.0, name=u'catan')
+
+        store = CountingStore(self.path)
+        for loaded, fetched in [store.get(13), store.getByName(u'catan')]:
+            self.assertEqual(100.0, fetched)
+            self.assertEqual(100.0, loaded.fetched)
+            for f in GameSummary.FIELDS:
+                self.assertEqual(getattr(summary, f), getattr(loaded, f), f)
+            self.assertEqual(((u'Board Game Rank', 400), (u'Family Game Rank', 90)), loaded.ranks)
+            self.assertEqual((u'Dice Rolling', u'Trading'), loaded.mechanics)
+
+        self.assertIsNone(store.get(14))
+        self.assertIsNone(store.getByName(u'cataan'))
+
+    def test_description_is_loaded_when_used(self):
+        game = Game(13, u'Catan')
+        store = CountingStore(self.path)
+        store.put(GameSummary.fromGame(game, keepDescription=False), game.description)
+
+        summary, fetched = store.get(13)
+        self.assertEqual(0, store.loads)
+        self.assertEqual(game.description, summary.description)
+        self.assertEqual(game.description, summary.description)
+        self.assertEqual(1, store.loads)
+
+
+class StaleTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+        self.store = GameStore(pjoin(self.dir, u'games.db'))
+        self.bgg = FakeBGG()
+        self.client = BGGClient(self.bgg, interval=0, ttl=10, maxStale=100, prefetchBudget=0,
+                                store=self.store)
+        self.refreshed = []
+        self.client._refresh = self.refreshed.append
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def stored(self, age):
+        fetched = time() - age
+        game = Game(13, u'Catan')
+        self.store.put(GameSummary.fromGame(game, keepDescription=False), game.description,
+                       fetched=fetched, name=u'Catan')
+        return fetched
+
+    def test_fresh(self):
+        fetched = self.stored(1)
+        self.assertEqual(fetched, self.client.game(game_id=13).fetched)
+        self.assertEqual(fetched, self.client.game(u'Catan').fetched)
+        self.assertEqual(([], 0), (self.refreshed, self.bgg.asked))
+
+    def test_stale_is_returned_and_refreshed(self):
+        fetched = self.stored(50)
+        self.assertEqual(fetched, self.client.game(game_id=13).fetched)
+        self.assertEqual(([(None, 13)], 0), (self.refreshed, self.bgg.asked))
+
+    def test_too_stale_is_fetched_again(self):
+        fetched = self.stored(500)
+        game = self.client.game(game_id=13)
+        self.assertEqual(1, self.bgg.asked)
+        self.assertGreater(game.fetched, fetched)
+        # and kept.
+        self.assertEqual(game.fetched, self.store.get(13)[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
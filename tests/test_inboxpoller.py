@@ -0,0 +1,40 @@
+import shutil
+import sys
+import unittest
+from os.path import abspath, dirname, join as pjoin
+from tempfile import mkdtemp
+from time import time
+
+HERE = dirname(abspath(__file__))
+sys.path.insert(0, dirname(HERE))
+sys.path.insert(0, pjoin(dirname(HERE), u'bench'))
+
+from BotDatabase import BotDatabase  # noqa: E402
+from InboxPoller import InboxPoller  # noqa: E402
+from fakereddit import FakeReddit  # noqa: E402
+
+
+class PollTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+        self.db = BotDatabase(pjoin(self.dir, u'bot.db'), comment_retention=30 * 86400)
+        self.reddit = FakeReddit(u'r2d8')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_older_than_retention_is_skipped(self):
+        self.reddit.add(u'old', u'/u/r2d8 xyzzy', u'user', arrive=time() - 31 * 86400)
+        self.reddit.add(u'new', u'/u/r2d8 xyzzy', u'user', arrive=time() - 86400)
+        read = []
+        poller = InboxPoller(self.reddit, self.db, markRead=read.append)
+
+        self.assertEqual([u'new'], [c.id for c in poller.poll()])
+        self.assertEqual([u'old'], [c.id for c in read])
+        # a restart, with the pruned ids forgotten.
+        poller = InboxPoller(self.reddit, self.db)
+        self.assertEqual([u'new'], [c.id for c in poller.poll()])
+
+
+if __name__ == '__main__':
+    unittest.main()
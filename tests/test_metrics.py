@@ -0,0 +1,35 @@
+import re
+import sys
+import unittest
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from Metrics import Metrics, flatten  # noqa: E402
+
+# https://prometheus.io/docs/concepts/data_model/
+NAME = re.compile(u'^[a-zA-Z_:][a-zA-Z0-9_:]*$')
+
+
+class FlattenTest(unittest.TestCase):
+    def test_names_are_valid(self):
+        stats = {u'resolutions': {u'hits': 3, u'misses': 1,
+                                  u'saved': {u'and --> &': 2, u'& --> and': 1, u'exact': 5}},
+                 u'render "x"': 1}
+        flat = flatten(stats, u'cache_')
+        for name in flat:
+            self.assertRegexpMatches(name, NAME)
+        # different steps stay apart.
+        self.assertEqual(len([n for n in flat if n.startswith(u'cache_resolutions_saved_')]), 3)
+        self.assertEqual(flat[u'cache_resolutions_hit_ratio'], 0.75)
+
+    def test_rendered_page_is_valid(self):
+        metrics = Metrics()
+        metrics.collect(lambda: flatten({u'saved': {u'and --> &': 2}}, u'cache_'))
+        for line in metrics.render().splitlines():
+            if line and not line.startswith(u'#'):
+                self.assertRegexpMatches(line.split(u' ')[0], NAME)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import csv
+import shutil
+import sys
+import unittest
+from os.path import abspath, dirname, join as pjoin
+from tempfile import mkdtemp
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from BotDatabase import BotDatabase  # noqa: E402
+from CommentHandler import CommentHandler  # noqa: E402
+from GameSummary import GameSummary  # noqa: E402
+from NameIndex import NameIndex  # noqa: E402
+
+# id, name, primary, owned, is_expansion
+ROWS = [(169786, u'Scythe', 1, 90000, 0),
+        (199727, u'Scythe: Invaders from Afar', 1, 30000, 1),
+        (167791, u'Terraforming Mars', 1, 100000, 0),
+        (68448, u'7 Wonders', 1, 110000, 0),
+        (68448, u'Seven Wonders', 0, 110000, 0),
+        (13, u'Catan', 1, 120000, 0),
+        (13, u'The Settlers of Catan', 0, 120000, 0),
+        (822, u'Carcassonne', 1, 110000, 0)]
+
+
+def build(directory):
+    dump = pjoin(directory, u'names.csv')
+    with open(dump, 'wb') as fd:
+        w = csv.writer(fd)
+        w.writerow(['id', 'name', 'primary', 'owned', 'is_expansion'])
+        for row in ROWS:
+            w.writerow([unicode(v).encode('utf-8') for v in row])
+    prefix = pjoin(directory, u'names')
+    NameIndex.build(dump, prefix)
+    return NameIndex(prefix)
+
+
+class NameIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+        self.index = build(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_build(self):
+        # the expansion is left out.
+        self.assertEqual(7, len(self.index))
+
+    def test_exact(self):
+        self.assertEqual(169786, self.index.lookup(u'Scythe'))
+        self.assertEqual(167791, self.index.lookup(u'  terraforming   MARS '))
+        self.assertEqual(13, self.index.lookup(u'Catan', fuzzy=False))
+        self.assertTrue(self.index.contains(u'the Catan'))
+        self.assertIsNone(self.index.lookup(u'Scythe: Invaders from Afar', fuzzy=False))
+
+    def test_alternate_name(self):
+        self.assertEqual(68448, self.index.lookup(u'Seven Wonders', fuzzy=False))
+        self.assertEqual(13, self.index.lookup(u'Settlers of Catan', fuzzy=False))
+
+    def test_fuzzy(self):
+        # a letter dropped and one swapped.
+        self.assertEqual(167791, self.index.lookup(u'Terraformng Mars'))
+        self.assertEqual(822, self.index.lookup(u'Carcasonne'))
+        self.assertIsNone(self.index.lookup(u'Terraformng Mars', fuzzy=False))
+
+    def test_near_miss(self):
+        # close to Scythe, but not it, so only a fuzzy lookup may say it is.
+        self.assertIsNone(self.index.lookup(u'Scythe 2', fuzzy=False))
+        self.assertIsNone(self.index.lookup(u'Sky Team'))
+        self.assertIsNone(self.index.lookup(u'Mars'))
+
+
+class FakeBGG(object):
+    '''Knows games by name and id. Search finds nothing.'''
+    def __init__(self, games):
+        self.games = games
+        self.searched = []
+
+    def game(self, name=None, game_id=None):
+        for game in self.games:
+            if (game_id and game.id == int(game_id)) or (name and game.name.lower() == name.lower()):
+                return game
+        return None
+
+    def search(self, name, **kwargs):
+        self.searched.append(name)
+        return []
+
+
+class ResolveTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+        self.botdb = BotDatabase(pjoin(self.dir, u'bot.db'))
+        self.bgg = FakeBGG([GameSummary(id=169786, name=u'Scythe'),
+                            GameSummary(id=999, name=u'Scythe 2'),
+                            GameSummary(id=167791, name=u'Terraforming Mars')])
+        self.handler = CommentHandler(u'r2d8', self.botdb, bgg=self.bgg,
+                                      nameIndex=build(self.dir))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_missing_from_index_is_not_replaced_by_a_neighbour(self):
+        self.assertEqual(999, self.handler._bggQueryGame(u'Scythe 2').id)
+        self.assertEqual((999, u'name'), tuple(self.botdb.get_resolution(u'Scythe 2')))
+
+    def test_fuzzy_match_stands_in_for_search(self):
+        self.assertEqual(167791, self.handler._bggQueryGame(u'Terraformng Mars').id)
+        self.assertEqual((167791, u'name index fuzzy'),
+                         tuple(self.botdb.get_resolution(u'Terraformng Mars')))
+        self.assertEqual([], self.bgg.searched)
+
+
+if __name__ == '__main__':
+    unittest.main()
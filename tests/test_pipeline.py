@@ -0,0 +1,156 @@
+import shutil
+import sqlite3
+import sys
+import threading
+import unittest
+from os.path import abspath, dirname, join as pjoin
+from tempfile import mkdtemp
+from time import time, sleep
+
+HERE = dirname(abspath(__file__))
+sys.path.insert(0, dirname(HERE))
+sys.path.insert(0, pjoin(dirname(HERE), u'bench'))
+
+from BotDatabase import BotDatabase  # noqa: E402
+from BotPipeline import BotPipeline  # noqa: E402
+from EventPipeline import EventPipeline  # noqa: E402
+from InboxPoller import InboxPoller  # noqa: E402
+from fakereddit import FakeReddit  # noqa: E402
+
+
+class FlakyDatabase(BotDatabase):
+    '''Fails the first claim and the first record with "database is locked".'''
+    def __init__(self, *args, **kwargs):
+        super(FlakyDatabase, self).__init__(*args, **kwargs)
+        self.fail = set([u'claim', u'add'])
+
+    def _maybeFail(self, what):
+        if what in self.fail:
+            self.fail.discard(what)
+            raise sqlite3.OperationalError(u'database is locked')
+
+    def claim_comment(self, comment):
+        self._maybeFail(u'claim')
+        return super(FlakyDatabase, self).claim_comment(comment)
+
+    def add_comment(self, comment):
+        self._maybeFail(u'add')
+        return super(FlakyDatabase, self).add_comment(comment)
+
+
+class LockedDatabase(FlakyDatabase):
+    '''Fails the first commit, refresh and prune with "database is locked".'''
+    def __init__(self, *args, **kwargs):
+        super(LockedDatabase, self).__init__(*args, **kwargs)
+        self.fail = set([u'commit', u'refresh', u'prune'])
+
+    def commit(self):
+        self._maybeFail(u'commit')
+        return super(LockedDatabase, self).commit()
+
+    def refresh(self):
+        self._maybeFail(u'refresh')
+        return super(LockedDatabase, self).refresh()
+
+    def prune_comments(self):
+        self._maybeFail(u'prune')
+        return super(LockedDatabase, self).prune_comments()
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def run_pipeline(self, pipeline, until, timeout=10):
+        t = threading.Thread(target=pipeline.run)
+        t.start()
+        deadline = time() + timeout
+        while not until() and time() < deadline:
+            sleep(0.02)
+        pipeline.stop()
+        t.join()
+
+    def check_survives_database_errors(self, make):
+        botdb = FlakyDatabase(pjoin(self.dir, u'bot.db'))
+        reddit = FakeReddit(u'r2d8')
+        for i in xrange(3):
+            reddit.add(u'c{}'.format(i), u'/u/r2d8 xyzzy', u'someone', arrive=time())
+        handled = []
+        poller = InboxPoller(reddit, botdb, minInterval=0.01, maxInterval=0.05)
+        pipeline = make(reddit, botdb, u'r2d8', {u'xyzzy': lambda c: handled.append(c.id)},
+                        poller=poller)
+        self.run_pipeline(pipeline, lambda: len(set(handled)) == 3)
+
+        # the comment whose claim failed is offered again, and the worker lives on to
+        # handle the rest.
+        self.assertEqual(sorted(set(handled)), [u'c0', u'c1', u'c2'])
+        self.assertEqual(len([c for c in reddit.inbox if botdb.comment_exists(c)]), 2)
+        self.assertEqual(len(pipeline._pending), 0)
+
+    def test_worker_survives_database_errors(self):
+        self.check_survives_database_errors(
+            lambda *args, **kwargs: BotPipeline(*args, workers=1, **kwargs))
+
+    def test_event_loop_survives_database_errors(self):
+        self.check_survives_database_errors(
+            lambda *args, **kwargs: EventPipeline(*args, concurrency=1, **kwargs))
+
+    def test_fetcher_survives_a_locked_commit(self):
+        botdb = LockedDatabase(pjoin(self.dir, u'bot.db'))
+        reddit = FakeReddit(u'r2d8')
+        reddit.add(u'c0', u'/u/r2d8 xyzzy', u'someone', arrive=time())
+        handled = []
+        poller = InboxPoller(reddit, botdb, minInterval=0.01, maxInterval=0.05)
+        pipeline = BotPipeline(reddit, botdb, u'r2d8', {u'xyzzy': lambda c: handled.append(c.id)},
+                               poller=poller)
+        # the first commit fails before c1 arrives. It is handled only if fetching goes on.
+        reddit.add(u'c1', u'/u/r2d8 xyzzy', u'someone', arrive=time() + 0.3)
+        self.run_pipeline(pipeline, lambda: len(set(handled)) == 2)
+
+        self.assertEqual(sorted(set(handled)), [u'c0', u'c1'])
+        self.assertEqual(set(), botdb.fail)
+
+    def test_timed_out_comment_is_recorded_only_when_done(self):
+        botdb = BotDatabase(pjoin(self.dir, u'bot.db'))
+        reddit = FakeReddit(u'r2d8')
+        slow = reddit.add(u'c0', u'/u/r2d8 slow', u'someone', arrive=time())
+        quick = reddit.add(u'c1', u'/u/r2d8 quick', u'someone', arrive=time() + 0.1)
+        release = threading.Event()
+        handled = []
+
+        def hang(comment):
+            release.wait(10)
+            handled.append(comment.id)
+
+        poller = InboxPoller(reddit, botdb, minInterval=0.01, maxInterval=0.05)
+        pipeline = EventPipeline(reddit, botdb, u'r2d8',
+                                 {u'slow': hang, u'quick': lambda c: handled.append(c.id)},
+                                 concurrency=1, timeout=0.2, poller=poller)
+        t = threading.Thread(target=pipeline.run)
+        t.start()
+        try:
+            deadline = time() + 10
+            while not pipeline._overdue and time() < deadline:
+                sleep(0.02)
+            sleep(0.3)
+            # given up on, but neither recorded nor out of the way of c1.
+            self.assertEqual(set([u'c0']), pipeline._overdue)
+            self.assertFalse(botdb.comment_exists(slow))
+            self.assertEqual([], handled)
+
+            release.set()
+            while not botdb.comment_exists(quick) and time() < deadline:
+                sleep(0.02)
+            self.assertEqual([u'c0', u'c1'], handled)
+            self.assertTrue(botdb.comment_exists(slow))
+        finally:
+            release.set()
+            pipeline.stop()
+            t.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import shutil
+import sys
+import unittest
+from os.path import abspath, dirname, join as pjoin
+from tempfile import mkdtemp
+from time import sleep
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from Profiler import Profiler  # noqa: E402
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+        self.profiler = Profiler(pjoin(self.dir, u'profile.jsonl'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_done(self):
+        summaries = []
+        self.assertTrue(self.profiler.start(1, onDone=summaries.append))
+        with self.profiler.command(u'c1', u'getinfo'):
+            with self.profiler.span(u'lookup'):
+                pass
+        self.assertFalse(self.profiler.active)
+        self.assertEqual(1, len(summaries))
+        self.assertIn(u'lookup', summaries[0])
+
+    def test_hung_command_times_out(self):
+        summaries = []
+        self.assertTrue(self.profiler.start(2, onDone=summaries.append, timeout=0.1))
+        with self.profiler.command(u'c1', u'getinfo'):
+            pass
+        hung = self.profiler.command(u'c2', u'getinfo')
+        hung.__enter__()
+        self.assertFalse(self.profiler.start(1))
+
+        sleep(0.3)
+        self.assertFalse(self.profiler.active)
+        self.assertEqual(1, len(summaries))
+        self.assertIn(u'Timed out waiting for 1 more', summaries[0])
+
+        # the hung command finishing late is not part of the next profile.
+        self.assertTrue(self.profiler.start(1, onDone=summaries.append))
+        hung.__exit__(None, None, None)
+        self.assertTrue(self.profiler.active)
+        self.assertEqual(1, len(summaries))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import shutil
+import sys
+import unittest
+from os.path import abspath, dirname, join as pjoin
+from tempfile import mkdtemp
+from time import time, sleep
+
+HERE = dirname(abspath(__file__))
+sys.path.insert(0, dirname(HERE))
+sys.path.insert(0, pjoin(dirname(HERE), u'bench'))
+
+from BotDatabase import BotDatabase  # noqa: E402
+from ReplyQueue import ReplyQueue  # noqa: E402
+from fakereddit import FakeRateLimit, FakeReddit  # noqa: E402
+
+
+class FlakyReddit(FakeReddit):
+    '''Raises each of errors in turn for the next replies and edits, and counts the calls
+    to get_info().'''
+    def __init__(self, botname, errors=()):
+        super(FlakyReddit, self).__init__(botname)
+        self.errors = list(errors)
+        self.lookups = 0
+
+    def throttle(self):
+        if self.errors:
+            raise self.errors.pop(0)
+
+    def get_info(self, thing_id=None):
+        self.lookups += 1
+        return super(FlakyReddit, self).get_info(thing_id)
+
+
+class ReplyQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+        self.botdb = BotDatabase(pjoin(self.dir, u'bot.db'))
+        self.queues = []
+
+    def tearDown(self):
+        for queue in self.queues:
+            queue.close(0)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def queue(self, reddit, **kwargs):
+        kwargs.setdefault(u'interval', 0)
+        kwargs.setdefault(u'backoff', 0.01)
+        queue = ReplyQueue(reddit, self.botdb, **kwargs)
+        self.queues.append(queue)
+        return queue
+
+    def replies(self, reddit, parent=u'c1'):
+        return [c for c in reddit.things.values() if c.parent_id == parent]
+
+    def wait(self, until, timeout=5):
+        deadline = time() + timeout
+        while not until() and time() < deadline:
+            sleep(0.01)
+        self.assertTrue(until())
+
+    def test_outbox_survives_a_restart(self):
+        down = FlakyReddit(u'r2d8', [IOError(u'Reddit is down')] * 10)
+        queue = self.queue(down, backoff=10)
+        oid = queue.reply(down.add(u'c1', u'/u/r2d8 getinfo **Catan**', u'someone'), u'Looking')
+        queue.edit(oid, u'Catan, 1995')
+        self.wait(lambda: len(down.errors) < 10)
+        queue.close(0)
+        self.assertEqual([], self.replies(down))
+        self.assertEqual(2, len(self.botdb.pending_outgoing()))
+
+        reddit = FlakyReddit(u'r2d8')
+        reddit.add(u'c1', u'/u/r2d8 getinfo **Catan**', u'someone')
+        self.queue(reddit)
+        self.wait(lambda: not self.botdb.pending_outgoing())
+        replies = self.replies(reddit)
+        self.assertEqual([u'Catan, 1995'], [r.body for r in replies])
+
+    def test_rate_limits_are_waited_out(self):
+        reddit = FlakyReddit(u'r2d8', [FakeRateLimit(0.05)] * 3)
+        queue = self.queue(reddit, retries=1)
+        start = time()
+        queue.reply(reddit.add(u'c1', u'/u/r2d8 getinfo **Catan**', u'someone'), u'Catan')
+        self.wait(lambda: self.replies(reddit))
+        # not counted against retries, however many.
+        self.assertGreaterEqual(time() - start, 0.15)
+        self.assertEqual([], reddit.errors)
+
+    def test_errors_are_retried_with_growing_waits(self):
+        reddit = FlakyReddit(u'r2d8', [IOError(u'Reddit is down')] * 3)
+        queue = self.queue(reddit, retries=3, backoff=0.05)
+        start = time()
+        queue.reply(reddit.add(u'c1', u'/u/r2d8 getinfo **Catan**', u'someone'), u'Catan')
+        self.wait(lambda: self.replies(reddit))
+        # 0.05 + 0.1 + 0.2
+        self.assertGreaterEqual(time() - start, 0.35)
+
+    def test_edit_of_a_dropped_reply_is_made_as_the_reply(self):
+        reddit = FlakyReddit(u'r2d8', [IOError(u'Reddit is down')] * 2)
+        queue = self.queue(reddit, retries=1)
+        oid = queue.reply(reddit.add(u'c1', u'/u/r2d8 getinfo **Catan**', u'someone'), u'Looking')
+        queue.edit(oid, u'Catan, 1995')
+        queue.edit(oid, u'Catan, 1995, Klaus Teuber')
+        self.wait(lambda: not self.botdb.pending_outgoing())
+        self.assertEqual([u'Catan, 1995, Klaus Teuber'], [r.body for r in self.replies(reddit)])
+        self.assertEqual(0, reddit.lookups)
+
+    def test_edit_of_a_reply_dropped_before_a_restart_is_dropped(self):
+        self.botdb.add_outgoing(u'edit', u'outbox:99', u'Catan, 1995')
+        reddit = FlakyReddit(u'r2d8')
+        start = time()
+        self.queue(reddit, backoff=5)
+        self.wait(lambda: not self.botdb.pending_outgoing())
+        # not looked up on Reddit, nor retried.
+        self.assertEqual(0, reddit.lookups)
+        self.assertLess(time() - start, 1)
+
+    def test_marked_read_in_batches(self):
+        reddit = FlakyReddit(u'r2d8')
+        queue = self.queue(reddit, readBatch=3, readInterval=60)
+        comments = [reddit.add(u'c{}'.format(i), u'/u/r2d8 getinfo', u'someone', arrive=time())
+                    for i in xrange(7)]
+        for comment in comments:
+            queue.markRead(comment)
+        self.assertEqual(2, reddit.markCalls)
+        self.assertEqual([u'c6'], [c.id for c in reddit.get_unread()])
+
+        # the rest on close.
+        queue.close(0)
+        self.assertEqual(3, reddit.markCalls)
+        self.assertTrue(reddit.done())
+
+
+if __name__ == '__main__':
+    unittest.main()
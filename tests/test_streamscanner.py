@@ -0,0 +1,72 @@
+import shutil
+import sqlite3
+import sys
+import unittest
+from os.path import abspath, dirname, join as pjoin
+from tempfile import mkdtemp
+from time import time, sleep
+
+HERE = dirname(abspath(__file__))
+sys.path.insert(0, dirname(HERE))
+sys.path.insert(0, pjoin(dirname(HERE), u'bench'))
+
+from BotDatabase import BotDatabase  # noqa: E402
+from StreamScanner import StreamScanner  # noqa: E402
+from fakereddit import FakeReddit  # noqa: E402
+
+
+class LockedOnce(BotDatabase):
+    def __init__(self, *args, **kwargs):
+        super(LockedOnce, self).__init__(*args, **kwargs)
+        self.locked = True
+
+    def claim_comment(self, comment):
+        if self.locked:
+            self.locked = False
+            raise sqlite3.OperationalError(u'database is locked')
+        return super(LockedOnce, self).claim_comment(comment)
+
+
+class StreamScannerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp(prefix=u'r2d8-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_filter(self):
+        botdb = BotDatabase(pjoin(self.dir, u'bot.db'))
+        botdb.add_resolution(u'Catan', 13, u'exact')
+        scanner = StreamScanner(FakeReddit(u'r2d8'), botdb, u'r2d8', [u'boardgames'], None)
+        scanner._loadNames()
+        reddit = FakeReddit(u'r2d8')
+        for body, names in [(u'I like **Catan** a lot', [u'Catan']),
+                            (u'I like Catan a lot', []),
+                            (u'**not a game** here', []),
+                            (u'**Seven Wonders** via an alias', [u'Seven Wonders']),
+                            (u'/u/r2d8 getinfo **Catan**', [])]:
+            self.assertEqual(scanner.candidateNames(reddit.add(None, body, u'someone')), names)
+
+    def test_worker_survives_database_errors(self):
+        botdb = LockedOnce(pjoin(self.dir, u'bot.db'))
+        botdb.add_resolution(u'Catan', 13, u'exact')
+        reddit = FakeReddit(u'r2d8')
+        for i in xrange(2):
+            reddit.add(u's{}'.format(i), u'**Catan**', u'someone', arrive=time() + i * 0.01,
+                       stream=True)
+        answered = []
+        scanner = StreamScanner(reddit, botdb, u'r2d8', [u'boardgames'],
+                                lambda c, names: answered.append(c.id) or True, interval=0.05)
+        scanner.start()
+        deadline = time() + 5
+        while not answered and time() < deadline:
+            sleep(0.02)
+        scanner.stop()
+
+        # the first claim failed, the second comment was still answered.
+        self.assertEqual(answered, [u's1'])
+        self.assertEqual(scanner.stats()[u'boardgames'][u'answered'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()